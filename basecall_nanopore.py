@@ -1,11 +1,25 @@
 import os
+import sys
+import copy
+import json
+import time
+import signal
+import hashlib
+from glob import glob
 from argparse import ArgumentParser
+from concurrent import futures
 from multiprocessing import cpu_count
 from psutil import virtual_memory
 from basecall_nanopore_methods import Methods
-import pkg_resources
 import shutil
 from kits import Kits
+from scheduler import Scheduler
+from basecall_server import BasecallServer
+from tuning import Tuner
+from catalog import Catalog
+from metrics import Metrics
+from process_engine import ProcessEngine
+from executors import Executors
 
 
 __author__ = 'duceppemo'
@@ -15,12 +29,12 @@ __version__ = '0.1'
 #       Space separated list of barcoding kit(s) or expansion kit(s) to detect against. Must be in double quotes.
 # TODO: check that is the GPU version of guppy installed
 #       Maybe by running "nvidia-smi" and checkking 1) no error (gpu driver working properly)
-#       2) if "guppy_basecall_server" is running (printed in the ouptut of the command)
 
 
 class Basecaller(object):
-    def __init__(self, args):
+    def __init__(self, args, name=None):
         # I/O
+        self.name = name  # Run name in a batch, None for a single run
         self.input = os.path.abspath(args.input)
         self.output_folder = os.path.abspath(args.output)
 
@@ -28,9 +42,23 @@ class Basecaller(object):
         self.cpu = args.threads
         self.parallel = args.parallel
         self.mem = args.memory
+        self.tool_timeout = args.tool_timeout
+        self.tool_retries = args.tool_retries
+        self.executor_name = args.executor
+        self.cluster_config = args.cluster_config
+        self.executor = None
 
         # Guppy related
         self.gpu = args.gpu
+        self.device_list = args.gpu.replace('"', '').split()
+        self.workers_per_device = args.workers_per_device
+        self.server = args.server
+        self.port = args.port
+        self.clients = args.clients
+        self.tune = args.tune
+        self.tune_files = args.tune_files
+        self.guppy_params = None
+        self.prometheus = args.prometheus
         self.description = args.description
         self.barcode_kit = args.barcode_kit[0].split()
         self.sequencer = args.sequencer
@@ -39,13 +67,51 @@ class Basecaller(object):
         self.library_kit = args.library_kit
         self.recursive = args.recursive
         # self.accuracy = args.accuracy
-        self.workflows = pkg_resources.resource_filename('data', 'workflows.tsv')
+
+        # Trimming and filtering
+        self.qc = args.qc
+        self.trimmer = args.trimmer
+        self.adapter_dict = Kits.get_adapters(self.library_kit)
+        self.filter = args.filter
+        self.fused = args.fused
+        self.keep_trimmed = args.keep_trimmed
+        self.bgzf = args.bgzf
+        self.target_bases = args.target_bases
+        self.target_dict = dict()
+
+        # Intermediate files
+        self.intermediate = args.intermediate_compression
+        self.scratch = os.path.abspath(args.scratch) if args.scratch else None
+        self.scratch_size = args.scratch_size
+        self.scratch_budget = None  # {'bytes': left}, shared by the runs of a batch
+        self.scratch_folder = None
+        self.cleanup = args.cleanup
+        self.disk_reserve = None if args.no_disk_check else int(args.disk_reserve * 1000000000)  # Bytes to keep free
+
+        # Live basecalling
+        self.watch = args.watch
+        self.watch_interval = args.watch_interval
+        self.watch_timeout = args.watch_timeout
+        self.watch_batch = args.watch_batch
+        self.workflows = Catalog.workflows
 
         # Data
         self.sample_dict = dict()
 
-        # Run
-        self.run()
+        # Run. The runs of a batch are driven by BatchBasecaller.
+        if name is None:
+            try:
+                self.run()
+            finally:
+                self.write_metrics()
+
+    def write_metrics(self):
+        # Also written when the run fails, to see where it stopped
+        if not os.path.isdir(self.output_folder):
+            return
+        Metrics.write_report(self.output_folder + '/run_metrics.json')
+        if self.prometheus:
+            Metrics.write_prometheus(self.prometheus)
 
     def run(self):
 
@@ -56,14 +122,97 @@ class Basecaller(object):
         ##################
 
         print('Checking a few things...')
+        self.check_resources(self.output_folder + '/cluster_jobs/')
+        self.check()
+        if self.disk_reserve is not None and not self.tune:
+            self.check_disk_space(self.estimate_footprint())
+        print('\tAll good!')
+
+        ##################
+        #
+        # Preparing outputs
+        #
+        ##################
+
+        # Checkpoint manifest of the completed nodes, for resuming purposes
+        manifest_file = self.output_folder + '/checkpoints.json'
+
+        # Output folders
+        self.prepare_outputs()
+
+        # Samples are processed independently, QC runs alongside trimming and filtering
+        scheduler = Scheduler(manifest_file, limits={'sample': self.parallel}, cpu=self.cpu, mem=self.mem,
+                              disk_reserve=self.disk_reserve)
+
+        ##################
+        #
+        # 1- Basecalling
+        #
+        ##################
+
+        guppy_conf = self.get_guppy_conf()
+
+        if self.tune:
+            # Only find the best Guppy parameters for this machine and config, saved for the next runs
+            Tuner.tune(self.input, self.output_folder, guppy_conf, self.recursive, self.gpu, self.tune_files,
+                       self.fast5_dict)
+            return
+
+        self.add_basecalling(scheduler, guppy_conf)
+        if scheduler.is_done(self.node('basecalling')) and scheduler.is_done(self.node('demultiplexing')):
+            print('Skipping basecalling. Already done.')
+        scheduler.run()
+
+        ##################
+        #
+        # 2- QC, 3- Trim reads and 4- Filter reads
+        #
+        ##################
+
+        self.add_samples(scheduler)
+        scheduler.run()
+        self.finish()
+
+        ##################
+        #
+        # Done
+        #
+        ##################
+
+        # Remove 'guppy_basecaller-core-dump-db' ?
+        print('DONE!')
+
+    def node(self, stage, sample=None):
+        # Node names are unique across the runs of a batch: "trimming:barcode01" or "trimming:run1/barcode01"
+        label = '/'.join(x for x in [self.name, sample] if x)
+        return stage + ':' + label if label else stage
 
+    def check_resources(self, job_folder):
         # Check if number of CPU and memory requested are valid
         self.cpu, self.parallel = Methods.check_cpus(self.cpu, self.parallel)
         self.mem = Methods.check_mem(self.mem)
 
-        # Check input folder
+        # At most one external tool per thread (Guppy not counted), with the requested timeout and retries
+        ProcessEngine.configure(limits={'tools': max(self.cpu, self.parallel)},
+                                timeout=self.tool_timeout * 60 if self.tool_timeout else None,
+                                retries=self.tool_retries)
+
+        # Where the per-sample steps run
+        if self.cluster_config and not os.path.exists(self.cluster_config):
+            raise Exception('Cluster config file "{}" not found.'.format(self.cluster_config))
+        self.executor = Executors.get(self.executor_name, self.parallel, job_folder, self.cluster_config)
+
+        # Size limit of the intermediate files staged on the scratch folder
+        if self.scratch:
+            self.scratch_budget = {'bytes': Methods.check_scratch(self.scratch, self.scratch_size)}
+
+    def check(self):
+        # Check input folder. The fast5 manifest is reused by the basecalling, and next scans are incremental.
         Methods.check_input(self.input)
-        Methods.check_fast5(self.input)
+        Methods.make_folder(self.output_folder)
+        self.fast5_manifest = self.output_folder + '/fast5_manifest.json'
+        self.fast5_dict = Methods.list_fast5(self.input, self.recursive, self.fast5_manifest)
+        Methods.check_fast5(self.fast5_dict)
 
         # Check if Guppy is installed
         Methods.check_guppy()
@@ -74,125 +223,620 @@ class Basecaller(object):
         # Check barcodes
         Methods.check_barcode(self.barcode_kit, self.description)
 
-        print('\tAll good!')
+        # Target number of bases per sample, if any
+        self.target_dict, self.target_bases = Methods.parse_target_bases(self.description, self.target_bases)
 
-        ##################
-        #
-        # Preparing outputs
-        #
-        ##################
+        # Output format of all the fastq files written by the pipeline, and compression of the intermediate ones
+        Methods.bgzf = self.bgzf
+        Methods.intermediate = self.intermediate
 
-        # Step completion report files
-        done_basecalling = self.output_folder + '/done_basecalling'
-        done_qc = self.output_folder + '/done_QC'
-        done_trimming = self.output_folder + '/done_trimming'
-        done_filtering = self.output_folder + '/done_filtering'
+    def estimate_footprint(self):
+        """
+        Bytes the run still has to write to its output folder at its peak, from the size of the fast5 files and the
+        ratios of each stage. With "--cleanup", the basecalled and trimmed reads of each sample are deleted once used,
+        so the peak is about the basecalled reads and the filtered reads.
+        """
+        fastq = sum(x[0] for x in self.fast5_dict.values()) * Methods.fastq_per_fast5
+        intermediate_ratio = Methods.compression_ratios[self.intermediate]
+        basecalled = fastq * intermediate_ratio
+        trimmed = fastq * Methods.stage_ratios['trimmed'] * intermediate_ratio
+        if (self.fused or self.scratch or self.cleanup) and not self.keep_trimmed:
+            trimmed = 0  # Not written, on the scratch folder or deleted once filtered
+        filtered = fastq * Methods.stage_ratios['filtered'] * Methods.compression_ratios['gzip']
+        # Plain fastq from Guppy until merged, unless it compresses them
+        peak = max(fastq if self.intermediate != 'gzip' else basecalled, basecalled + trimmed + filtered)
+        return int(max(peak - Methods.folder_size(self.output_folder), 0))  # Minus what a previous run wrote
 
+    def check_disk_space(self, needed):
+        free = Methods.check_disk_space(self.output_folder, needed, self.disk_reserve)
+        print('\tAbout {:.1f} GB to write, {:.1f} GB free.'.format(needed / 1000000000, free / 1000000000))
+
+    def prepare_outputs(self):
         # Output folders to create
-        basecalled_folder = self.output_folder + '/1_basecalled/'
-        qc_folder = self.output_folder + '/2_qc/'
-        trimmed_folder = self.output_folder + '/3_trimmed/'
-        filtered_folder = self.output_folder + '/4_filtered/'
+        self.basecalled_folder = self.output_folder + '/1_basecalled/'
+        self.qc_folder = self.output_folder + '/2_qc/'
+        self.trimmed_folder = self.output_folder + '/3_trimmed/'
+        self.filtered_folder = self.output_folder + '/4_filtered/'
+        self.trimmed_batch_folder = self.trimmed_folder + 'batches/'  # Watch mode only
+        self.preselected_folder = self.trimmed_folder + 'preselected/'  # With a target number of bases only
+        if self.scratch:
+            # Same folder when the run is resumed, a different one for each output folder
+            self.scratch_folder = '{}/basecall_nanopore_{}/'.format(
+                self.scratch, hashlib.md5(self.output_folder.encode()).hexdigest()[:8])
 
         # Create output folder
         Methods.make_folder(self.output_folder)
 
-        ##################
-        #
-        # 1- Basecalling
-        #
-        ##################
-
-        if not os.path.exists(done_basecalling):
-            # Retrieve proper configuration file
-            if not self.config:
-                guppy_conf = Methods.get_guppy_config(self.flowcell, self.library_kit, self.sequencer, self.workflows)
-            else:
-                guppy_conf = self.config
-
-            # Basecall fast5 to
-            Methods.run_guppy(self.input, basecalled_folder, guppy_conf, self.recursive,
-                              self.gpu, self.barcode_kit)
-
-            # Merge all fastq per barcode, if more than one file present
-            Methods.merge_rename_fastq(basecalled_folder, self.barcode_kit)
+    def get_guppy_conf(self):
+        # Retrieve proper configuration file
+        if not self.config:
+            return Methods.get_guppy_config(self.flowcell, self.library_kit, self.sequencer, self.workflows)
+        return self.config
 
-            if self.description:
-                sample_dict = Methods.parse_samples(self.description)
-                Methods.rename_barcode(sample_dict, basecalled_folder)  # Also remove extra barcode folders
+    def add_basecalling(self, scheduler, guppy_conf, then=None):
+        # Parameters found by "--tune" for this host and config, if any
+        self.guppy_params = Tuner.load_profile(guppy_conf, self.gpu)
 
-            # Remove dump folder
-            dump_file = basecalled_folder + 'guppy_basecaller-core-dump-db'
-            if os.path.exists(dump_file):
-                shutil.rmtree(basecalled_folder + 'guppy_basecaller-core-dump-db', ignore_errors=False, onerror=None)
+        basecalling_params = {'input': self.input, 'config': guppy_conf, 'recursive': self.recursive,
+                              'barcode_kit': self.barcode_kit, 'watch': self.watch,
+                              'sharded': bool(self.workers_per_device or self.server)}
+        # Plain fastq from Guppy are compressed when merged, the compressed ones are concatenated
+        fastq = sum(x[0] for x in self.fast5_dict.values()) * Methods.fastq_per_fast5
+        merged = fastq * Methods.compression_ratios[self.intermediate] if self.intermediate != 'gzip' else 0
+        scheduler.add(self.node('basecalling'), self.basecall, (guppy_conf,), group='basecalling',
+                      outputs=[self.basecalled_folder + 'sequencing_summary.txt'], params=basecalling_params,
+                      disk=int(fastq if self.intermediate != 'gzip' else fastq * Methods.compression_ratios['gzip']))
+        scheduler.add(self.node('demultiplexing'), self.demultiplex, deps=[self.node('basecalling')],
+                      params={'description': self.description, 'bgzf': self.bgzf,
+                              'intermediate': self.intermediate}, then=then, disk=int(merged))
 
-            # Create "done" file for resuming purposes
-            Methods.flag_done(done_basecalling)
-        else:
-            print('Skipping basecalling. Already done.')
+    def stage(self, folder, size):
+        """
+        Folder for intermediate files of that size (bytes): its mirror in the scratch folder while the scratch size
+        limit allows, else the folder itself.
+        """
+        if not self.scratch_folder or size > self.scratch_budget['bytes']:
+            return folder
+        self.scratch_budget['bytes'] -= size
+        staged_folder = self.scratch_folder + os.path.relpath(folder, self.output_folder) + '/'
+        Methods.make_folder(staged_folder)
+        return staged_folder
 
+    def add_samples(self, scheduler):
         # Update sample_dict after extracting, only keep "pass" files
-        self.sample_dict['basecalled'] = Methods.get_files(basecalled_folder, 'pass.fastq.gz')
+        recorded_dict = {os.path.realpath(k): v
+                         for k, v in scheduler.recorded_outputs(self.node('demultiplexing')).items()}
+        if self.cleanup:
+            # Also the samples whose basecalled reads were deleted once used, listed in the checkpoint manifest
+            self.sample_dict['basecalled'] = Methods.get_samples([x for x in recorded_dict
+                                                                  if x.endswith('pass.fastq.gz')])
+        else:
+            self.sample_dict['basecalled'] = Methods.get_files(self.basecalled_folder, 'pass.fastq.gz')
 
         # Remove "unclassified" for next step if barcodes used
         if self.barcode_kit:
             self.sample_dict['basecalled'].pop('unclassified')
 
-        ##################
-        #
-        # 2- QC
-        #
-        ##################
+        print('{}Performing read QC with {}, removing Nanopore adapters with {} and filtering lower quality reads '
+              'with {}...'.format(self.name + ': ' if self.name else '',
+                                  'PycoQC' if self.qc == 'pycoqc' else 'the native QC',
+                                  'Porechop' if self.trimmer == 'porechop' else 'the native trimmer',
+                                  'Filtlong' if self.filter == 'filtlong' else 'the native filter'))
 
-        if not os.path.exists(done_qc):
-            print('Performing read QC with PycoQC...')
-            Methods.run_pycoqc(basecalled_folder, qc_folder)
-            Methods.flag_done(done_qc)
+        # Imported here, NumPy and pandas are only needed from this stage on
+        from read_filter import ReadFilter
+        from trimmer import NativeTrimmer
+        from qc_report import QcReport
+        from summary_cache import SummaryCache
+
+        # Sequencing summary converted once, for the QC and the reports
+        scheduler.add(self.node('summary_cache'), SummaryCache.run_cache, (self.basecalled_folder,),
+                      deps=[self.node('demultiplexing')],
+                      outputs=[SummaryCache.cache_folder(self.basecalled_folder + 'sequencing_summary.txt')
+                                   + SummaryCache.meta_file],
+                      params={'columns': sorted(SummaryCache.column_dict)})
+        if self.qc == 'pycoqc':
+            scheduler.add(self.node('qc'), Methods.run_pycoqc, (self.basecalled_folder, self.qc_folder),
+                          deps=[self.node('demultiplexing')], outputs=[self.qc_folder + 'pycoQC_output.html'],
+                          params={'qc': self.qc})
         else:
-            print('Skipping QC. Already done.')
+            scheduler.add(self.node('qc'), QcReport.run_qc, (self.basecalled_folder, self.qc_folder),
+                          deps=[self.node('summary_cache')], outputs=[self.qc_folder + 'qc_report.json'],
+                          params={'qc': self.qc})
 
-        ##################
-        #
-        # 3- Trim reads
-        #
-        ##################
+        # Reads were already trimmed batch by batch in watch mode
+        batch_dict = dict()
+        if os.path.exists(self.trimmed_batch_folder):
+            barcode_dict = Methods.parse_samples(self.description) if self.description else dict()
+            batch_dict = {barcode_dict.get(x, x): self.trimmed_batch_folder + x
+                          for x in os.listdir(self.trimmed_batch_folder)}
 
-        if not os.path.exists(done_trimming):
-            print('Removing Nanopore adapters with Porechop...')
-            Methods.run_porechop_parallel(self.sample_dict['basecalled'], trimmed_folder, self.cpu, self.parallel)
-            Methods.flag_done(done_trimming)
-        else:
-            print('Skipping trimming. Already done.')
+        # Rough size of the outputs of each step on the output volume, for the disk space checks
+        intermediate_ratio = Methods.compression_ratios[self.intermediate]
+        final_ratio = Methods.compression_ratios['gzip']
 
-        # Update sample_dict after trimming
-        self.sample_dict['trimmed'] = Methods.get_files(trimmed_folder, '.fastq.gz')
+        Methods.make_folder(self.trimmed_folder)
+        Methods.make_folder(self.filtered_folder)
+        for sample, fastq in self.sample_dict['basecalled'].items():
+            trimmed_fastq = self.trimmed_folder + sample + '.fastq.gz'
+            filtered_fastq = self.filtered_folder + sample + '.fastq.gz'
+            target_bases = self.target_dict.get(sample, self.target_bases)
 
-        ##################
-        #
-        # 4- Filter reads
-        #
-        ##################
+            # Largest samples start first and get more threads, within the memory budget
+            if os.path.exists(fastq):
+                size = Methods.estimate_uncompressed_size(fastq)
+                deep = target_bases and size > 2 * target_bases * ReadFilter.preselect_margin  # About 2 bytes per base
+            else:
+                # Deleted once used: same steps as when it was there
+                size = int(recorded_dict[fastq]['size'] / intermediate_ratio)
+                deep = self.node('preselection', sample) in scheduler.manifest
+
+            # The basecalled reads are deleted by the first step of the sample with "--cleanup", then each
+            # intermediate file by the step reading it, if staged on the scratch folder or with "--cleanup"
+            cleanup = ([fastq, fastq + '.fqi'] if self.bgzf else [fastq]) if self.cleanup else []
+            trim_deps = [self.node('demultiplexing')]
+            filtered_size = int(size * Methods.stage_ratios['filtered'] * final_ratio)
+            if target_bases:
+                filtered_size = min(filtered_size, int(2 * target_bases * final_ratio))
+            if deep and sample not in batch_dict:
+                # Deep sample: only the best reads, with some margin for the trimming, go to the next steps
+                Methods.make_folder(self.preselected_folder)
+                preselected_size = int(2 * target_bases * ReadFilter.preselect_margin)
+                preselected_folder = self.stage(self.preselected_folder, preselected_size)
+                preselected_fastq = preselected_folder + sample + '.fastq'
+                scheduler.add(self.node('preselection', sample), ReadFilter.preselect_process,
+                              (sample, fastq, preselected_folder,
+                               int(target_bases * ReadFilter.preselect_margin), Scheduler.THREADS,
+                               self.preselected_folder),
+                              deps=[self.node('demultiplexing')], group='sample', executor=self.executor,
+                              outputs=[preselected_fastq, self.preselected_folder + sample + '.json'],
+                              cleanup=cleanup, work=size,
+                              disk=preselected_size if preselected_folder == self.preselected_folder else 0,
+                              params={'input': fastq, 'target_bases': target_bases,
+                                      'margin': ReadFilter.preselect_margin})
+                fastq = preselected_fastq
+                trim_deps = [self.node('preselection', sample)]
+                size = preselected_size
+                cleanup = [fastq] if self.cleanup or preselected_folder != self.preselected_folder else []
+            trim_mem = Methods.estimate_memory(self.trimmer, size)
+            filter_mem = Methods.estimate_memory(self.filter, size)
+            trimmed_size = int(size * Methods.stage_ratios['trimmed'] * intermediate_ratio)
+            if self.fused and sample not in batch_dict:
+                # Porechop output goes straight to Filtlong
+                outputs = [filtered_fastq, trimmed_fastq] if self.keep_trimmed else [filtered_fastq]
+                tmp_folder = self.stage(self.filtered_folder, size)
+                disk = filtered_size + (trimmed_size if self.keep_trimmed else 0) + \
+                    (size if tmp_folder == self.filtered_folder else 0)
+                scheduler.add(self.node('trimming_filtering', sample), Methods.run_porechop_filtlong,
+                              (sample, fastq, self.trimmed_folder, self.filtered_folder,
+                               Scheduler.THREADS, 1000, 95, self.keep_trimmed, self.filter,
+                               self.trimmer, self.adapter_dict, target_bases,
+                               tmp_folder if tmp_folder != self.filtered_folder else None),
+                              deps=trim_deps, group='sample', outputs=outputs, executor=self.executor,
+                              cleanup=cleanup, work=size, mem=max(trim_mem, filter_mem), disk=disk,
+                              params={'input': fastq, 'check_reads': 1000, 'keep_percent': 95,
+                                      'keep_trimmed': self.keep_trimmed, 'filter': self.filter,
+                                      'trimmer': self.trimmer, 'bgzf': self.bgzf, 'target_bases': target_bases,
+                                      'intermediate': self.intermediate if self.keep_trimmed else None})
+                continue
+            # Trimmed reads are only read by the filtering: staged and deleted after, unless they are kept
+            trimmed_folder = self.trimmed_folder
+            if not self.keep_trimmed and sample not in batch_dict:
+                trimmed_folder = self.stage(self.trimmed_folder, trimmed_size)
+            trimmed_fastq = trimmed_folder + sample + '.fastq.gz'
+            trimmed_disk = trimmed_size if trimmed_folder == self.trimmed_folder else 0
+            filter_deps = [self.node('trimming', sample)]
+            if sample in batch_dict and deep:
+                # Deep sample trimmed in watch mode: the merged batches are pre-selected like the basecalled reads
+                # otherwise are, so the same reads go to the filtering
+                Methods.make_folder(self.preselected_folder)
+                merged_folder = self.stage(self.preselected_folder, trimmed_size)
+                merged_fastq = merged_folder + sample + '.fastq.gz'
+                scheduler.add(self.node('trimming', sample), Methods.merge_trimmed_batches,
+                              (batch_dict[sample] + '/', merged_fastq), deps=[self.node('demultiplexing')],
+                              group='sample', outputs=[merged_fastq], cleanup=cleanup, work=size,
+                              disk=trimmed_size if merged_folder == self.preselected_folder else 0,
+                              params={'input': batch_dict[sample], 'bgzf': self.bgzf})
+                trimmed_disk = int(2 * target_bases * ReadFilter.preselect_margin * intermediate_ratio)
+                scheduler.add(self.node('preselection', sample), ReadFilter.preselect_process,
+                              (sample, merged_fastq, trimmed_folder,
+                               int(target_bases * ReadFilter.preselect_margin), Scheduler.THREADS,
+                               self.preselected_folder, True),
+                              deps=[self.node('trimming', sample)], group='sample', executor=self.executor,
+                              outputs=[trimmed_fastq, self.preselected_folder + sample + '.json'],
+                              cleanup=[merged_fastq, merged_fastq + '.fqi'] if self.bgzf else [merged_fastq],
+                              work=size, disk=trimmed_disk,
+                              params={'input': merged_fastq, 'target_bases': target_bases,
+                                      'margin': ReadFilter.preselect_margin, 'bgzf': self.bgzf,
+                                      'intermediate': self.intermediate})
+                filter_deps = [self.node('preselection', sample)]
+            elif sample in batch_dict:
+                scheduler.add(self.node('trimming', sample), Methods.merge_trimmed_batches,
+                              (batch_dict[sample] + '/', trimmed_fastq), deps=[self.node('demultiplexing')],
+                              group='sample', outputs=[trimmed_fastq], cleanup=cleanup, work=size,
+                              disk=trimmed_disk, params={'input': batch_dict[sample], 'bgzf': self.bgzf})
+            elif self.trimmer == 'native':
+                scheduler.add(self.node('trimming', sample), NativeTrimmer.run_trimming,
+                              (sample, fastq, trimmed_folder, Scheduler.THREADS, 1000,
+                               self.adapter_dict),
+                              deps=trim_deps, group='sample', outputs=[trimmed_fastq], cleanup=cleanup,
+                              executor=self.executor, work=size, mem=trim_mem, disk=trimmed_disk,
+                              params={'input': fastq, 'check_reads': 1000, 'trimmer': self.trimmer,
+                                      'bgzf': self.bgzf, 'intermediate': self.intermediate})
+            else:
+                scheduler.add(self.node('trimming', sample), Methods.run_porechop,
+                              (sample, fastq, trimmed_folder, Scheduler.THREADS, 1000),
+                              deps=trim_deps, group='sample', outputs=[trimmed_fastq], cleanup=cleanup,
+                              executor=self.executor, work=size, mem=trim_mem, disk=trimmed_disk,
+                              params={'input': fastq, 'check_reads': 1000, 'trimmer': self.trimmer,
+                                      'bgzf': self.bgzf, 'intermediate': self.intermediate})
+            cleanup = list()
+            if not self.keep_trimmed and (self.cleanup or trimmed_folder != self.trimmed_folder):
+                cleanup = [trimmed_fastq, trimmed_fastq + '.fqi'] if self.bgzf else [trimmed_fastq]
+            filter_func = ReadFilter.run_filter_process if self.filter == 'native' else Methods.run_filtlong
+            scheduler.add(self.node('filtering', sample), filter_func,
+                          (sample, trimmed_fastq, self.filtered_folder, 95, Scheduler.THREADS, target_bases),
+                          deps=filter_deps, group='sample', outputs=[filtered_fastq],
+                          cleanup=cleanup, executor=self.executor, work=size, mem=filter_mem, disk=filtered_size,
+                          params={'input': trimmed_fastq, 'keep_percent': 95, 'filter': self.filter,
+                                  'bgzf': self.bgzf, 'target_bases': target_bases})
+
+    def finish(self):
+        # Work skipped on the deep samples
+        self.report_preselection()
+
+        # CPU spent on compression and space used by the outputs
+        self.report_compression()
+
+        # Logs of the steps run on the scratch folder, which is not needed anymore
+        if self.scratch_folder and os.path.exists(self.scratch_folder):
+            for log_file in glob(self.scratch_folder + '**/logs/*.log', recursive=True):
+                dest_file = self.output_folder + '/' + os.path.relpath(log_file, self.scratch_folder)
+                Methods.make_folder(os.path.dirname(dest_file))
+                shutil.copy(log_file, dest_file)
+            shutil.rmtree(self.scratch_folder, ignore_errors=True)
 
-        # Get reference size
-        if not os.path.exists(done_filtering):
-            print('Filtering lower quality reads with Filtlong...')
-            Methods.run_filtlong_parallel(self.sample_dict['trimmed'], filtered_folder, self.parallel)
-            Methods.flag_done(done_filtering)
+        # Trimmed batches were all merged
+        shutil.rmtree(self.trimmed_batch_folder, ignore_errors=True)
+
+        # Update sample_dict after trimming and filtering. Trimmed reads staged on the scratch folder or cleaned up
+        # are deleted.
+        if not (self.fused or self.scratch or self.cleanup) or self.keep_trimmed:
+            self.sample_dict['trimmed'] = Methods.get_files(self.trimmed_folder, '.fastq.gz')
+        self.sample_dict['filtered'] = Methods.get_files(self.filtered_folder, '.fastq.gz')
+
+    def report_preselection(self):
+        # Bases that did not have to be trimmed and filtered thanks to the target number of bases
+        stats_list = list()
+        for sample in sorted(self.sample_dict['basecalled']):
+            stats_file = self.preselected_folder + sample + '.json'
+            if os.path.exists(stats_file):
+                with open(stats_file, 'r') as f:
+                    stats = json.load(f)
+                stats['target_bases'] = self.target_dict.get(sample, self.target_bases)
+                stats_list.append(stats)
+        if not stats_list:
+            return
+
+        print('Target number of bases{}:'.format(' of ' + self.name if self.name else ''))
+        with open(self.output_folder + '/preselection_report.tsv', 'w') as f:
+            f.write('sample\ttarget_bases\tinput_reads\tinput_bases\tpreselected_reads\tpreselected_bases\t'
+                    'skipped_percent\n')
+            for stats in stats_list:
+                skipped = 100 * (1 - stats['preselected_bases'] / max(stats['input_bases'], 1))
+                f.write('{}\t{}\t{}\t{}\t{}\t{}\t{:.1f}\n'.format(
+                    stats['sample'], stats['target_bases'], stats['input_reads'], stats['input_bases'],
+                    stats['preselected_reads'], stats['preselected_bases'], skipped))
+                print('\t{}: {:.1f} of {:.1f} Mbp trimmed and filtered, {:.1f}% skipped'.format(
+                    stats['sample'], stats['preselected_bases'] / 1000000, stats['input_bases'] / 1000000, skipped))
+        input_bases = sum(x['input_bases'] for x in stats_list)
+        preselected_bases = sum(x['preselected_bases'] for x in stats_list)
+        print('\tTotal: {:.1f} of {:.1f} Mbp trimmed and filtered, {:.1f}% skipped'.format(
+            preselected_bases / 1000000, input_bases / 1000000, 100 * (1 - preselected_bases / max(input_bases, 1))))
+
+    def report_compression(self):
+        # Fastq compressed by the pipeline in this run (Guppy and Porechop compress their own outputs), per stage
+        stage_dict = dict()
+        for record in list(Metrics.records['compression']):
+            stage, _, label = (record['stage'] or '').partition(':')
+            if self.name and label != self.name and not label.startswith(self.name + '/'):
+                continue  # Other run of the batch
+            total = stage_dict.setdefault(stage, {'levels': set(), 'input_bytes': 0, 'output_bytes': 0,
+                                                  'cpu_seconds': 0})
+            total['levels'].add(record['level'])
+            for key in ['input_bytes', 'output_bytes', 'cpu_seconds']:
+                total[key] += record[key]
+
+        print('Compression and disk use{}:'.format(' of ' + self.name if self.name else ''))
+        for stage, total in stage_dict.items():
+            print('\t{}: level {}, {:.1f} MB compressed to {:.1f} MB in {:.1f} CPU seconds'.format(
+                stage if stage else 'other', '/'.join(str(x) for x in sorted(total['levels'])),
+                total['input_bytes'] / 1000000, total['output_bytes'] / 1000000, total['cpu_seconds']))
+        for folder in [self.basecalled_folder, self.trimmed_folder, self.filtered_folder]:
+            size = Methods.folder_size(folder)
+            name = os.path.relpath(folder, os.path.dirname(self.output_folder) if self.name else self.output_folder)
+            Metrics.add('disk', {'name': name, 'bytes': size})
+            print('\t{}: {:.1f} MB'.format(name, size / 1000000))
+
+    def basecall(self, guppy_conf):
+        if self.server:
+            # Find or start the basecall server once, all the Guppy processes of this run are its clients
+            self.port = BasecallServer.get_server(guppy_conf, self.gpu, self.port, self.guppy_params)
+
+        if self.watch:
+            # Basecall and trim batches of fast5 as they are written by the sequencer
+            self.watch_run(guppy_conf, self.basecalled_folder, self.trimmed_batch_folder)
         else:
-            print('Skipping filtering. Already done.')
+            # Output of an interrupted Guppy run present
+            resume = os.path.exists(self.basecalled_folder + 'sequencing_summary.txt')
+            self.run_basecaller(guppy_conf, self.basecalled_folder, sorted(self.fast5_dict), resume)
 
-        # Update sample_dict after trimming
-        self.sample_dict['filtered'] = Methods.get_files(filtered_folder, '.fastq.gz')
+    def run_basecaller(self, guppy_conf, basecalled_folder, file_list, resume=False):
+        # Guppy gets the files to basecall from the manifest instead of scanning the input folder again
+        if self.server:
+            # Pool of client processes sharing the basecall server, each basecalling shards of the input
+            Methods.run_guppy_sharded(self.input, basecalled_folder, guppy_conf, self.recursive,
+                                      ['server'], self.clients, self.barcode_kit, file_list=file_list,
+                                      port=self.port, guppy_params=self.guppy_params, fast5_dict=self.fast5_dict)
+        elif self.workers_per_device:
+            # One Guppy process per device and worker, each basecalling shards of the input
+            Methods.run_guppy_sharded(self.input, basecalled_folder, guppy_conf, self.recursive,
+                                      self.device_list, self.workers_per_device, self.barcode_kit,
+                                      file_list=file_list, guppy_params=self.guppy_params,
+                                      fast5_dict=self.fast5_dict)
+        else:
+            if resume:
+                print('\tResuming interrupted basecalling.')
 
-        ##################
-        #
-        # Done
-        #
-        ##################
+            # Basecall fast5 to
+            Methods.run_guppy(self.input, basecalled_folder, guppy_conf, self.recursive,
+                              self.gpu, self.barcode_kit, file_list=file_list, resume=resume,
+                              guppy_params=self.guppy_params)
 
-        # Remove 'guppy_basecaller-core-dump-db' ?
+    def demultiplex(self):
+        # Merge all fastq per barcode, if more than one file present
+        Methods.merge_rename_fastq(self.basecalled_folder, self.barcode_kit, self.cpu, self.parallel)
+
+        if self.description:
+            sample_dict = Methods.parse_samples(self.description)
+            Methods.rename_barcode(sample_dict, self.basecalled_folder)  # Also remove extra barcode folders
+
+        # Remove dump folder
+        dump_file = self.basecalled_folder + 'guppy_basecaller-core-dump-db'
+        if os.path.exists(dump_file):
+            shutil.rmtree(dump_file, ignore_errors=False, onerror=None)
+
+        # Per-sample basecalled files, so truncated or deleted ones are detected on restart
+        return sorted(Methods.list_files_in_folder(self.basecalled_folder + '*/*', '.fastq.gz') +
+                      Methods.list_files_in_folder(self.basecalled_folder + '*', '.fastq.gz'))
+
+    def watch_run(self, guppy_conf, basecalled_folder, trimmed_batch_folder):
+        print('Watching {} for new fast5 files...'.format(self.input))
+
+        # Barcodes to trim. Same as the ones kept for the trimming step in batch mode.
+        barcode_dict = Methods.parse_samples(self.description) if self.description else dict()
+
+        # Files already basecalled by a previous (interrupted) watch, and batches already trimmed
+        processed_file = basecalled_folder + 'watch_processed.txt'
+        trimmed_file = basecalled_folder + 'watch_trimmed.txt'
+        processed_set = set()
+        batch_list = list()
+        trimmed_set = set()
+        if os.path.exists(processed_file):
+            with open(processed_file, 'r') as f:
+                for line in f:
+                    if not line.rstrip():
+                        continue
+                    tag, file_path = line.rstrip().split('\t')
+                    if tag not in batch_list:
+                        batch_list.append(tag)
+                    processed_set.add(file_path)
+            if os.path.exists(trimmed_file):
+                with open(trimmed_file, 'r') as f:
+                    trimmed_set = set(x.strip() for x in f if x.strip())
+        batch_number = len(batch_list)
+        if os.path.exists(processed_file) or os.path.exists(basecalled_folder + 'batches/'):
+            # Batch merged but not recorded when interrupted: basecalled again, its reads must not be there twice
+            Methods.remove_unrecorded_batch(basecalled_folder, 'batch{:05d}'.format(batch_number + 1), processed_set)
+
+        previous_dict = dict()
+        last_activity = time.time()
+        trim_list = list()
+
+        def trim_batch(tag, moved_dict):
+            # Only trim what would be trimmed in batch mode
+            if self.barcode_kit:
+                moved_dict.pop('unclassified', None)
+            if barcode_dict:
+                moved_dict = {k: v for k, v in moved_dict.items() if k in barcode_dict}
+            Methods.run_porechop_batch(moved_dict, trimmed_batch_folder, tag, self.cpu, self.parallel, self.trimmer,
+                                       self.adapter_dict)
+            # Record progress for resuming purposes, once the trimmed files are complete
+            with open(trimmed_file, 'a') as f:
+                f.write(tag + '\n')
+
+        # Trimming of a batch runs in the background while the next batch is being basecalled
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                # Batches basecalled but not completely trimmed by a previous watch
+                for tag in batch_list:
+                    if tag not in trimmed_set:
+                        print('\tTrimming {} again'.format(tag))
+                        trim_list.append(executor.submit(trim_batch, tag,
+                                                         Methods.batch_pass_files(basecalled_folder, tag)))
+
+                while True:
+                    current_dict = Methods.list_fast5(self.input, self.recursive, self.fast5_manifest)
+                    self.fast5_dict = current_dict
+                    completed_list = Methods.get_completed_fast5(current_dict, previous_dict, processed_set)
+                    run_finished = Methods.is_run_finished(self.input)
+                    previous_dict = current_dict
+
+                    if not completed_list:
+                        pending = [x for x in current_dict if x not in processed_set]
+                        if run_finished and not pending:
+                            print('\tSequencing run is over.')
+                            break
+                        if time.time() - last_activity > self.watch_timeout * 60:
+                            print('\tNo new fast5 for {} minutes. Stopping watch.'.format(self.watch_timeout))
+                            break
+                        time.sleep(self.watch_interval)
+                        continue
+
+                    last_activity = time.time()
+                    step = self.watch_batch if self.watch_batch > 0 else len(completed_list)
+                    for i in range(0, len(completed_list), step):
+                        fast5_list = completed_list[i:i + step]
+                        batch_number += 1
+                        tag = 'batch{:05d}'.format(batch_number)
+                        batch_folder = basecalled_folder + 'batches/' + tag + '/'
+                        shutil.rmtree(batch_folder, ignore_errors=True)  # Leftover of an interrupted watch
+                        print('\tBasecalling {} ({} fast5)'.format(tag, len(fast5_list)))
+
+                        self.run_basecaller(guppy_conf, batch_folder, fast5_list)
+                        moved_dict = Methods.merge_basecalled_batch(batch_folder, basecalled_folder, tag)
+
+                        # Record progress for resuming purposes
+                        with open(processed_file, 'a') as f:
+                            for file_path in fast5_list:
+                                f.write('{}\t{}\n'.format(tag, file_path))
+                        processed_set.update(fast5_list)
+
+                        trim_list.append(executor.submit(trim_batch, tag, moved_dict))
+
+                # Wait for the last batches to be trimmed
+                for job in trim_list:
+                    job.result()
+            except BaseException:
+                # Do not wait for the background trimming to finish
+                ProcessEngine.cancel_all()
+                raise
+
+        shutil.rmtree(basecalled_folder + 'batches/', ignore_errors=True)
+
+
+class BatchBasecaller(object):
+    """
+    Several sequencing runs in one process, listed in a tab-separated sheet. The runs are basecalled back to back on
+    the GPU (grouped by Guppy config, so a basecall server or model is reused), and the QC, trimming and filtering of
+    all the runs share one scheduler: a run moves on to its CPU steps while the next one is basecalled, and the
+    samples of all the runs share the threads, memory and parallel slots. Each run has its own output folder, and a
+    summary of all the runs is written to "batch_summary.tsv".
+    """
+
+    # First line of the sheet. Only "name" and "input" are mandatory, empty values are the command line ones.
+    columns = ['name', 'input', 'config', 'flowcell', 'library_kit', 'barcode_kit', 'description', 'sequencer',
+               'target_bases']
+
+    def __init__(self, args):
+        self.output_folder = os.path.abspath(args.output)
+        self.prometheus = args.prometheus
+        self.run_list = list()
+
+        try:
+            self.run(args)
+        finally:
+            if os.path.isdir(self.output_folder):
+                Metrics.write_report(self.output_folder + '/run_metrics.json')
+                if self.prometheus:
+                    Metrics.write_prometheus(self.prometheus)
+
+    @staticmethod
+    def parse_sheet(sheet_file):
+        with open(sheet_file, 'r') as f:
+            line_list = [x.rstrip('\n').split('\t') for x in f if x.strip() and not x.startswith('#')]
+        if not line_list:
+            raise Exception('The batch sheet "{}" is empty.'.format(sheet_file))
+        header = [x.strip().lower() for x in line_list[0]]
+        unknown = [x for x in header if x not in BatchBasecaller.columns]
+        if unknown or 'name' not in header or 'input' not in header:
+            raise Exception('The first line of the batch sheet must list its columns, among {}, with at least "name" '
+                            'and "input". Unknown: {}'.format(', '.join(BatchBasecaller.columns), ', '.join(unknown)))
+
+        row_list = list()
+        for fields in line_list[1:]:
+            row = {k: v.strip() for k, v in zip(header, fields) if v.strip()}
+            if not row.get('name') or not row.get('input'):
+                raise Exception('Run with no name or input in the batch sheet: {}'.format('\t'.join(fields)))
+            if any(x in row['name'] for x in '/: ') or row['name'] in [x['name'] for x in row_list]:
+                raise Exception('Run names of the batch sheet must be unique, without "/", ":" or spaces: '
+                                '"{}"'.format(row['name']))
+            row_list.append(row)
+        return row_list
+
+    @staticmethod
+    def run_args(args, row, output_folder):
+        # Command line arguments, with the values of the sheet for this run
+        run_args = copy.copy(args)
+        run_args.input = row['input']
+        run_args.output = os.path.join(output_folder, row['name'])
+        for column in BatchBasecaller.columns[2:]:
+            if column in row:
+                setattr(run_args, column, [row[column]] if column == 'barcode_kit' else row[column])
+        return run_args
+
+    def run(self, args):
+        print('Checking a few things...')
+        Methods.make_folder(self.output_folder)
+        for row in BatchBasecaller.parse_sheet(args.batch):
+            self.run_list.append(Basecaller(BatchBasecaller.run_args(args, row, self.output_folder), row['name']))
+
+        # Same threads, memory, executor and scratch size limit for all the runs
+        first = self.run_list[0]
+        first.check_resources(self.output_folder + '/cluster_jobs/')
+        for run in self.run_list:
+            run.cpu, run.parallel, run.mem, run.executor = first.cpu, first.parallel, first.mem, first.executor
+            run.scratch_budget = first.scratch_budget
+            run.check()
+            run.prepare_outputs()
+        if first.disk_reserve is not None:
+            # All the runs are written to the same volume
+            first.check_disk_space(sum(run.estimate_footprint() for run in self.run_list))
+        print('\tAll good! {} runs.'.format(len(self.run_list)))
+
+        # One Guppy at a time, the CPU steps of the runs already basecalled run alongside
+        scheduler = Scheduler(self.output_folder + '/checkpoints.json',
+                              limits={'basecalling': 1, 'sample': first.parallel}, cpu=first.cpu, mem=first.mem,
+                              disk_reserve=first.disk_reserve)
+        conf_dict = {run.name: run.get_guppy_conf() for run in self.run_list}
+        conf_order = list(dict.fromkeys(conf_dict.values()))
+        for run in sorted(self.run_list, key=lambda x: conf_order.index(conf_dict[x.name])):
+            # The samples of a run are only known once it is demultiplexed
+            run.add_basecalling(scheduler, conf_dict[run.name], then=lambda x=run: x.add_samples(scheduler))
+        scheduler.run()
+
+        for run in self.run_list:
+            run.finish()
+        self.write_summary(first.cpu)
         print('DONE!')
 
+    def write_summary(self, cpu):
+        # Reads and bases of each sample, basecalled (from the sequencing summary cache) and after filtering
+        from summary_cache import SummaryCache
+        print('Batch summary:')
+        with futures.ThreadPoolExecutor(max_workers=cpu) as executor:
+            stats_dict = {(run.name, sample): executor.submit(Methods.fastq_stats, fastq)
+                          for run in self.run_list for sample, fastq in sorted(run.sample_dict['filtered'].items())}
+        with open(self.output_folder + '/batch_summary.tsv', 'w') as f:
+            f.write('run\tsample\tbasecalled_reads\tbasecalled_bases\tfiltered_reads\tfiltered_bases\n')
+            for run in self.run_list:
+                barcode_stats = dict()
+                if os.path.exists(run.basecalled_folder + 'sequencing_summary.txt'):
+                    barcode_stats = SummaryCache.open(run.basecalled_folder + 'sequencing_summary.txt').barcode_stats()
+                    if run.description:
+                        barcode_stats = {Methods.parse_samples(run.description).get(k, k): v
+                                         for k, v in barcode_stats.items()}
+                total_reads = total_bases = 0
+                for sample in sorted(run.sample_dict['filtered']):
+                    reads, bases = stats_dict[(run.name, sample)].result()
+                    basecalled = barcode_stats.get(sample, ['', ''])
+                    f.write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(run.name, sample, basecalled[0], basecalled[1],
+                                                            reads, bases))
+                    total_reads += reads
+                    total_bases += bases
+                print('\t{}: {} samples, {:,} reads and {:.1f} Mbp after filtering'.format(
+                    run.name, len(run.sample_dict['filtered']), total_reads, total_bases / 1000000))
+
 
 if __name__ == "__main__":
     max_cpu = cpu_count()
@@ -200,11 +844,18 @@ if __name__ == "__main__":
 
     parser = ArgumentParser(description='Basecall Nanopore raw data to fastq.')
     parser.add_argument('-i', '--input', metavar='/path/to/input_folder/',
-                        required=True, type=str,
-                        help='Folder that contains the fast5 files. Mandatory.')
+                        required=False, type=str,
+                        help='Folder that contains the fast5 files. Mandatory, unless "--batch" is used.')
     parser.add_argument('-o', '--output', metavar='/path/to/output_folder/',
                         required=True, type=str,
                         help='Folder to hold the result files. Mandatory.')
+    parser.add_argument('--batch', metavar='/path/to/batch_sheet.tsv',
+                        required=False, type=str,
+                        help='Process several runs instead of "--input": tab-separated file with a header line and '
+                             'one run per line. Columns are "name", "input" and optionally "config", "flowcell", '
+                             '"library_kit", "barcode_kit", "description", "sequencer" and "target_bases" (empty '
+                             'for the command line value). Each run is written to a "name" folder in the output '
+                             'folder. Sample file in data folder. Optional.')
     parser.add_argument('-s', '--sequencer',
                         required=False, type=str,
                         choices=['minion', 'promethion'],
@@ -243,6 +894,37 @@ if __name__ == "__main__":
                         help='GPU device tp use. Typically "cuda:0" is one compatible graphics card is installed. '
                              'Use "cuda:0 cuda:1" (including the quotes) to use two graphics cards. '
                              'Default is "cuda:0". Mandatory.')
+    parser.add_argument('--workers-per-device', metavar='1',
+                        required=False, type=int, default=0,
+                        help='Split the fast5 files in size-balanced shards and run that many Guppy processes per '
+                             'device listed in "--gpu", each one taking the next shard when done. '
+                             'Default is 0 (a single Guppy process using all the devices). Optional.')
+    parser.add_argument('--server',
+                        required=False, action='store_true',
+                        help='Basecall with "guppy_basecaller" clients of a "guppy_basecall_server". A server '
+                             'started by a previous run with the same config and GPU is reused, otherwise one is '
+                             'started and left running for the next runs. Optional.')
+    parser.add_argument('--stop-server',
+                        required=False, action='store_true',
+                        help='With "--server", stop the basecall server at the end of the run instead of leaving it '
+                             'running for the next runs. Optional.')
+    parser.add_argument('--port', metavar='5555',
+                        required=False, type=str,
+                        help='With "--server", port of the server to start, or "host:port" of an already running '
+                             'server to use. Default is a free port. Optional.')
+    parser.add_argument('--clients', metavar='4',
+                        required=False, type=int, default=4,
+                        help='With "--server", number of client processes basecalling at the same time. '
+                             'Default is 4. Optional.')
+    parser.add_argument('--tune',
+                        required=False, action='store_true',
+                        help='Basecall a few fast5 files with different Guppy "--chunk_size", "--chunks_per_runner" '
+                             'and "--gpu_runners_per_device" values and save the fastest for this computer and '
+                             'config. Next runs use them automatically. Nothing else is done. Optional.')
+    parser.add_argument('--tune-files', metavar='4',
+                        required=False, type=int, default=4,
+                        help='Number of fast5 files basecalled for each combination with "--tune". '
+                             'Default is 4. Optional.')
     parser.add_argument('-p', '--parallel', metavar='2',
                         required=False, type=int, default=2,
                         help='Number of samples to process in parallel for trimming and filtering. '
@@ -250,10 +932,146 @@ if __name__ == "__main__":
     parser.add_argument('-m', '--memory', metavar=str(max_mem),
                         required=False, type=int, default=max_mem,
                         help='Memory in GB. Default is 85%% of total memory ({}). Optional.'.format(max_mem))
+    parser.add_argument('--qc',
+                        required=False, type=str, default='native',
+                        choices=['native', 'pycoqc'],
+                        help='Read QC engine. "native" reads the sequencing summary by chunks and writes a compact '
+                             'html and json report. "pycoqc" loads it all in memory. Default is "native". Optional.')
+    parser.add_argument('--trimmer',
+                        required=False, type=str, default='porechop',
+                        choices=['porechop', 'native'],
+                        help='Adapter trimming engine. "native" uses the built-in multi-process trimmer, with the '
+                             'adapters of the library kit (all known adapters if no library kit). '
+                             'Default is "porechop". Optional.')
+    parser.add_argument('--filter',
+                        required=False, type=str, default='filtlong',
+                        choices=['filtlong', 'native'],
+                        help='Read filtering engine. "native" uses the built-in multi-threaded filter, which scores '
+                             'and keeps reads like Filtlong. Default is "filtlong". Optional.')
+    parser.add_argument('--fused',
+                        action='store_true',
+                        help='Pipe the trimmed reads directly to the filtering step instead of writing them '
+                             'compressed in the "3_trimmed" folder. Saves compression and decompression time. '
+                             'Optional.')
+    parser.add_argument('--keep-trimmed',
+                        action='store_true',
+                        help='With "--fused", also write the compressed trimmed reads in the "3_trimmed" folder. '
+                             'With "--scratch", keep them in the "3_trimmed" folder instead of the scratch folder. '
+                             'Optional.')
+    parser.add_argument('--intermediate-compression',
+                        required=False, type=str, default='gzip',
+                        choices=['gzip', 'fast', 'none'],
+                        help='Compression of the intermediate fastq files (basecalled and trimmed), which are only '
+                             'read by the next step. "fast" is gzip level 1, "none" writes uncompressed gzip blocks '
+                             '(same file names, no compression CPU, about twice the disk space of "gzip"). The '
+                             'filtered reads are always gzip (or BGZF) level 6. Default is "gzip". Optional.')
+    parser.add_argument('--scratch', metavar='/path/to/scratch/',
+                        required=False, type=str,
+                        help='Fast local or tmpfs folder for the intermediate files that are deleted once used: '
+                             'pre-selected reads, trimmed reads (unless "--keep-trimmed") and the uncompressed '
+                             'reads of "--fused". Samples that do not fit in "--scratch-size" use the output '
+                             'folder. Removed at the end of the run. Optional.')
+    parser.add_argument('--scratch-size', metavar='0',
+                        required=False, type=float, default=0,
+                        help='Maximum size of the files staged on the scratch folder, in GB. 0 means 90%% of its '
+                             'free space. Default is 0. Optional.')
+    parser.add_argument('--cleanup',
+                        action='store_true',
+                        help='Delete the basecalled reads of each sample once its trimmed (or pre-selected) reads '
+                             'are written and recorded, and its trimmed reads (unless "--keep-trimmed") once its '
+                             'filtered reads are. Peak disk use then depends on the samples processed at the same '
+                             'time rather than on the size of the run. Steps whose inputs were deleted cannot be '
+                             'rerun with other parameters. Optional.')
+    parser.add_argument('--disk-reserve', metavar='5',
+                        required=False, type=float, default=5,
+                        help='Free space to keep on the volume of the output folder, in GB. The run does not start '
+                             'if its estimated size does not fit, and each step waits until its estimated output '
+                             'fits. Default is 5. Optional.')
+    parser.add_argument('--no-disk-check',
+                        action='store_true',
+                        help='Do not check the free disk space before the run and before each step. Optional.')
+    parser.add_argument('--target-bases', metavar='500M',
+                        required=False, type=str,
+                        help='Keep at most that many bases per sample after filtering (e.g. 500M for 100x of a 5 Mbp '
+                             'genome). Deep samples are pre-selected (best reads, with a 25%% margin) before '
+                             'trimming, so less reads are trimmed and filtered. A third column in the barcode '
+                             'description file sets it per sample. Optional.')
+    parser.add_argument('--bgzf',
+                        action='store_true',
+                        help='Write the basecalled, trimmed and filtered fastq files as BGZF (still readable as '
+                             'gzip) with a read index (".fqi"), for random access and fast subsampling with '
+                             '"fastq_index.py". Optional.')
+    parser.add_argument('-w', '--watch',
+                        action='store_true',
+                        help='Basecall and trim fast5 files as they are produced while the run is still sequencing. '
+                             'Watching stops when MinKNOW writes the "final_summary" file or after "--watch-timeout" '
+                             'minutes without new fast5. With "--trimmer porechop", Porechop looks for the adapters '
+                             'in each batch instead of the whole sample, so the trimming can differ a little from a '
+                             'run processed at once. The native trimmer finds them in the first batch of each sample '
+                             'and reuses them. Optional.')
+    parser.add_argument('--watch-interval', metavar='60',
+                        required=False, type=int, default=60,
+                        help='Number of seconds between two scans of the input folder in watch mode. '
+                             'Default is 60. Optional.')
+    parser.add_argument('--watch-timeout', metavar='60',
+                        required=False, type=int, default=60,
+                        help='Stop watching if no new fast5 were produced for that many minutes. '
+                             'Default is 60. Optional.')
+    parser.add_argument('--watch-batch', metavar='0',
+                        required=False, type=int, default=0,
+                        help='Maximum number of fast5 files per basecalling batch in watch mode. '
+                             '0 means all the completed fast5 found at each scan. Default is 0. Optional.')
+    parser.add_argument('--tool-timeout', metavar='0',
+                        required=False, type=int, default=0,
+                        help='Kill Porechop, Filtlong or pycoQC if still running after that many minutes. '
+                             'Guppy is never killed. 0 means no timeout. Default is 0. Optional.')
+    parser.add_argument('--tool-retries', metavar='1',
+                        required=False, type=int, default=1,
+                        help='Number of times a failed or timed out Porechop, Filtlong or pycoQC is run again before '
+                             'the pipeline stops. Default is 1. Optional.')
+    parser.add_argument('--executor',
+                        required=False, type=str, default='thread',
+                        choices=Executors.choices,
+                        help='Where the per-sample steps (pre-selection, trimming and filtering) run. "thread" runs '
+                             'them in this process, "local" in a pool of "--parallel" worker processes, "batch" as '
+                             'jobs of a batch scheduler (SLURM by default, see "--cluster-config"). '
+                             'Default is "thread". Optional.')
+    parser.add_argument('--cluster-config', metavar='/path/to/cluster.json',
+                        required=False, type=str,
+                        help='With "--executor batch", json file with the submit, status and cancel commands of the '
+                             'scheduler, the CPUs and memory per job, the job folder, staging, polling interval and '
+                             'retries. Default is SLURM with 8 CPUs per job and the jobs in "cluster_jobs" in the '
+                             'output folder. Optional.')
+    parser.add_argument('--prometheus', metavar='/path/to/basecall_nanopore.prom',
+                        required=False, type=str,
+                        help='Also write the run metrics (time, CPU, memory and I/O of each step) to this file, in '
+                             'the Prometheus textfile collector format. The json report is always written to '
+                             '"run_metrics.json" in the output folder. Optional.')
     parser.add_argument('-v', '--version', action='version',
                         version=f'{os.path.basename(__file__)}: version {__version__}')
 
     # Get the arguments into an object
     arguments = parser.parse_args()
+    if bool(arguments.input) == bool(arguments.batch):
+        parser.error('Use either "--input" or "--batch".')
+    if arguments.batch and (arguments.watch or arguments.tune):
+        parser.error('"--watch" and "--tune" are for a single run, not with "--batch".')
 
-    Basecaller(arguments)
+    # Same clean up on "kill" as on Ctrl-C: the running tools are killed, nothing is left behind
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        if arguments.batch:
+            BatchBasecaller(arguments)
+        else:
+            Basecaller(arguments)
+    except KeyboardInterrupt:
+        ProcessEngine.cancel_all()
+        print('Interrupted. Rerun the same command to resume.')
+        sys.exit(130)
+    finally:
+        if arguments.stop_server and BasecallServer.used_keys:
+            # Only the servers of this run, the ones used by other runs are left running
+            BasecallServer.stop_all(BasecallServer.used_keys)
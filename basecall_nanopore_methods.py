@@ -6,38 +6,89 @@ import pathlib
 from psutil import virtual_memory
 from multiprocessing import cpu_count
 import gzip
+import zlib
+import time
+from collections import deque
+from queue import Queue, Empty
 from glob import glob
 import shutil
-import pandas as pd
-from kits import Kits
+from catalog import Catalog
+from fast5_manifest import Fast5Manifest
+from process_engine import ProcessEngine
+from metrics import Metrics
 
 
 # mamba create -n nanopore -y -c bioconda \
 # flye samtools parallel bbmap shasta porechop filtlong bandage minimap2 blast psutil pandas pycoqc pysam
 
 
+class ConcatReader(object):
+    # Several fastq files, gzipped or not, read as a single stream
+    def __init__(self, file_list):
+        self.file_list = list(file_list)
+        self.f = None
+
+    def read(self, size=-1):
+        while True:
+            if self.f is None:
+                if not self.file_list:
+                    return b''
+                fastq = self.file_list.pop(0)
+                self.f = gzip.open(fastq, 'rb') if fastq.endswith('.gz') else open(fastq, 'rb')
+            data = self.f.read(size)
+            if data:
+                return data
+            self.f.close()
+            self.f = None
+
+
 class Methods(object):
+    # Guppy performance parameters used when this host and config were not tuned (see tuning.py)
+    guppy_params = {'chunk_size': 1000,
+                    'chunks_per_runner': 128,
+                    'gpu_runners_per_device': 2}
+
+    # Compressed fastq outputs are BGZF with a read index instead of plain gzip (see fastq_index.py)
+    bgzf = False
+
+    # Compression of the intermediate fastq files (basecalled and trimmed), read once or twice by the next step.
+    # The filtered reads are always compressed at the final level. "none" still writes gzip files (stored blocks),
+    # so the file names and the tools reading them do not change.
+    intermediate = 'gzip'
+    compression_levels = {'gzip': 6, 'fast': 1, 'none': 0}
+    compression_ratios = {'gzip': 0.45, 'fast': 0.5, 'none': 1.0}  # Rough compressed size of fastq, for estimates
+
+    # Rough size of the reads at each stage, for the disk space estimates: uncompressed fastq bytes per fast5 byte,
+    # then share of the bases left after trimming and after filtering
+    fastq_per_fast5 = 0.2
+    stage_ratios = {'trimmed': 0.95, 'filtered': 0.9}
+
+    @staticmethod
+    def intermediate_level():
+        return Methods.compression_levels[Methods.intermediate]
+
     @staticmethod
     def check_cpus(requested_cpu, n_proc):
         total_cpu = cpu_count()
 
-        if 1 > requested_cpu > total_cpu:
+        if requested_cpu < 1 or requested_cpu > total_cpu:
             requested_cpu = total_cpu
-            sys.stderr.write("Number of threads was set to {}".format(requested_cpu))
-        if 1 > n_proc > total_cpu:
-            n_proc = total_cpu
-            sys.stderr.write("Number of samples to parallel process was set to {}".format(total_cpu))
+            sys.stderr.write("Number of threads was set to {}\n".format(requested_cpu))
+        if n_proc < 1 or n_proc > requested_cpu:
+            n_proc = min(max(n_proc, 1), requested_cpu)
+            sys.stderr.write("Number of samples to parallel process was set to {}\n".format(n_proc))
 
         return requested_cpu, n_proc
 
     @staticmethod
     def check_mem(requested_mem):
         max_mem = int(virtual_memory().total * 0.85 / 1000000000)  # in GB
-        if requested_mem:
+        if requested_mem and requested_mem > 0:
             if requested_mem > max_mem:
                 requested_mem = max_mem
-                sys.stderr.write("Requested memory was set higher than available system memory ({})".format(max_mem))
-                sys.stderr.write("Memory was set to {}".format(requested_mem))
+                sys.stderr.write("Requested memory was set higher than available system memory ({})\n"
+                                 .format(max_mem))
+                sys.stderr.write("Memory was set to {}\n".format(requested_mem))
         else:
             requested_mem = max_mem
 
@@ -53,13 +104,59 @@ class Methods(object):
             raise Exception('Please select a folder as input.')
 
     @staticmethod
-    def check_fast5(input_folder):
+    def check_scratch(scratch_folder, requested_size):
+        # Size limit of the intermediate files staged on the scratch folder, in bytes. Default is 90% of free space.
+        Methods.make_folder(scratch_folder)
+        if not os.access(scratch_folder, os.W_OK):
+            raise Exception('Scratch folder "{}" is not writable.'.format(scratch_folder))
+        free = shutil.disk_usage(scratch_folder).free
+        if requested_size and requested_size > 0:
+            if requested_size * 1000000000 > free:
+                sys.stderr.write('Requested scratch size is larger than the free space of "{}" ({:.1f} GB)\n'
+                                 .format(scratch_folder, free / 1000000000))
+            return int(requested_size * 1000000000)
+        return int(free * 0.9)
+
+    @staticmethod
+    def check_disk_space(folder, needed, reserve):
+        # Refuse to start a run that would fill the volume of its output folder
+        free = shutil.disk_usage(folder).free
+        if needed + reserve > free:
+            raise Exception('Not enough disk space in "{}": about {:.1f} GB still to write, {:.1f} GB free and '
+                            '{:.1f} GB to keep free. See "--cleanup", "--intermediate-compression", "--scratch" and '
+                            '"--disk-reserve".'.format(folder, needed / 1000000000, free / 1000000000,
+                                                      reserve / 1000000000))
+        return free
+
+    @staticmethod
+    def check_fast5(fast5_dict):
         # Check if input folder contains fast5
-        for root, directories, filenames in os.walk(input_folder):
-            for filename in filenames:
-                if filename.endswith('.fast5'):  # accept a tuple or string
-                    return  # At least one fast5 file is present
-        raise Exception('No fast5 files detected in provided input folder.')
+        if not fast5_dict:
+            raise Exception('No fast5 files detected in provided input folder.')
+
+    @staticmethod
+    def list_fast5(input_folder, recursive, manifest_file=None):
+        # Return {path: (size, mtime)} for all the fast5 files currently in the input folder
+        return Fast5Manifest.scan(input_folder, recursive, manifest_file)
+
+    @staticmethod
+    def get_completed_fast5(current_dict, previous_dict, processed_set):
+        # A fast5 is considered complete once its size and modification time did not change between two polls
+        completed_list = list()
+        for file_path, stat in current_dict.items():
+            if file_path in processed_set:
+                continue
+            if previous_dict.get(file_path) == stat and stat[0] > 0:
+                completed_list.append(file_path)
+        return sorted(completed_list)
+
+    @staticmethod
+    def is_run_finished(input_folder):
+        # MinKNOW writes a "final_summary_*.txt" file in the run folder once sequencing is over
+        for folder in [input_folder, os.path.dirname(input_folder.rstrip('/'))]:
+            if glob(folder + '/final_summary*.txt'):
+                return True
+        return False
 
     @staticmethod
     def check_guppy():
@@ -75,9 +172,9 @@ class Methods(object):
             print('Running Guppy{}'.format(guppy_version))
 
     @staticmethod
-    def check_from_list(my_category, my_item, my_list):
-        if my_item not in my_list:
-            print('Please use of the following choice for {}: {}'.format(my_category, my_list))
+    def check_from_list(my_category, my_item):
+        if not Catalog.is_valid(my_category, my_item):
+            print('Please use of the following choice for {}: {}'.format(my_category, Catalog.get_list(my_category)))
             sys.exit()
 
     @staticmethod
@@ -102,15 +199,15 @@ class Methods(object):
             raise Exception('Please chose a configuration file or a "library kit/flowcell/sequencer" combination, '
                             'not both.')
         if config:
-            if config not in Kits.configuration_file_list:
+            if not Catalog.is_valid('configuration file', config):
                 raise Exception('Please use one of the following supported configuration file: {}'
-                                .format(Kits.configuration_file_list))
+                                .format(Catalog.get_list('configuration file')))
         if not config:
             if flowcell and library_kit and sequencer:
                 # Check flowcell
-                Methods.check_from_list('flowcell', flowcell, Kits.flowcell_list)
+                Methods.check_from_list('flowcell', flowcell)
                 # Check library kit
-                Methods.check_from_list('library kit', library_kit, Kits.library_kit_list)
+                Methods.check_from_list('library kit', library_kit)
             else:
                 raise Exception('Please make sure you are selection a library kit, a flowcell and a sequencer if '
                                 'you are not using a configuration file')
@@ -119,15 +216,13 @@ class Methods(object):
     def check_barcode(barcode_kit, barcode_description):
         for bc in barcode_kit:
             if bc:
-                Methods.check_from_list('barcoding kit', bc, Kits.barcoding_kit_list)
+                Methods.check_from_list('barcoding kit', bc)
 
     @staticmethod
     def get_guppy_config(flowcell, library, sequencer, workflows):
-        # Parse workflow.tsv to pandas df
-        df = pd.read_csv(workflows, sep='\t', header=0)
-
-        # Return the config (4th column) matching the requested flowcell, library, accuracy and sequencer
-        guppy_conf_list = df.loc[(df['flowcell'] == flowcell) & (df['kit'] == library), 'config_name'].values
+        # Return the config (4th column of workflow.tsv) matching the requested flowcell, library, accuracy and
+        # sequencer, from the precompiled catalog
+        guppy_conf_list = Catalog.get_configs(flowcell, library, workflows)
 
         if sequencer == 'promethion':
             guppy_conf_list = [x for x in guppy_conf_list if 'prom' in x]  # Assume it will only return one...
@@ -151,18 +246,27 @@ class Methods(object):
 
     @staticmethod
     def get_files(in_folder, ext):
-        sample_dict = dict()
+        file_list = list()
 
         # Look for input sequence files recursively
         for root, directories, filenames in os.walk(in_folder):
             for filename in filenames:
                 if filename.endswith(ext):  # accept a tuple or string
-                    file_path = os.path.join(root, filename)
-                    file_path = os.path.realpath(file_path)  # follow symbolic links
-                    sample = filename.split('.')[0].replace('_pass', '').replace('_filtered', '')
-                    if filename.endswith('gz'):
-                        sample = sample.split('.')[0]
-                    sample_dict[sample] = file_path
+                    file_list.append(os.path.join(root, filename))
+
+        return Methods.get_samples(file_list)
+
+    @staticmethod
+    def get_samples(file_list):
+        # {sample: path} of sequence files named after their sample
+        sample_dict = dict()
+        for file_path in file_list:
+            filename = os.path.basename(file_path)
+            file_path = os.path.realpath(file_path)  # follow symbolic links
+            sample = filename.split('.')[0].replace('_pass', '').replace('_filtered', '')
+            if filename.endswith('gz'):
+                sample = sample.split('.')[0]
+            sample_dict[sample] = file_path
         if not sample_dict:
             raise Exception('Sample dictionary empty!')
 
@@ -188,12 +292,92 @@ class Methods(object):
         with gzip.open(gzipped_file, 'rb') as f:
             return f.seek(0, whence=2)
 
+    @staticmethod
+    def folder_size(folder):
+        # Bytes used by the files of a folder and its sub-folders
+        size = 0
+        for root, directories, filenames in os.walk(folder):
+            for filename in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(root, filename))
+                except OSError:
+                    continue  # Deleted while walking
+        return size
+
+    @staticmethod
+    def estimate_uncompressed_size(gzipped_file, sample_size=4 * 1024 * 1024):
+        # Extrapolate the compression ratio of the beginning of the file, much faster than "gzipped_file_size"
+        size = os.path.getsize(gzipped_file)
+        if size <= sample_size or not gzipped_file.endswith('.gz'):
+            return Methods.gzipped_file_size(gzipped_file) if gzipped_file.endswith('.gz') else size
+        with open(gzipped_file, 'rb') as f:
+            data = f.read(sample_size)
+        uncompressed = 0
+        while data:
+            # Files written by blocks (compress_stream, BGZF) have one gzip member per block
+            d = zlib.decompressobj(31)
+            uncompressed += len(d.decompress(data))
+            data = d.unused_data if d.eof else b''
+        return int(uncompressed * size / sample_size)
+
+    @staticmethod
+    def fastq_stats(fastq):
+        # Number of reads and bases of a fastq (gzipped or not), from its read index if it has one
+        if os.path.exists(fastq + '.fqi'):
+            from fastq_index import FastqIndex
+            lengths = FastqIndex.load(fastq)[2]
+            return len(lengths), int(lengths.sum())
+        reads = bases = 0
+        with (gzip.open(fastq, 'rb') if fastq.endswith('.gz') else open(fastq, 'rb')) as f:
+            for i, line in enumerate(f):
+                if i % 4 == 1:
+                    reads += 1
+                    bases += len(line.rstrip(b'\r\n'))
+        return reads, bases
+
+    @staticmethod
+    def estimate_memory(tool, uncompressed_size):
+        # Rough peak memory in GB of a per-sample job, from the uncompressed size of its input
+        if tool == 'porechop':
+            return 2.5 * uncompressed_size / 1e9  # Loads all the reads
+        if tool == 'filtlong':
+            return 0.05 * uncompressed_size / 1e9 + 0.1  # Keeps read scores
+        return 0.5  # Built-in engines and others, streaming with fixed size buffers
+
+    @staticmethod
+    def copy_file_kernel(fd, wfd):
+        # Append a file to another without going through Python buffers. Gzip members can simply be concatenated.
+        size = os.fstat(fd.fileno()).st_size
+        offset = 0
+        wfd.flush()  # The kernel copies write at the file position, after what a previous fallback left buffered
+        for copy_func in ['copy_file_range', 'sendfile']:
+            if not hasattr(os, copy_func):
+                continue
+            try:
+                while offset < size:
+                    if copy_func == 'copy_file_range':
+                        n = os.copy_file_range(fd.fileno(), wfd.fileno(), size - offset, offset)
+                    else:
+                        n = os.sendfile(wfd.fileno(), fd.fileno(), offset, size - offset)
+                    if n == 0:
+                        break  # Nothing copied before the end (e.g. some file systems): same as not supported
+                    offset += n
+            except OSError:
+                # Not supported between these file systems, try the next method from where it stopped
+                continue
+            if offset == size:
+                return
+        fd.seek(offset)
+        shutil.copyfileobj(fd, wfd)
+        if fd.tell() != size:
+            raise IOError('{} changed size while being merged'.format(fd.name))
+
     @staticmethod
     def merge_files(file_list, merged_file):
         with open(merged_file, 'wb') as wfd:
             for f in file_list:
                 with open(f, 'rb') as fd:
-                    shutil.copyfileobj(fd, wfd)
+                    Methods.copy_file_kernel(fd, wfd)
 
     @staticmethod
     def delete_unmerged(file_list):
@@ -201,23 +385,145 @@ class Methods(object):
             os.remove(f)
 
     @staticmethod
-    def merge_rename_fastq(fastq_folder, barcode_kit):
-        # List all folders
+    def list_guppy_fastq(folder):
+        # Guppy chunks, plain fastq when Guppy does not compress them
+        return sorted(glob(folder + 'fastq_runid_*.fastq.gz') + glob(folder + 'fastq_runid_*.fastq'))
+
+    @staticmethod
+    def merge_barcode(name, fastq_list, merged_fastq, threads=1):
+        start_time = time.time()
+        size = sum(os.path.getsize(x) for x in fastq_list)
+        if not all(x.endswith('.gz') for x in fastq_list):
+            # Plain fastq from Guppy: compressed once here, at the level of the intermediate files
+            index_file = merged_fastq + '.fqi' if Methods.bgzf else None
+            Methods.compress_stream(ConcatReader(fastq_list), merged_fastq + '.tmp', threads,
+                                    level=Methods.intermediate_level(), index_file=index_file)
+            os.replace(merged_fastq + '.tmp', merged_fastq)
+            Methods.delete_unmerged(fastq_list)
+        elif len(fastq_list) == 1:
+            os.rename(fastq_list[0], merged_fastq)  # Nothing to merge
+        else:
+            Methods.merge_files(fastq_list, merged_fastq)
+            Methods.delete_unmerged(fastq_list)
+        # Single write, so lines from concurrent merges do not get mixed
+        print('\t{}: {} file(s), {:.1f} MB in {:.1f}s\n'.format(name, len(fastq_list), size / 1000000,
+                                                            time.time() - start_time), end='')
+
+    @staticmethod
+    def merge_rename_fastq(fastq_folder, barcode_kit, cpu, parallel):
+        # List the files to merge for each folder
+        merge_list = list()
         for i in ['pass', 'fail']:
             if not barcode_kit:
-                fastq_list = glob(fastq_folder + i + '/fastq_runid_*.fastq.gz')
+                fastq_list = Methods.list_guppy_fastq(fastq_folder + i + '/')
+                if not fastq_list:
+                    continue  # Already merged
                 merged_fastq = fastq_folder + i + '/' + i + '.fastq.gz'
-                Methods.merge_files(fastq_list, merged_fastq)
-                Methods.delete_unmerged(fastq_list)
+                merge_list.append((i, fastq_list, merged_fastq))
             else:
                 # List directory (each barcode)
                 folder_list = glob(fastq_folder + i + '/*/')
                 for barcode_folder in folder_list:
-                    fastq_list = glob(barcode_folder + '/fastq_runid_*.fastq.gz')
+                    fastq_list = Methods.list_guppy_fastq(barcode_folder)
+                    if not fastq_list:
+                        continue  # Already merged
                     barcode_name = barcode_folder.split('/')[-2]
                     merged_fastq = fastq_folder + i + '/' + barcode_name + '/' + barcode_name + '_' + i + '.fastq.gz'
-                    Methods.merge_files(fastq_list, merged_fastq)
-                    Methods.delete_unmerged(fastq_list)
+                    merge_list.append((i + '/' + barcode_name, fastq_list, merged_fastq))
+
+        # Barcodes are merged concurrently, largest first, "parallel" at a time sharing the "cpu" threads
+        merge_list.sort(key=lambda x: -len(x[1]))
+        threads = max(1, int(cpu / parallel))
+        with futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            for job in [executor.submit(Metrics.bind(Methods.merge_barcode), *x, threads) for x in merge_list]:
+                job.result()
+
+        if Methods.bgzf:
+            # Guppy writes plain gzip: recompress the merged files (also the ones merged by a previous run)
+            from fastq_index import FastqIndex
+            fastq_list = [x for x in glob(fastq_folder + '*/*.fastq.gz') + glob(fastq_folder + '*/*/*.fastq.gz')
+                          if not os.path.basename(x).startswith('fastq_runid_')
+                          and not os.path.exists(FastqIndex.index_file(x))]
+            with futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+                for job in [executor.submit(Metrics.bind(FastqIndex.build), x, threads, Methods.intermediate_level())
+                            for x in fastq_list]:
+                    job.result()
+
+    @staticmethod
+    def merge_basecalled_batch(batch_folder, basecalled_folder, tag):
+        """
+        Move the fastq files of a basecalled batch into the main basecalled folder, keeping the pass/fail and
+        barcode sub-folders. Files are prefixed with the batch tag to avoid name collisions between batches.
+        The batch sequencing summary is appended to the main one.
+        Return a dictionary of the moved "pass" files per barcode: {barcode: [fastq, ...]}
+        """
+        for i in ['pass', 'fail']:
+            for fastq in sorted(glob(batch_folder + i + '/**/fastq_runid_*.fastq.gz', recursive=True) +
+                                glob(batch_folder + i + '/**/fastq_runid_*.fastq', recursive=True)):
+                rel_folder = os.path.relpath(os.path.dirname(fastq), batch_folder)  # "pass" or "pass/barcode01"
+                dest_folder = basecalled_folder + rel_folder + '/'
+                Methods.make_folder(dest_folder)
+                dest_fastq = dest_folder + os.path.basename(fastq).replace('fastq_runid_', 'fastq_runid_' + tag + '_')
+                shutil.move(fastq, dest_fastq)
+
+        # Append sequencing summary, writing header only once
+        batch_summary = batch_folder + 'sequencing_summary.txt'
+        main_summary = basecalled_folder + 'sequencing_summary.txt'
+        if os.path.exists(batch_summary):
+            write_header = not os.path.exists(main_summary)
+            with open(batch_summary, 'r') as f_in, open(main_summary, 'a') as f_out:
+                header = f_in.readline()
+                if write_header:
+                    f_out.write(header)
+                shutil.copyfileobj(f_in, f_out)
+
+        # Keep Guppy logs
+        for log_file in glob(batch_folder + 'guppy_basecaller_log-*.log'):
+            shutil.move(log_file, basecalled_folder + os.path.basename(log_file))
+
+        shutil.rmtree(batch_folder, ignore_errors=True)
+
+        return Methods.batch_pass_files(basecalled_folder, tag)
+
+    @staticmethod
+    def batch_pass_files(basecalled_folder, tag):
+        # "pass" files of a batch merged into the basecalled folder, per barcode: {barcode: [fastq, ...]}
+        moved_dict = dict()
+        for fastq in sorted(glob(basecalled_folder + 'pass/**/fastq_runid_' + tag + '_*.fastq.gz', recursive=True) +
+                            glob(basecalled_folder + 'pass/**/fastq_runid_' + tag + '_*.fastq', recursive=True)):
+            barcode = os.path.basename(os.path.dirname(fastq))  # "pass" without barcodes
+            moved_dict.setdefault(barcode, list()).append(fastq)
+        return moved_dict
+
+    @staticmethod
+    def remove_unrecorded_batch(basecalled_folder, tag, processed_set):
+        """
+        Undo the merge of a batch interrupted before it was recorded as processed, so it can be basecalled again:
+        remove its fastq files and the rows of the sequencing summary of the fast5 files not recorded.
+        """
+        for fastq in glob(basecalled_folder + '*/**/fastq_runid_' + tag + '_*.fastq*', recursive=True):
+            os.remove(fastq)
+
+        main_summary = basecalled_folder + 'sequencing_summary.txt'
+        if not os.path.exists(main_summary):
+            return
+        name_set = set(os.path.basename(x) for x in processed_set)
+        removed = 0
+        with open(main_summary, 'r') as f_in, open(main_summary + '.tmp', 'w') as f_out:
+            header = f_in.readline()
+            f_out.write(header)
+            columns = header.rstrip('\n').split('\t')
+            column = columns.index('filename_fast5' if 'filename_fast5' in columns else 'filename')
+            for line in f_in:
+                if line.split('\t')[column] in name_set:
+                    f_out.write(line)
+                else:
+                    removed += 1
+        if removed:
+            print('\tRemoved {} reads of the interrupted {} from the sequencing summary.'.format(removed, tag))
+            os.replace(main_summary + '.tmp', main_summary)
+        else:
+            os.remove(main_summary + '.tmp')
 
     @staticmethod
     def parse_samples(barcode_desc):
@@ -229,8 +535,8 @@ class Methods(object):
                 if not line:
                     continue
                 try:
-                    barcode, sample_name = line.split('\t')
-                except IndexError:
+                    barcode, sample_name = line.split('\t')[:2]
+                except ValueError:
                     raise Exception('The sample decription file must be a tab-separated file with two columns where '
                                     'the first one is the barcode (e.g. barcode01) name and the second one the sample '
                                     'name (e.g. my_sample')
@@ -238,8 +544,34 @@ class Methods(object):
 
         return sample_dict
 
+    @staticmethod
+    def parse_bases(bases):
+        # "500M", "1.5G", "5e8" or "500000000" -> 500000000
+        bases = str(bases).strip().upper().rstrip('B')
+        multiplier = {'K': 1e3, 'M': 1e6, 'G': 1e9}.get(bases[-1:], 1)
+        try:
+            value = int(float(bases[:-1] if multiplier > 1 else bases) * multiplier)
+        except ValueError:
+            raise Exception('Invalid number of bases: "{}". Use for example 500M, 1.5G or 5e8.'.format(bases))
+        if value <= 0:
+            raise Exception('The number of bases must be positive: "{}"'.format(bases))
+        return value
+
+    @staticmethod
+    def parse_target_bases(barcode_desc, target_bases=None):
+        # {sample: target bases} from the optional third column of the sample description file, else the global one
+        target_dict = dict()
+        if barcode_desc:
+            with open(barcode_desc, 'r') as f:
+                for line in f:
+                    fields = line.rstrip().split('\t')
+                    if len(fields) > 2 and fields[2].strip():
+                        target_dict[fields[1]] = Methods.parse_bases(fields[2])
+        return target_dict, Methods.parse_bases(target_bases) if target_bases else None
+
     @staticmethod
     def rename_barcode(sample_dict, basecalled_folder):
+        from fastq_index import FastqIndex
         for i in ['pass', 'fail']:
             # Rename folders
             folder_list = glob(basecalled_folder + i + '/*/')
@@ -251,15 +583,19 @@ class Methods(object):
                     fastq_new_name = folder_new_name + '/' + sample_dict[barcode_name] + '_' + i + '.fastq.gz'
                     os.rename(barcode_folder, folder_new_name)  # Rename folder
                     os.rename(fastq_current_name, fastq_new_name)  # Rename fastq
-                elif barcode_name == 'unclassified':
-                    continue
+                    if os.path.exists(FastqIndex.index_file(fastq_current_name)):
+                        # Read index of the fastq with "--bgzf", only refers to positions in the file
+                        os.rename(FastqIndex.index_file(fastq_current_name), FastqIndex.index_file(fastq_new_name))
+                elif barcode_name == 'unclassified' or barcode_name in sample_dict.values():
+                    continue  # Unclassified or already renamed
                 else:  # Delete barcodes found but not present en description file. Not supposed to be there
                     shutil.rmtree(barcode_folder, ignore_errors=False, onerror=None)  # Delete non-empty folder
 
     @staticmethod
-    def run_guppy(fast5_folder, basecalled_folder, guppy_conf, recursive, device, barcode_kit):
+    def run_guppy(fast5_folder, basecalled_folder, guppy_conf, recursive, device, barcode_kit, file_list=None,
+                  resume=False, port=None, guppy_params=None, group=None):
         Methods.make_folder(basecalled_folder)
-        os.chdir(basecalled_folder)  # avoid "guppy_basecaller-core-dump-db" folder created in script location
+        guppy_params = guppy_params if guppy_params else Methods.guppy_params
 
         cmd = ['guppy_basecaller',
                '--config', guppy_conf,
@@ -267,18 +603,31 @@ class Methods(object):
                '--save_path', basecalled_folder,
                '--calib_detect',
                '--records_per_fastq', str(0),
-               '--compress_fastq',
-               '--disable_pings',
-               '--gpu_runners_per_device', str(2),
-               '--chunk_size', str(1000),
-               '--chunks_per_runner', str(128),
-               '--device', device,
-               '--detect_adapter',
-               '--detect_primer',
-               '--trim_adapters',
-               '--trim_primers']
+               '--disable_pings']
+        if Methods.intermediate == 'gzip':
+            cmd += ['--compress_fastq']  # Else plain fastq, compressed at a lower level when merged
+        if port:
+            # Client of a running basecall server, which already holds the model and the devices
+            cmd += ['--port', port]
+        else:
+            cmd += ['--gpu_runners_per_device', str(guppy_params['gpu_runners_per_device']),
+                    '--chunk_size', str(guppy_params['chunk_size']),
+                    '--chunks_per_runner', str(guppy_params['chunks_per_runner']),
+                    '--device', device]
+        cmd += ['--detect_adapter',
+                '--detect_primer',
+                '--trim_adapters',
+                '--trim_primers']
         if recursive:
             cmd += ['--recursive']
+        if resume:
+            # Continue an interrupted run, files already basecalled in the save path are skipped
+            cmd += ['--resume']
+        if file_list:
+            # Only basecall the listed fast5 files (all or a subset of the files present in the input folder)
+            input_file_list = basecalled_folder + 'input_file_list.txt'
+            Methods.list_to_file([os.path.basename(x) for x in file_list], input_file_list)
+            cmd += ['--input_file_list', input_file_list]
         if barcode_kit:
             cmd += ['--detect_barcodes']
             if barcode_kit[0] != 'unknown':
@@ -287,7 +636,80 @@ class Methods(object):
                 else:
                     cmd += ['--barcode_kits', barcode_kit[0]]
 
-        subprocess.run(cmd)
+        # Run from the save path to avoid "guppy_basecaller-core-dump-db" folder created in script location
+        # No timeout nor retry: a run takes as long as it takes, and is resumed instead
+        ProcessEngine.run('guppy:' + os.path.basename(basecalled_folder.rstrip('/')), cmd, cwd=basecalled_folder,
+                          timeout=0, retries=0, pool='guppy', group=group)
+
+    @staticmethod
+    def split_shards(fast5_dict, n_shards):
+        # Size-balanced shards: largest files first, each one added to the smallest shard so far
+        shard_list = [list() for _ in range(n_shards)]
+        shard_sizes = [0] * n_shards
+        for file_path, (size, mtime) in sorted(fast5_dict.items(), key=lambda x: (-x[1][0], x[0])):
+            i = shard_sizes.index(min(shard_sizes))
+            shard_list[i].append(file_path)
+            shard_sizes[i] += size
+        return [sorted(x) for x in shard_list if x]
+
+    @staticmethod
+    def run_guppy_sharded(fast5_folder, basecalled_folder, guppy_conf, recursive, device_list, workers_per_device,
+                          barcode_kit, file_list=None, shards_per_worker=4, port=None, guppy_params=None,
+                          fast5_dict=None):
+        """
+        Split the fast5 files in size-balanced shards and basecall them with one Guppy process per device and
+        worker slot, each with its own save path. There are more shards than workers, so a worker finishing early
+        takes the next shard from the queue. Shards are then merged in shard order, so the outputs do not depend on
+        which worker finished first. With a basecall server port, the workers are client processes of that server.
+        """
+        if fast5_dict is None:
+            fast5_dict = Methods.list_fast5(fast5_folder, recursive)
+        if file_list:
+            fast5_dict = {x: fast5_dict[x] for x in file_list if x in fast5_dict}
+        slot_list = [device for device in device_list for _ in range(workers_per_device)]
+        shard_list = Methods.split_shards(fast5_dict, len(slot_list) * shards_per_worker)
+
+        shard_folder = basecalled_folder + 'shards/'
+        Methods.make_folder(shard_folder)
+
+        # Shards already basecalled and merged by an interrupted run
+        merged_file = shard_folder + 'merged.txt'
+        merged_set = set()
+        if os.path.exists(merged_file):
+            with open(merged_file, 'r') as f:
+                merged_set = set(int(x) for x in f.read().split())
+
+        shard_queue = Queue()
+        for i in sorted(range(len(shard_list)), key=lambda x: -len(shard_list[x])):
+            if i not in merged_set:
+                shard_queue.put(i)
+
+        def worker(device, group=None):
+            while True:
+                try:
+                    i = shard_queue.get_nowait()
+                except Empty:
+                    return
+                folder = shard_folder + 'shard_{:04d}/'.format(i)
+                if os.path.exists(folder + 'shard_done'):
+                    continue
+                shutil.rmtree(folder, ignore_errors=True)  # Leftover of an interrupted run
+                print('\tShard {} ({} fast5) on {}\n'.format(i + 1, len(shard_list[i]), device), end='')
+                Methods.run_guppy(fast5_folder, folder, guppy_conf, recursive, device, barcode_kit,
+                                  file_list=shard_list[i], port=port, guppy_params=guppy_params, group=group)
+                Methods.flag_done(folder + 'shard_done')
+
+        # A failed shard stops the other workers
+        ProcessEngine.run_parallel(worker, [(device,) for device in slot_list], len(slot_list))
+
+        for i in range(len(shard_list)):
+            if i in merged_set:
+                continue
+            folder = shard_folder + 'shard_{:04d}/'.format(i)
+            Methods.merge_basecalled_batch(folder, basecalled_folder, 'shard{:04d}'.format(i))
+            with open(merged_file, 'a') as f:
+                f.write('{}\n'.format(i))
+        shutil.rmtree(shard_folder, ignore_errors=True)
 
     @staticmethod
     def rename_basecalled(basecalled_folder, sample_dict):
@@ -323,55 +745,274 @@ class Methods(object):
 
         Methods.get_files(basecalled_folder)
 
+    @staticmethod
+    def log_file(folder, sample, tool):
+        # Per-sample log of the external tools, in the "logs" folder of the stage
+        log_file = folder + 'logs/{}.{}.log'.format(sample, tool)
+        Methods.make_folder(os.path.dirname(log_file))
+        return log_file
+
     @staticmethod
     def run_pycoqc(basecalled_folder, report_folder):
         Methods.make_folder(report_folder)
         cmd = ['pycoQC',
                '-f', basecalled_folder + 'sequencing_summary.txt',
                '-o', report_folder + 'pycoQC_output.html']
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        ProcessEngine.run('pycoqc', cmd, log_file=report_folder + 'pycoQC.log')
 
     @staticmethod
-    def run_porechop(sample, input_fastq, trimmed_folder, cpu):
+    def run_porechop(sample, input_fastq, trimmed_folder, cpu, check_reads=1000, group=None):
+        trimmed_fastq = trimmed_folder + sample + '.fastq.gz'
         cmd = ['porechop',
                '-i', input_fastq,
-               '-o', trimmed_folder + sample + '.fastq.gz',
                '--threads', str(cpu),
-               '--check_reads', str(1000)]  # Only check adapter from 1,000 reads instead of 10,000
+               '--check_reads', str(check_reads)]  # Only check adapter from 1,000 reads instead of 10,000
 
         print('\t{}'.format(sample))
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        log_file = Methods.log_file(trimmed_folder, sample, 'porechop')
+        if not Methods.bgzf and Methods.intermediate == 'gzip':
+            # Porechop writes the output in place: to a temporary name (it picks the format from the extension),
+            # renamed once complete so an interrupted Porechop never leaves a truncated file under the final name
+            tmp_fastq = trimmed_folder + sample + '.tmp.fastq.gz'
+            try:
+                ProcessEngine.run('porechop:' + sample, cmd + ['-o', tmp_fastq], log_file=log_file, group=group)
+            except BaseException:
+                if os.path.exists(tmp_fastq):
+                    os.remove(tmp_fastq)
+                raise
+            os.replace(tmp_fastq, trimmed_fastq)
+            return
+
+        # Porechop only writes plain gzip at its own level: uncompressed reads to stdout, compressed here
+        job = ProcessEngine.submit('porechop:' + sample, cmd + ['--format', 'fastq'], stdout=ProcessEngine.PIPE,
+                                   log_file=log_file, group=group)
+        try:
+            with job.stdout:
+                Methods.compress_stream(job.stdout, trimmed_fastq + '.tmp', max(1, cpu),
+                                        level=Methods.intermediate_level(), index_file=trimmed_fastq + '.fqi')
+            job.result()
+        except BaseException:
+            if os.path.exists(trimmed_fastq + '.tmp'):
+                os.remove(trimmed_fastq + '.tmp')
+            raise
+        os.replace(trimmed_fastq + '.tmp', trimmed_fastq)
 
     @staticmethod
     def run_porechop_parallel(sample_dict, output_folder, cpu, parallel):
         Methods.make_folder(output_folder)
 
-        with futures.ThreadPoolExecutor(max_workers=int(parallel)) as executor:
-            args = ((sample, path, output_folder, int(cpu / parallel))
-                    for sample, path in sample_dict.items())
-            for results in executor.map(lambda x: Methods.run_porechop(*x), args):
-                pass
+        # First failure cancels the other samples
+        ProcessEngine.run_parallel(Methods.run_porechop,
+                                   [(sample, path, output_folder, int(cpu / parallel))
+                                    for sample, path in sample_dict.items()], parallel)
 
     @staticmethod
-    def run_filtlong(sample, input_fastq, filtered_folder):
+    def run_porechop_filtlong(sample, input_fastq, trimmed_folder, filtered_folder, cpu, check_reads=1000,
+                              keep_percent=95, keep_trimmed=False, filter_engine='filtlong', trimmer='porechop',
+                              adapter_dict=None, target_bases=None, tmp_folder=None):
+        """
+        Trim and filter a sample without writing the gzipped trimmed reads in between. Porechop writes uncompressed
+        reads to stdout, straight into a temporary file read by Filtlong. Filtlong needs to read its input twice
+        (scoring, then output), so a plain file is used instead of a pipe. The temporary file is written to
+        tmp_folder if given (e.g. a scratch folder), else next to the filtered reads. The trimmed reads are only
+        compressed to the trimmed folder if requested, at the same time as the filtering.
+        """
+        print('\t{}'.format(sample))
+
+        if tmp_folder:
+            Methods.make_folder(tmp_folder)
+            trimmed_fastq = tmp_folder + sample + '.trimmed.fastq'
+        else:
+            trimmed_fastq = filtered_folder + '.' + sample + '.trimmed.fastq'
+        try:
+            if trimmer == 'native':
+                from trimmer import NativeTrimmer  # Avoid circular import
+                NativeTrimmer.trim_fastq(input_fastq, trimmed_fastq, cpu, check_reads, adapter_dict, compress=False)
+            else:
+                cmd = ['porechop',
+                       '-i', input_fastq,
+                       '--format', 'fastq',
+                       '--threads', str(cpu),
+                       '--check_reads', str(check_reads)]
+                ProcessEngine.run('porechop:' + sample, cmd, stdout=trimmed_fastq,
+                                  log_file=Methods.log_file(filtered_folder, sample, 'porechop'))
+
+            with futures.ThreadPoolExecutor(max_workers=1) as executor:
+                if keep_trimmed:
+                    def keep():
+                        with open(trimmed_fastq, 'rb') as f_in:
+                            Methods.compress_stream(f_in, trimmed_folder + sample + '.fastq.gz', max(1, int(cpu / 2)),
+                                                    level=Methods.intermediate_level(),
+                                                    index_file=trimmed_folder + sample + '.fastq.gz.fqi')
+                    job = executor.submit(Metrics.bind(keep))
+                if filter_engine == 'native':
+                    from read_filter import ReadFilter  # Avoid circular import
+                    ReadFilter.run_filter_process(sample, trimmed_fastq, filtered_folder, keep_percent, cpu,
+                                                  target_bases)
+                else:
+                    Methods.run_filtlong(sample, trimmed_fastq, filtered_folder, keep_percent, cpu, target_bases)
+                if keep_trimmed:
+                    job.result()
+        finally:
+            # Also when the trimming or the filtering failed or was interrupted
+            if os.path.exists(trimmed_fastq):
+                os.remove(trimmed_fastq)
+
+    @staticmethod
+    def run_porechop_batch(moved_dict, trimmed_batch_folder, tag, cpu, parallel, trimmer='porechop',
+                           adapter_dict=None):
+        """
+        Trim the reads of a single basecalled batch. One output file per barcode and batch. The native trimmer
+        looks for the adapters of a barcode in its first batch only, and trims the next batches with them, like a
+        whole sample is trimmed in batch mode. Porechop looks for them in each batch.
+        """
+        sample_dict = dict()
+        for barcode, fastq_list in moved_dict.items():
+            for j, fastq in enumerate(fastq_list):
+                Methods.make_folder(trimmed_batch_folder + barcode)
+                sample_dict['{}/{}_{}'.format(barcode, tag, j)] = fastq
+        if trimmer == 'native':
+            from trimmer import NativeTrimmer  # Avoid circular import
+            found_dict = {barcode: NativeTrimmer.batch_adapters(trimmed_batch_folder + barcode + '/', fastq_list[0],
+                                                                adapter_dict)
+                          for barcode, fastq_list in moved_dict.items()}
+            with futures.ThreadPoolExecutor(max_workers=int(parallel)) as executor:
+                job_list = [executor.submit(NativeTrimmer.run_trimming, sample, path, trimmed_batch_folder,
+                                            int(cpu / parallel), 0, found_dict[sample.split('/')[0]])
+                            for sample, path in sample_dict.items()]
+                for job in job_list:
+                    job.result()
+        else:
+            Methods.run_porechop_parallel(sample_dict, trimmed_batch_folder, cpu, parallel)
+
+    @staticmethod
+    def trimmed_batch_files(barcode_batch_folder):
+        # Trimmed batches of a barcode ("batch00002_10.fastq.gz"), in batch then file order
+        batch_list = list()
+        for fastq in glob(barcode_batch_folder + 'batch*.fastq.gz'):
+            fields = os.path.basename(fastq)[len('batch'):-len('.fastq.gz')].split('_')
+            if len(fields) == 2 and all(x.isdigit() for x in fields):
+                batch_list.append((int(fields[0]), int(fields[1]), fastq))
+        return [x[2] for x in sorted(batch_list)]
+
+    @staticmethod
+    def merge_trimmed_batches(barcode_batch_folder, trimmed_fastq):
+        # Concatenate the trimmed batches of a barcode into a single file
+        print('\t{}'.format(os.path.basename(trimmed_fastq).split('.')[0]))
+        fastq_list = Methods.trimmed_batch_files(barcode_batch_folder)
+        Methods.merge_files(fastq_list, trimmed_fastq)
+        if Methods.bgzf:
+            # Concatenated BGZF files are still BGZF, only the read offsets move
+            from fastq_index import FastqIndex
+            FastqIndex.merge(fastq_list, trimmed_fastq)
+
+    @staticmethod
+    def compress_stream(in_stream, out_file, threads, block_size=4 * 1024 * 1024, level=6, bgzf=None,
+                        index_file=None):
+        """
+        Gzip a binary stream using multiple threads. The stream is read in blocks of fixed size and each block is
+        compressed independently as a gzip member (concatenated gzip members are a valid gzip file). At most
+        2 blocks per thread are held in memory, whatever the size of the stream.
+        With bgzf (default is Methods.bgzf), each block is split in BGZF blocks and the fastq read index is written
+        to index_file, if given (see fastq_index.py).
+        The level, sizes and compression CPU time go to the run metrics. Return the number of bytes read and written.
+        """
+        if bgzf is None:
+            bgzf = Methods.bgzf
+        start_time = time.time()
+        cpu_list = list()  # Compression CPU time of each block
+        indexer = None
+        if bgzf:
+            from fastq_index import FastqIndex, Indexer
+            block_size = block_size // FastqIndex.block_size * FastqIndex.block_size
+            if index_file:
+                indexer = Indexer()
+
+        def compress_block(block):
+            start_cpu = time.thread_time()
+            if bgzf:
+                result = FastqIndex.compress_chunk(block, level)
+            else:
+                c = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31 -> gzip header and trailer
+                result = c.compress(block) + c.flush(), None
+            cpu_list.append(time.thread_time() - start_cpu)
+            return result
+
+        def write_block(job):
+            data, sizes = job.result()
+            f.write(data)
+            if indexer:
+                for size in sizes:
+                    indexer.add_block(*size)
+            return len(data)
+
+        bytes_in = bytes_out = 0
+        max_pending = 2 * threads
+        pending = deque()
+        with open(out_file, 'wb') as f, futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            while True:
+                block = in_stream.read(block_size)
+                if not block:
+                    break
+                bytes_in += len(block)
+                pending.append(executor.submit(compress_block, block))
+                if indexer:
+                    indexer.feed(block)  # While the workers compress
+                # Write compressed blocks in order, waiting for the oldest one when too many are in flight
+                while pending and (len(pending) >= max_pending or pending[0].done()):
+                    bytes_out += write_block(pending.popleft())
+            while pending:
+                bytes_out += write_block(pending.popleft())
+            if bgzf:
+                f.write(FastqIndex.eof)
+                bytes_out += len(FastqIndex.eof)
+
+        if indexer:
+            indexer.write(index_file)
+        Metrics.add('compression', {'name': os.path.basename(out_file[:-4] if out_file.endswith('.tmp') else out_file),
+                                    'stage': Metrics.current_stage(),
+                                    'level': level,
+                                    'bgzf': bool(bgzf),
+                                    'input_bytes': bytes_in,
+                                    'output_bytes': bytes_out,
+                                    'cpu_seconds': round(sum(cpu_list), 3),
+                                    'wall_seconds': round(time.time() - start_time, 3)})
+        return bytes_in, bytes_out
+
+    @staticmethod
+    def run_filtlong(sample, input_fastq, filtered_folder, keep_percent=95, cpu=1, target_bases=None, group=None):
         print('\t{}'.format(sample))
 
         cmd = ['filtlong',
-               '--keep_percent', str(95),  # Drop bottom 5% reads
-               input_fastq]
+               '--keep_percent', str(keep_percent)]  # Drop bottom 5% reads
+        if target_bases:
+            cmd += ['--target_bases', str(target_bases)]  # Stop at that many bases, whichever is reached first
+        cmd += [input_fastq]
 
-        # Filtlong writes to stdout
+        # Filtlong writes to stdout, which is compressed on the fly
         filtered_fastq = filtered_folder + sample + '.fastq.gz'
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        with gzip.open(filtered_fastq, 'wb') as f:
-            f.write(p.communicate()[0])
+        start_time = time.time()
+        job = ProcessEngine.submit('filtlong:' + sample, cmd, stdout=ProcessEngine.PIPE,
+                                   log_file=Methods.log_file(filtered_folder, sample, 'filtlong'), group=group)
+        try:
+            with job.stdout:
+                bytes_in, bytes_out = Methods.compress_stream(job.stdout, filtered_fastq + '.tmp', max(1, cpu),
+                                                              index_file=filtered_fastq + '.fqi')
+            job.result()
+        except BaseException:
+            if os.path.exists(filtered_fastq + '.tmp'):
+                os.remove(filtered_fastq + '.tmp')
+            raise
+        os.replace(filtered_fastq + '.tmp', filtered_fastq)  # Output only present if complete
+
+        elapsed = max(time.time() - start_time, 0.001)
+        print('\t{}: {:.1f} MB filtered and compressed to {:.1f} MB in {:.1f}s ({:.1f} MB/s)'.format(
+            sample, bytes_in / 1000000, bytes_out / 1000000, elapsed, bytes_in / 1000000 / elapsed))
 
     @staticmethod
-    def run_filtlong_parallel(sample_dict, output_folder, parallel):
+    def run_filtlong_parallel(sample_dict, output_folder, cpu, parallel):
         Methods.make_folder(output_folder)
 
-        with futures.ThreadPoolExecutor(max_workers=int(parallel)) as executor:
-            args = ((sample, path, output_folder)
-                    for sample, path in sample_dict.items())
-            for results in executor.map(lambda x: Methods.run_filtlong(*x), args):
-                pass
+        ProcessEngine.run_parallel(Methods.run_filtlong,
+                                   [(sample, path, output_folder, 95, int(cpu / parallel))
+                                    for sample, path in sample_dict.items()], parallel)
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import socket
+import subprocess
+from argparse import ArgumentParser
+import psutil
+
+
+class BasecallServer(object):
+    """
+    Long-lived "guppy_basecall_server", so the model is loaded and the devices are initialized only once.
+    Started servers are recorded in a state file in the home folder, keyed by config, device and performance
+    parameters, and are reused by later invocations as long as they are still running. Basecalling is then done by
+    "guppy_basecaller" client processes connected to the server.
+    """
+
+    state_file = os.path.expanduser('~/.basecall_nanopore/servers.json')
+    log_folder = os.path.expanduser('~/.basecall_nanopore/server_logs/')  # Servers outlive the output folders
+    start_timeout = 300  # Seconds to wait for the server to accept connections
+    used_keys = list()  # Servers used by this process, for "--stop-server"
+
+    @staticmethod
+    def load_state():
+        # Recorded servers still running, the ones that exited are dropped
+        if os.path.exists(BasecallServer.state_file):
+            with open(BasecallServer.state_file, 'r') as f:
+                state = json.load(f)
+            return {k: v for k, v in state.items() if BasecallServer.is_running(v)}
+        return dict()
+
+    @staticmethod
+    def server_key(guppy_conf, device, guppy_params=None):
+        # A server started with other performance parameters (e.g. before "--tune") is not reused
+        params = ','.join('{}={}'.format(k, v) for k, v in sorted(guppy_params.items())) if guppy_params else ''
+        return '{}|{}|{}'.format(guppy_conf, device, params)
+
+    @staticmethod
+    def save_state(state):
+        os.makedirs(os.path.dirname(BasecallServer.state_file), exist_ok=True)
+        tmp_file = BasecallServer.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=4)
+        os.replace(tmp_file, BasecallServer.state_file)
+
+    @staticmethod
+    def split_address(address):
+        # "5555" or "host:5555"
+        address = str(address)
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+            return host, int(port)
+        return 'localhost', int(address)
+
+    @staticmethod
+    def is_listening(address):
+        host, port = BasecallServer.split_address(address)
+        try:
+            with socket.create_connection((host, port), timeout=2):
+                return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def start_time(pid):
+        """
+        Start time of the process if it is a basecall server, else None. A recorded pid can have been reused by any
+        other process since the server exited: the executable (or script, run by an interpreter) must be
+        "guppy_basecall_server".
+        """
+        try:
+            process = psutil.Process(pid)
+            if not any(os.path.basename(x) == 'guppy_basecall_server' for x in process.cmdline()[:2]):
+                return None
+            return process.create_time()
+        except psutil.Error:
+            return None  # Exited, or owned by another user
+
+    @staticmethod
+    def is_running(server):
+        # Still the recorded server: same pid, command and start time (not recorded by older versions)
+        start_time = BasecallServer.start_time(server['pid'])
+        if start_time is None:
+            return False
+        return server.get('start_time') is None or abs(start_time - server['start_time']) < 1
+
+    @staticmethod
+    def free_port():
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(('localhost', 0))
+            return s.getsockname()[1]
+
+    @staticmethod
+    def start(guppy_conf, device, log_folder, port=None, guppy_params=None):
+        port = port if port else BasecallServer.free_port()
+        os.makedirs(log_folder, exist_ok=True)
+        cmd = ['guppy_basecall_server',
+               '--config', guppy_conf,
+               '--log_path', log_folder,
+               '--port', str(port),
+               '--device', device,
+               '--disable_pings']
+        if guppy_params:
+            # The server runs the models, so it gets the performance parameters
+            cmd += ['--gpu_runners_per_device', str(guppy_params['gpu_runners_per_device']),
+                    '--chunk_size', str(guppy_params['chunk_size']),
+                    '--chunks_per_runner', str(guppy_params['chunks_per_runner'])]
+        # New session, so the server is not killed with this pipeline and can be reused by the next one
+        with open(log_folder + 'guppy_basecall_server.out', 'a') as f:
+            p = subprocess.Popen(cmd, cwd=log_folder, stdout=f, stderr=subprocess.STDOUT,
+                                 start_new_session=True)
+
+        start_time = time.time()
+        while not BasecallServer.is_listening(port):
+            if p.poll() is not None:
+                raise Exception('Basecall server failed to start (exit code {}). See {}.'.format(
+                    p.returncode, log_folder + 'guppy_basecall_server.out'))
+            if time.time() - start_time > BasecallServer.start_timeout:
+                p.kill()
+                raise Exception('Basecall server not accepting connections on port {} after {}s.'.format(
+                    port, BasecallServer.start_timeout))
+            time.sleep(0.5)
+        return p.pid, port, BasecallServer.start_time(p.pid)
+
+    @staticmethod
+    def get_server(guppy_conf, device, address=None, guppy_params=None):
+        """
+        Return the address of a basecall server for this config and device. A server given by address must
+        already be running. Otherwise, a server started by a previous invocation is reused if still running,
+        or a new one is started.
+        """
+        if address and BasecallServer.is_listening(address):
+            print('\tUsing basecall server at {}.'.format(address))
+            return str(address)
+        elif address and ':' in str(address):
+            raise Exception('No basecall server listening at {}.'.format(address))
+
+        key = BasecallServer.server_key(guppy_conf, device, guppy_params)
+        BasecallServer.used_keys.append(key)
+        state = BasecallServer.load_state()
+        if key in state:
+            server = state[key]
+            if BasecallServer.is_listening(server['port']):
+                print('\tReusing basecall server on port {} (pid {}).'.format(server['port'], server['pid']))
+                return str(server['port'])
+            state.pop(key)  # Not accepting connections
+        for old_key in [k for k, v in state.items() if v['config'] == guppy_conf and v['device'] == device]:
+            # Same model and GPU with other parameters: stopped to free the GPU memory
+            BasecallServer.stop(state.pop(old_key))
+
+        print('\tStarting basecall server for {} on {}...'.format(guppy_conf, device))
+        pid, port, start_time = BasecallServer.start(guppy_conf, device, BasecallServer.log_folder, address,
+                                                     guppy_params)
+        state[key] = {'pid': pid, 'port': port, 'config': guppy_conf, 'device': device,
+                      'params': guppy_params if guppy_params else dict(),
+                      'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'start_time': start_time}
+        BasecallServer.save_state(state)
+        print('\tBasecall server listening on port {} (pid {}).'.format(port, pid))
+        return str(port)
+
+    @staticmethod
+    def stop(server):
+        if not BasecallServer.is_running(server):
+            return  # Exited: its pid (and process group) may now be another process
+        try:
+            os.killpg(server['pid'], 15)
+        except (ProcessLookupError, PermissionError):
+            return
+        print('\tStopped basecall server on port {} (pid {}).'.format(server['port'], server['pid']))
+
+    @staticmethod
+    def stop_all(key_list=None):
+        # Stop the servers started by this pipeline, all of them or the ones listed
+        state = BasecallServer.load_state()
+        for key in list(state):
+            if key_list is None or key in key_list:
+                BasecallServer.stop(state.pop(key))
+        BasecallServer.save_state(state)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='List the basecall servers started by basecall_nanopore.py and still '
+                                        'running, or stop them.')
+    parser.add_argument('--stop', action='store_true',
+                        help='Stop all the servers. Optional.')
+    args = parser.parse_args()
+
+    if args.stop:
+        BasecallServer.stop_all()
+    else:
+        for server in BasecallServer.load_state().values():
+            print('Port {}, pid {}: {} on {} {}, started {}'.format(
+                server['port'], server['pid'], server['config'], server['device'], server.get('params', dict()),
+                server['started']))
@@ -0,0 +1,341 @@
+import os
+import sys
+import gzip
+import json
+import random
+import shutil
+import tempfile
+import subprocess
+from glob import glob
+from argparse import ArgumentParser
+
+benchmark_folder = os.path.dirname(os.path.abspath(__file__))
+package_folder = os.path.dirname(benchmark_folder)
+stub_folder = os.path.join(benchmark_folder, 'stubs')
+sys.path.insert(0, package_folder)
+sys.path.insert(0, benchmark_folder)
+
+from generate import SyntheticData  # noqa: E402
+from read_filter import ReadFilter  # noqa: E402
+from trimmer import NativeTrimmer  # noqa: E402
+from kits import Kits  # noqa: E402
+
+
+class PipelineCheck(object):
+    """
+    Functional checks of the pipeline on synthetic fast5 files, with the stub executables of "benchmarks/stubs"
+    in place of Guppy, Porechop, Filtlong and pycoQC, so they run without a GPU or a cluster. Each check runs
+    "basecall_nanopore.py" in its own process, or the native engines on hand-built reads, and raises an exception at
+    the first unexpected result.
+    """
+
+    checks = ['checkpoints', 'sharding', 'executors', 'filter', 'trimmer']
+    n_fast5 = 6
+    n_barcodes = 3
+    reads_per_fast5 = 200
+
+    def __init__(self, work_folder, cpu):
+        self.work_folder = work_folder
+        self.cpu = cpu
+        self.fast5_folder = os.path.join(work_folder, 'fast5')
+        if not os.path.exists(self.fast5_folder):
+            SyntheticData.write_fast5(self.fast5_folder, PipelineCheck.n_fast5)
+
+    @staticmethod
+    def expect(condition, message):
+        if not condition:
+            raise Exception('Check failed: {}'.format(message))
+
+    def run_pipeline(self, output_folder, extra_args=(), env=None, check=True):
+        # Return the output of the run
+        cmd = [sys.executable, os.path.join(package_folder, 'basecall_nanopore.py'),
+               '-i', self.fast5_folder, '-o', output_folder, '-c', 'dna_r9.4.1_450bps_sup.cfg', '-b', 'EXP-NBD104',
+               '-g', 'cuda:0', '-t', str(self.cpu), '--no-disk-check'] + list(extra_args)
+        env = dict(os.environ, STUB_GUPPY_BARCODES=str(PipelineCheck.n_barcodes),
+                   STUB_GUPPY_READS=str(PipelineCheck.reads_per_fast5), **(env if env else dict()))
+        p = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if check and p.returncode:
+            print(p.stdout)
+            raise Exception('Check failed: the pipeline exited with code {}.'.format(p.returncode))
+        return p
+
+    @staticmethod
+    def summary_reads(basecalled_folder):
+        # {fast5 file: number of reads} and number of distinct read ids of the sequencing summary
+        fast5_dict = dict()
+        read_ids = set()
+        with open(basecalled_folder + 'sequencing_summary.txt', 'r') as f:
+            next(f)
+            for line in f:
+                fields = line.split('\t')
+                fast5_dict[fields[0]] = fast5_dict.get(fields[0], 0) + 1
+                read_ids.add(fields[1])
+        return fast5_dict, len(read_ids)
+
+    @staticmethod
+    def fastq_content(folder):
+        # {fastq file of the folder and its subfolders: decompressed content}
+        content_dict = dict()
+        for root, directories, filenames in os.walk(folder):
+            for filename in filenames:
+                if filename.endswith('.fastq.gz'):
+                    with gzip.open(os.path.join(root, filename), 'rb') as f:
+                        content_dict[os.path.relpath(os.path.join(root, filename), folder)] = f.read()
+        return content_dict
+
+    @staticmethod
+    def mtimes(folder):
+        return {x: os.stat(folder + x).st_mtime for x in os.listdir(folder) if x.endswith('.fastq.gz')}
+
+    def check_checkpoints(self):
+        # Guppy resumed after a failure, completed nodes skipped on rerun, truncated outputs made again
+        output_folder = os.path.join(self.work_folder, 'checkpoints') + '/'
+        shutil.rmtree(output_folder, ignore_errors=True)
+        basecalled_folder = output_folder + '1_basecalled/'
+        filtered_folder = output_folder + '4_filtered/'
+
+        p = self.run_pipeline(output_folder, env={'STUB_GUPPY_FAIL_AFTER': '2'}, check=False)
+        PipelineCheck.expect(p.returncode, 'the pipeline did not stop when Guppy failed')
+        fast5_dict, _ = PipelineCheck.summary_reads(basecalled_folder)
+        PipelineCheck.expect(len(fast5_dict) == 2, '{} fast5 basecalled before the failure, not 2'.format(
+            len(fast5_dict)))
+
+        p = self.run_pipeline(output_folder)
+        PipelineCheck.expect('Resuming interrupted basecalling' in p.stdout, 'Guppy not resumed')
+        fast5_dict, n_ids = PipelineCheck.summary_reads(basecalled_folder)
+        PipelineCheck.expect(len(fast5_dict) == PipelineCheck.n_fast5 and
+                             set(fast5_dict.values()) == {PipelineCheck.reads_per_fast5} and
+                             n_ids == sum(fast5_dict.values()),
+                             'resumed basecalling skipped or repeated fast5 files: {}'.format(fast5_dict))
+
+        with open(output_folder + 'checkpoints.json', 'r') as f:
+            manifest = json.load(f)
+        samples = sorted(PipelineCheck.mtimes(filtered_folder))
+        PipelineCheck.expect(samples, 'no filtered reads')
+        for sample in samples:
+            sample = sample.replace('.fastq.gz', '')
+            for stage in ['trimming', 'filtering']:
+                node = manifest.get('{}:{}'.format(stage, sample))
+                PipelineCheck.expect(node and all(set(x) >= {'size', 'checksum'} for x in node['outputs'].values()),
+                                     'no checkpoint with the output size and checksum for {}:{}'.format(stage, sample))
+
+        before = PipelineCheck.mtimes(filtered_folder)
+        p = self.run_pipeline(output_folder)
+        PipelineCheck.expect('Skipping basecalling' in p.stdout and PipelineCheck.mtimes(filtered_folder) == before,
+                             'completed nodes run again')
+
+        # Truncated output of one sample: only that sample is filtered again
+        truncated = filtered_folder + samples[0]
+        size = os.path.getsize(truncated)
+        with open(truncated, 'r+b') as f:
+            f.truncate(size // 2)
+        self.run_pipeline(output_folder)
+        after = PipelineCheck.mtimes(filtered_folder)
+        PipelineCheck.expect(os.path.getsize(truncated) == size, 'truncated output not made again')
+        PipelineCheck.expect(all(after[x] == before[x] for x in samples[1:]), 'complete samples filtered again')
+        print('\tcheckpoints: OK')
+
+    def check_sharding(self):
+        # Shards spread over the workers of two devices, merged outputs independent of the worker finishing order
+        reference_folder = os.path.join(self.work_folder, 'unsharded') + '/'
+        shutil.rmtree(reference_folder, ignore_errors=True)
+        self.run_pipeline(reference_folder)
+        reference_dict, _ = PipelineCheck.summary_reads(reference_folder + '1_basecalled/')
+
+        merged_list = list()
+        for i in range(2):
+            output_folder = os.path.join(self.work_folder, 'sharded_{}'.format(i)) + '/'
+            shutil.rmtree(output_folder, ignore_errors=True)
+            p = self.run_pipeline(output_folder, ['-g', 'cuda:0 cuda:1', '--workers-per-device', '2'])
+            shard_lines = [x for x in p.stdout.splitlines() if x.strip().startswith('Shard ')]
+            PipelineCheck.expect(len(shard_lines) == PipelineCheck.n_fast5 and
+                                 all(any(x.endswith(device) for x in shard_lines) for device in ['cuda:0', 'cuda:1']),
+                                 'fast5 not split in one shard per file over both devices:\n' + '\n'.join(shard_lines))
+            basecalled_folder = output_folder + '1_basecalled/'
+            PipelineCheck.expect(not os.path.exists(basecalled_folder + 'shards/'), 'shard folders left behind')
+            fast5_dict, n_ids = PipelineCheck.summary_reads(basecalled_folder)
+            PipelineCheck.expect(fast5_dict == reference_dict and n_ids == sum(fast5_dict.values()),
+                                 'sharded basecalling skipped or repeated fast5 files: {}'.format(fast5_dict))
+            with open(basecalled_folder + 'sequencing_summary.txt', 'rb') as f:
+                merged_list.append((f.read(), PipelineCheck.fastq_content(basecalled_folder)))
+            PipelineCheck.expect(sorted(os.listdir(output_folder + '4_filtered/')) ==
+                                 sorted(os.listdir(reference_folder + '4_filtered/')),
+                                 'other samples than without sharding')
+        PipelineCheck.expect(merged_list[0] == merged_list[1], 'merged outputs differ between two sharded runs')
+        print('\tsharding: OK')
+
+    def check_executors(self):
+        # Per-sample steps in worker processes and as jobs of the fake scheduler give the same reads as in threads
+        cluster_config = os.path.join(benchmark_folder, 'fake_cluster.json')
+        env = {'FAKE_SCHEDULER_FOLDER': os.path.join(self.work_folder, 'fake_scheduler')}
+        filtered_dict = dict()
+        for executor in ['thread', 'local', 'batch']:
+            output_folder = os.path.join(self.work_folder, 'executor_' + executor) + '/'
+            shutil.rmtree(output_folder, ignore_errors=True)
+            extra_args = ['--executor', executor]
+            if executor == 'batch':
+                extra_args += ['--cluster-config', cluster_config]
+            p = self.run_pipeline(output_folder, extra_args, env)
+            if executor == 'batch':
+                PipelineCheck.expect('submitted as job' in p.stdout, 'no job submitted to the fake scheduler')
+            filtered_dict[executor] = PipelineCheck.fastq_content(output_folder + '4_filtered/')
+            PipelineCheck.expect(filtered_dict[executor], 'no filtered reads with the {} executor'.format(executor))
+            PipelineCheck.expect(filtered_dict[executor] == filtered_dict['thread'],
+                                 'the {} executor gives other filtered reads than the thread one'.format(executor))
+
+        # Jobs lost by the scheduler: submitted again, then the run stops
+        output_folder = os.path.join(self.work_folder, 'executor_lost') + '/'
+        shutil.rmtree(output_folder, ignore_errors=True)
+        p = self.run_pipeline(output_folder, ['--executor', 'batch', '--cluster-config', cluster_config],
+                              dict(env, FAKE_SCHEDULER_LOSE='1'), check=False)
+        PipelineCheck.expect(p.returncode and 'retrying (1/1)' in p.stdout,
+                             'lost jobs not submitted again before the run stopped')
+        print('\texecutors: OK')
+
+    @staticmethod
+    def accuracy(q):
+        # Base accuracy of a Phred quality, as a percentage
+        return 100 * (1 - 10 ** (-q / 10))
+
+    @staticmethod
+    def write_reads(fastq, read_list):
+        # Reads given as (name, sequence, quality string)
+        with open(fastq, 'w') as f:
+            f.writelines('@{}\n{}\n+\n{}\n'.format(name, seq, qual) for name, seq, qual in read_list)
+
+    def check_filter(self):
+        """
+        Native filter on hand-built reads: scores as defined by Filtlong (length, mean accuracy and worst 250 bp
+        window), then the reads kept with "--keep_percent 95". The low quality stretch of r2 makes it the worst
+        read: without the window penalty, r3 would be dropped instead. Then the same reads and a synthetic sample
+        must be kept by the Filtlong stub, which scores reads the same way.
+        """
+        acc = PipelineCheck.accuracy
+        read_list = [('r1', 'A' * 300, '+' * 300),  # Q10
+                     ('r2', 'C' * 1000, '?' * 500 + '"' * 250 + '?' * 250),  # Q30 with 250 bp of Q1
+                     ('r3', 'G' * 100, '5' * 100),  # Q20, shorter than the window
+                     ('r4', 'T' * 19000, '?' * 19000),  # Q30
+                     ('r5', 'A' * 400, '$' * 400),  # Q3
+                     ('r6', 'C' * 900, '0' * 900)]  # Q15
+        r2_mean = (750 * acc(30) + 250 * acc(1)) / 1000
+        expected = {'r1': (300, acc(10), acc(10)),
+                    'r2': (1000, r2_mean, acc(1)),
+                    'r3': (100, acc(20), acc(20)),
+                    'r4': (19000, acc(30), acc(30)),
+                    'r5': (400, acc(3), acc(3)),
+                    'r6': (900, acc(15), acc(15))}
+        lengths, mean_q, window_q = ReadFilter.score_batch([x[2].encode() for x in read_list])
+        for i, (name, _, _) in enumerate(read_list):
+            length, mean, window = expected[name]
+            PipelineCheck.expect(lengths[i] == length and abs(mean_q[i] - mean) < 1e-6 and
+                                 abs(window_q[i] - window) < 1e-6,
+                                 '{} scored {}, {:.4f}, {:.4f} instead of {}, {:.4f}, {:.4f}'.format(
+                                     name, lengths[i], mean_q[i], window_q[i], length, mean, window))
+
+        scores = ReadFilter.read_scores(lengths, mean_q, window_q)
+        for i, (name, _, _) in enumerate(read_list):
+            length, mean, window = expected[name]
+            score = (length * mean) ** 0.5 * min(1, window / mean)
+            PipelineCheck.expect(abs(scores[i] - score) < 1e-6, '{} has a score of {:.4f} instead of {:.4f}'.format(
+                name, scores[i], score))
+
+        keep = ReadFilter.select_reads(lengths, scores, 95)
+        kept = set(x[0] for x, k in zip(read_list, keep) if k)
+        PipelineCheck.expect(kept == {'r1', 'r3', 'r4', 'r5', 'r6'}, 'kept {} instead of all but r2'.format(
+            ', '.join(sorted(kept))))
+
+        fastq = os.path.join(self.work_folder, 'filter_reads.fastq')
+        PipelineCheck.write_reads(fastq, read_list)
+        sample_folder = os.path.join(self.work_folder, 'filter_sample') + '/'
+        if not os.path.exists(sample_folder):
+            SyntheticData.write_basecalled(sample_folder, 0, 5000, n_chunks=1, fail_fraction=0)
+        for input_fastq in [fastq] + glob(sample_folder + 'pass/*.fastq.gz'):
+            check = ReadFilter.compare_with_filtlong(input_fastq, 95)
+            PipelineCheck.expect(check['agreement'] == 1.0, 'the native filter and the Filtlong stub keep other '
+                                                             'reads ({}) in {}'.format(check, input_fastq))
+        print('\tfilter: OK')
+
+
+    def check_trimmer(self):
+        """
+        Native trimmer on hand-built reads with SQK-NSK007 adapters at known positions, trimmed by its process pool:
+        the exact bases kept at the read ends (adapter and "extra_end_trim" bases removed), and the pieces of reads
+        split on a middle adapter, numbered like Porechop, without the pieces shorter than "min_split_size".
+        """
+        rng = random.Random(1)
+
+        def bases(n):
+            return ''.join(rng.choice('ACGT') for _ in range(n))
+
+        start_adapter, end_adapter = Kits.adapter_dict['SQK-NSK007']
+        extra = NativeTrimmer.extra_end_trim
+        lead, tail, insert = bases(12), bases(7), bases(9000)
+        a, b = insert[:3000], insert[3000:6000]
+        # Read: (sequence, [(start, end) of each piece expected in the output])
+        read_dict = {'t1': (lead + start_adapter + a, [(len(lead) + len(start_adapter) + extra, None)]),
+                     't2': (a + end_adapter + tail, [(0, len(a) - extra)]),
+                     't3': (lead + start_adapter + a + end_adapter + tail,
+                            [(len(lead) + len(start_adapter) + extra,
+                              len(lead) + len(start_adapter) + len(a) - extra)]),
+                     't4': (insert, [(0, None)]),
+                     't5': (a + start_adapter + b, [(0, len(a) - extra), (len(a) + len(start_adapter) + extra, None)]),
+                     't6': (a[:500] + start_adapter + b, [(500 + len(start_adapter) + extra, None)]),
+                     't7': (lead + start_adapter + a + start_adapter + b + end_adapter + tail,
+                            [(len(lead) + len(start_adapter) + extra, len(lead) + len(start_adapter) + len(a) - extra),
+                             (len(lead) + 2 * len(start_adapter) + len(a) + extra,
+                              len(lead) + 2 * len(start_adapter) + len(a) + len(b) - extra)])}
+        qual_dict = {name: ''.join(rng.choice('+5?') for _ in seq) for name, (seq, _) in read_dict.items()}
+        fastq = os.path.join(self.work_folder, 'trimmer_reads.fastq')
+        PipelineCheck.write_reads(fastq, [(name + ' runid=check', seq, qual_dict[name])
+                                          for name, (seq, _) in read_dict.items()])
+
+        trimmed_fastq = os.path.join(self.work_folder, 'trimmer_reads.trimmed.fastq')
+        stats = NativeTrimmer.trim_fastq(fastq, trimmed_fastq, self.cpu, compress=False)
+        PipelineCheck.expect(stats['adapters'] == ['SQK-NSK007'], 'adapters found: {}'.format(stats['adapters']))
+        expected = list()
+        for name, (seq, piece_list) in read_dict.items():
+            for i, (start, end) in enumerate(piece_list):
+                header = '@{}{} runid=check'.format(name, '_{}'.format(i + 1) if name in ['t5', 't6', 't7'] else '')
+                expected.append((header, seq[start:end], qual_dict[name][start:end]))
+        with open(trimmed_fastq, 'r') as f:
+            lines = f.read().splitlines()
+        found = list(zip(lines[0::4], lines[1::4], lines[3::4]))
+        PipelineCheck.expect([x[0] for x in found] == [x[0] for x in expected], 'reads written: {}'.format(
+            ', '.join(x[0] for x in found)))
+        for (header, seq, qual), (_, expected_seq, expected_qual) in zip(found, expected):
+            PipelineCheck.expect(seq == expected_seq and qual == expected_qual, '{} trimmed to {} bp instead of the '
+                                 'expected {} bp'.format(header, len(seq), len(expected_seq)))
+        PipelineCheck.expect(stats['reads'] == 7 and stats['trimmed'] == 6 and stats['split'] == 3,
+                             'counted {}'.format(stats))
+        print('\ttrimmer: OK')
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Functional checks of the pipeline on synthetic data with stub tools.')
+    parser.add_argument('-c', '--checks', metavar=','.join(PipelineCheck.checks),
+                        required=False, type=str, default=','.join(PipelineCheck.checks),
+                        help='Comma separated list of checks to run. Default is all. Optional.')
+    parser.add_argument('-t', '--threads', metavar='2',
+                        required=False, type=int, default=2,
+                        help='Number of threads. Default is 2. Optional.')
+    parser.add_argument('-w', '--work', metavar='/path/to/work_folder/',
+                        required=False, type=str,
+                        help='Folder for the synthetic data and outputs, kept after the checks. Default is a '
+                             'temporary folder. Optional.')
+    args = parser.parse_args()
+
+    # Stub tools first in the PATH, for the pipeline processes
+    os.environ['PATH'] = stub_folder + os.pathsep + os.environ['PATH']
+
+    work_folder = args.work if args.work else tempfile.mkdtemp(prefix='basecall_nanopore_check_')
+    os.makedirs(work_folder, exist_ok=True)
+    try:
+        pipeline_check = PipelineCheck(work_folder, args.threads)
+        for name in args.checks.split(','):
+            if name not in PipelineCheck.checks:
+                raise Exception('Unknown check "{}", choose among {}.'.format(name, ', '.join(PipelineCheck.checks)))
+            getattr(pipeline_check, 'check_' + name)()
+    finally:
+        if not args.work:
+            shutil.rmtree(work_folder, ignore_errors=True)
+    print('All checks passed.')
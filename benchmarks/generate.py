@@ -0,0 +1,173 @@
+import os
+import gzip
+import hashlib
+from argparse import ArgumentParser
+import numpy as np
+
+
+class SyntheticData(object):
+    """
+    Synthetic Guppy output for benchmarks: barcoded "fastq_runid_*.fastq.gz" chunks in pass/fail folders, with
+    skewed barcode sizes like on a real run, and the matching sequencing_summary.txt. Everything is generated from
+    a seed, so the same parameters always give the same files.
+    """
+
+    summary_header = ['filename', 'read_id', 'run_id', 'channel', 'start_time', 'duration', 'passes_filtering',
+                      'sequence_length_template', 'mean_qscore_template', 'barcode_arrangement']
+    run_id = 'b3a6c1d2e4f5'
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+    @staticmethod
+    def barcode_weights(n_barcodes, skew=1.0):
+        # Zipf-like: barcode01 gets the most reads, then fewer and fewer
+        weights = 1 / np.arange(1, n_barcodes + 1) ** skew
+        return weights / weights.sum()
+
+    @staticmethod
+    def read_lengths(rng, n_reads, mean_length):
+        # Log-normal, like nanopore read lengths
+        sigma = 0.8
+        lengths = rng.lognormal(np.log(mean_length) - sigma ** 2 / 2, sigma, n_reads)
+        return np.clip(lengths, 100, 100 * mean_length).astype(np.int64)
+
+    @staticmethod
+    def make_reads(rng, n_reads, mean_length, prefix, adapters=None):
+        """
+        Return read ids, lengths, mean qualities and the fastq text of the reads. With adapters, a (start, end) pair
+        of sequences, each read starts and ends with them.
+        """
+        start_adapter, end_adapter = [x.encode() for x in adapters] if adapters else (b'', b'')
+        lengths = SyntheticData.read_lengths(rng, n_reads, mean_length)
+        mean_q = np.clip(rng.normal(14, 3, n_reads), 4, 30)
+        seq = SyntheticData.bases[rng.integers(0, 4, int(lengths.sum()), dtype=np.uint8)].tobytes()
+        lengths = lengths + len(start_adapter) + len(end_adapter)
+        qual = np.clip(np.repeat(mean_q, lengths) + rng.normal(0, 3, int(lengths.sum())), 1, 50)
+        qual = (qual + 33).astype(np.uint8).tobytes()
+        read_ids = [hashlib.md5('{}_{}'.format(prefix, i).encode()).hexdigest() for i in range(n_reads)]
+
+        records = list()
+        start = 0
+        q_start = 0
+        for read_id, length in zip(read_ids, lengths):
+            end = start + length - len(start_adapter) - len(end_adapter)
+            records.append(b'@%s runid=%s\n%s%s%s\n+\n%s\n' % (
+                read_id.encode(), SyntheticData.run_id.encode(), start_adapter, seq[start:end], end_adapter,
+                qual[q_start:q_start + length]))
+            start = end
+            q_start += length
+        return read_ids, lengths, mean_q, b''.join(records)
+
+    @staticmethod
+    def write_basecalled(folder, n_barcodes=12, n_reads=50000, mean_length=2000, n_chunks=10, skew=1.0,
+                         fail_fraction=0.1, seed=1, fast5_name=None, first_chunk=0, compress=True, adapters=None):
+        """
+        Write a basecalled folder like Guppy does ("pass/barcode01/fastq_runid_*_0_0.fastq.gz", ...), with reads
+        spread over n_chunks chunks (one per fast5 file), numbered from first_chunk. No barcode folders if
+        n_barcodes is 0, plain ".fastq" files if not compress. Adapters are added to the reads if given (see
+        make_reads()). Return the number of reads and bases written.
+        """
+        rng = np.random.default_rng(seed)
+        if n_barcodes:
+            names = ['barcode{:02d}'.format(i + 1) for i in range(n_barcodes)] + ['unclassified']
+            weights = np.append(SyntheticData.barcode_weights(n_barcodes, skew) * 0.97, 0.03)
+        else:
+            names, weights = [''], np.array([1.0])
+
+        summary_lines = list()
+        total_bases = 0
+        for chunk in range(first_chunk, first_chunk + n_chunks):
+            chunk_reads = n_reads // n_chunks + (1 if chunk - first_chunk < n_reads % n_chunks else 0)
+            counts = rng.multinomial(chunk_reads, weights)
+            filename = fast5_name if fast5_name else 'FAR12345_{}_{}.fast5'.format(SyntheticData.run_id, chunk)
+            for name, count in zip(names, counts):
+                if not count:
+                    continue
+                passed = rng.random(count) >= fail_fraction
+                for status, mask in [('pass', passed), ('fail', ~passed)]:
+                    n = int(mask.sum())
+                    if not n:
+                        continue
+                    prefix = '{}_{}_{}_{}_{}'.format(seed, chunk, name, status, filename)
+                    read_ids, lengths, mean_q, fastq = SyntheticData.make_reads(rng, n, mean_length, prefix,
+                                                                                  adapters)
+                    out_folder = os.path.join(folder, status, name)
+                    os.makedirs(out_folder, exist_ok=True)
+                    out_file = os.path.join(out_folder, 'fastq_runid_{}_{}_0.fastq{}'.format(
+                        SyntheticData.run_id, chunk, '.gz' if compress else ''))
+                    with gzip.open(out_file, 'ab', compresslevel=1) if compress else open(out_file, 'ab') as f:
+                        f.write(fastq)
+                    total_bases += int(lengths.sum())
+                    start_times = rng.random(n) * 72 * 3600
+                    for read_id, length, q, start_time in zip(read_ids, lengths, mean_q, start_times):
+                        summary_lines.append('{}\t{}\t{}\t{}\t{:.2f}\t{:.2f}\t{}\t{}\t{:.2f}\t{}\n'.format(
+                            filename, read_id, SyntheticData.run_id, rng.integers(1, 513), start_time,
+                            length / 400, 'TRUE' if status == 'pass' else 'FALSE', length, q,
+                            name if name else 'unclassified'))
+
+        summary_file = os.path.join(folder, 'sequencing_summary.txt')
+        new_file = not os.path.exists(summary_file)
+        with open(summary_file, 'a') as f:
+            if new_file:
+                f.write('\t'.join(SyntheticData.summary_header) + '\n')
+            f.writelines(summary_lines)
+        return n_reads, total_bases
+
+    @staticmethod
+    def write_summary(summary_file, n_reads=1000000, n_barcodes=12, mean_length=2000, seed=1,
+                      block_size=500000):
+        # Large sequencing_summary.txt only (no fastq), written by blocks, for the QC benchmarks
+        rng = np.random.default_rng(seed)
+        names = np.array(['barcode{:02d}'.format(i + 1) for i in range(n_barcodes)] + ['unclassified'])
+        weights = np.append(SyntheticData.barcode_weights(n_barcodes) * 0.97, 0.03)
+        with open(summary_file, 'w') as f:
+            f.write('\t'.join(SyntheticData.summary_header) + '\n')
+            for start in range(0, n_reads, block_size):
+                n = min(block_size, n_reads - start)
+                lengths = SyntheticData.read_lengths(rng, n, mean_length)
+                mean_q = np.clip(rng.normal(14, 3, n), 4, 30)
+                barcodes = names[rng.choice(len(names), n, p=weights)]
+                passed = np.where(mean_q >= 9, 'TRUE', 'FALSE')
+                start_times = rng.random(n) * 72 * 3600
+                channels = rng.integers(1, 513, n)
+                f.writelines('FAR12345_{}_{}.fast5\t{:032x}\t{}\t{}\t{:.2f}\t{:.2f}\t{}\t{}\t{:.2f}\t{}\n'.format(
+                    SyntheticData.run_id, (start + i) // 4000, start + i, SyntheticData.run_id, channels[i],
+                    start_times[i], lengths[i] / 400, passed[i], lengths[i], mean_q[i], barcodes[i])
+                    for i in range(n))
+
+    @staticmethod
+    def write_fast5(folder, n_files=10, size=1024):
+        # Placeholder fast5 files, only read by the stub basecaller
+        os.makedirs(folder, exist_ok=True)
+        for i in range(n_files):
+            with open(os.path.join(folder, 'FAR12345_{}_{}.fast5'.format(SyntheticData.run_id, i)), 'wb') as f:
+                f.write(b'\0' * size)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Generate synthetic basecalled data.')
+    parser.add_argument('-o', '--output', metavar='/path/to/output_folder/',
+                        required=True, type=str,
+                        help='Folder to write the basecalled data to. Mandatory.')
+    parser.add_argument('-b', '--barcodes', metavar='12',
+                        required=False, type=int, default=12,
+                        help='Number of barcodes. 0 for no barcodes. Default is 12. Optional.')
+    parser.add_argument('-r', '--reads', metavar='50000',
+                        required=False, type=int, default=50000,
+                        help='Number of reads. Default is 50000. Optional.')
+    parser.add_argument('-l', '--length', metavar='2000',
+                        required=False, type=int, default=2000,
+                        help='Mean read length. Default is 2000. Optional.')
+    parser.add_argument('-c', '--chunks', metavar='10',
+                        required=False, type=int, default=10,
+                        help='Number of fastq chunks per barcode. Default is 10. Optional.')
+    parser.add_argument('-s', '--summary-only', metavar='1000000',
+                        required=False, type=int,
+                        help='Only write a sequencing_summary.txt with that many reads. Optional.')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    if args.summary_only:
+        SyntheticData.write_summary(os.path.join(args.output, 'sequencing_summary.txt'), args.summary_only,
+                                    args.barcodes, args.length)
+    else:
+        SyntheticData.write_basecalled(args.output, args.barcodes, args.reads, args.length, args.chunks)
@@ -0,0 +1,285 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+from multiprocessing import cpu_count
+
+benchmark_folder = os.path.dirname(os.path.abspath(__file__))
+package_folder = os.path.dirname(benchmark_folder)
+stub_folder = os.path.join(benchmark_folder, 'stubs')
+sys.path.insert(0, package_folder)
+sys.path.insert(0, benchmark_folder)
+sys.path.insert(0, stub_folder)
+
+from generate import SyntheticData  # noqa: E402
+from stub_common import Stub  # noqa: E402
+from basecall_nanopore_methods import Methods  # noqa: E402
+from qc_report import QcReport  # noqa: E402
+from summary_cache import SummaryCache  # noqa: E402
+from read_filter import ReadFilter  # noqa: E402
+from trimmer import NativeTrimmer  # noqa: E402
+from kits import Kits  # noqa: E402
+
+
+class Benchmark(object):
+    """
+    Time the pipeline stages (merging, trimming, filtering and QC) and the whole pipeline on synthetic data, with
+    stub executables in place of Guppy, Porechop, Filtlong and pycoQC, for different numbers of samples and data
+    sizes. Results are saved to a json file and can be compared with a previous one.
+    """
+
+    presets = {'quick': {'samples': [1, 4], 'reads': [4000], 'summary_reads': [200000]},
+               'full': {'samples': [1, 4, 12], 'reads': [10000, 50000], 'summary_reads': [1000000, 5000000]}}
+
+    def __init__(self, work_folder, cpu, repeats, tool_dict=None):
+        self.work_folder = work_folder
+        self.cpu = cpu
+        self.repeats = repeats
+        self.tool_dict = tool_dict if tool_dict else dict()  # {tool: executable} for the native engine checks
+        self.results = list()
+
+    @staticmethod
+    def median(values):
+        values = sorted(values)
+        return values[len(values) // 2]
+
+    def measure(self, stage, func, setup=None, **labels):
+        # Median of the repeats. setup() prepares the inputs and is not timed.
+        timings = list()
+        for _ in range(self.repeats):
+            args = setup() if setup else ()
+            start_time = time.perf_counter()
+            func(*args)
+            timings.append(time.perf_counter() - start_time)
+        result = dict(stage=stage, seconds=round(Benchmark.median(timings), 4),
+                      runs=[round(x, 4) for x in timings], **labels)
+        self.results.append(result)
+        print('\t{}: {:.3f}s {}'.format(stage, result['seconds'],
+                                        ' '.join('{}={}'.format(k, v) for k, v in labels.items())))
+        return result
+
+    def check(self, stage, func, *args, **labels):
+        # Native engine against the external tool, run once: throughput of both and agreement of their outputs
+        check = func(*args)
+        result = dict(stage=stage, seconds=round(check['reads'] / check['native_reads_per_s'], 4),
+                      check={k: round(v, 4) for k, v in check.items()}, **labels)
+        self.results.append(result)
+        print('\t{}: {:.1%} agreement, {:,.0f} reads/s native vs {:,.0f} reads/s external ({:.1f}x) {}'.format(
+            stage, check['agreement'], check['native_reads_per_s'], check['external_reads_per_s'], check['speedup'],
+            ' '.join('{}={}'.format(k, v) for k, v in labels.items())))
+        return result
+
+    def basecalled_data(self, n_samples, n_reads):
+        # Generated once per size and copied for each repeat, since merging modifies the folder
+        source = os.path.join(self.work_folder, 'basecalled_{}_{}'.format(n_samples, n_reads))
+        if not os.path.exists(source):
+            SyntheticData.write_basecalled(source, n_samples, n_reads, n_chunks=20)
+        return source
+
+    def bench_merge(self, n_samples, n_reads):
+        source = self.basecalled_data(n_samples, n_reads)
+        folder = os.path.join(self.work_folder, 'merge') + '/'
+        parallel = min(n_samples, max(1, self.cpu // 2))
+
+        def setup():
+            shutil.rmtree(folder, ignore_errors=True)
+            shutil.copytree(source, folder)
+            return folder, ['EXP-NBD104'], self.cpu, parallel
+
+        self.measure('merge_rename_fastq', Methods.merge_rename_fastq, setup, samples=n_samples, reads=n_reads)
+
+    def merged_samples(self, n_samples, n_reads):
+        # {sample: merged pass fastq}, as after demultiplexing
+        folder = os.path.join(self.work_folder, 'merged_{}_{}'.format(n_samples, n_reads)) + '/'
+        if not os.path.exists(folder):
+            shutil.copytree(self.basecalled_data(n_samples, n_reads), folder)
+            Methods.merge_rename_fastq(folder, ['EXP-NBD104'], self.cpu, min(n_samples, max(1, self.cpu // 2)))
+        return {k: v for k, v in Methods.get_files(folder + 'pass/', '.fastq.gz').items() if k != 'unclassified'}
+
+    def bench_trim_filter(self, n_samples, n_reads):
+        sample_dict = self.merged_samples(n_samples, n_reads)
+        parallel = min(n_samples, max(1, self.cpu // 2))
+        trimmed_folder = os.path.join(self.work_folder, 'trimmed') + '/'
+        filtered_folder = os.path.join(self.work_folder, 'filtered') + '/'
+
+        def setup_trim():
+            shutil.rmtree(trimmed_folder, ignore_errors=True)
+            return sample_dict, trimmed_folder, self.cpu, parallel
+
+        def setup_filter():
+            shutil.rmtree(filtered_folder, ignore_errors=True)
+            return trimmed_dict, filtered_folder, self.cpu, parallel
+
+        self.measure('run_porechop_parallel', Methods.run_porechop_parallel, setup_trim, samples=n_samples,
+                     reads=n_reads)
+        trimmed_dict = Methods.get_files(trimmed_folder, '.fastq.gz')
+        trimmed_dict = {k: v for k, v in trimmed_dict.items() if k in sample_dict}
+        self.measure('run_filtlong_parallel', Methods.run_filtlong_parallel, setup_filter, samples=n_samples,
+                     reads=n_reads)
+
+    def bench_trim(self, n_reads):
+        # Built-in adapter trimmer against Porechop, on reads with the ligation kit adapters at both ends
+        folder = os.path.join(self.work_folder, 'adapters_{}'.format(n_reads)) + '/'
+        if not os.path.exists(folder):
+            SyntheticData.write_basecalled(folder, 0, n_reads, n_chunks=1, fail_fraction=0,
+                                           adapters=Kits.adapter_dict['SQK-NSK007'])
+        fastq = Methods.get_files(folder + 'pass/', '.fastq.gz')
+        self.check('trim_vs_porechop', NativeTrimmer.compare_with_porechop, list(fastq.values())[0],
+                   os.path.join(self.work_folder, 'trim_check'), self.cpu, 1000, None, 5,
+                   self.tool_dict.get('porechop', 'porechop'), reads=n_reads)
+
+    def bench_filter(self, n_samples, n_reads):
+        # Built-in read filter against Filtlong, on the first merged sample
+        sample_dict = self.merged_samples(n_samples, n_reads)
+        fastq = sample_dict[sorted(sample_dict)[0]]
+        self.check('filter_vs_filtlong', ReadFilter.compare_with_filtlong, fastq, 95,
+                   self.tool_dict.get('filtlong', 'filtlong'), samples=n_samples, reads=n_reads)
+
+    def bench_qc(self, n_reads):
+        folder = os.path.join(self.work_folder, 'summary_{}'.format(n_reads)) + '/'
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+            SyntheticData.write_summary(folder + 'sequencing_summary.txt', n_reads)
+        report_folder = os.path.join(self.work_folder, 'qc') + '/'
+        # Text summary parsed each time, conversion to the columnar cache, then the QC on the cache
+        self.measure('qc_text', lambda x: QcReport().parse(x), lambda: (folder + 'sequencing_summary.txt',),
+                     summary_reads=n_reads)
+        self.measure('summary_cache', SummaryCache.build, lambda: (folder + 'sequencing_summary.txt',),
+                     summary_reads=n_reads)
+        self.measure('qc_native', QcReport.run_qc, lambda: (folder, report_folder), summary_reads=n_reads)
+        self.measure('qc_pycoqc', Methods.run_pycoqc, lambda: (folder, report_folder), summary_reads=n_reads)
+
+    def bench_end_to_end(self, n_samples, n_reads, n_fast5=10):
+        # Basecaller.run in its own process, like a real invocation
+        fast5_folder = os.path.join(self.work_folder, 'fast5')
+        if not os.path.exists(fast5_folder):
+            SyntheticData.write_fast5(fast5_folder, n_fast5)
+        output_folder = os.path.join(self.work_folder, 'end_to_end')
+        env = dict(os.environ, STUB_GUPPY_BARCODES=str(n_samples), STUB_GUPPY_READS=str(n_reads // n_fast5))
+        cmd = [sys.executable, os.path.join(package_folder, 'basecall_nanopore.py'),
+               '-i', fast5_folder, '-o', output_folder, '-c', 'dna_r9.4.1_450bps_sup.cfg', '-b', 'EXP-NBD104',
+               '-g', 'cuda:0', '-t', str(self.cpu)]
+
+        def setup():
+            shutil.rmtree(output_folder, ignore_errors=True)
+            return ()
+
+        def run():
+            subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, check=True)
+
+        self.measure('end_to_end', run, setup, samples=n_samples, reads=n_reads)
+
+    def report(self):
+        try:
+            commit = subprocess.run(['git', '-C', package_folder, 'rev-parse', '--short', 'HEAD'],
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+        except OSError:
+            commit = ''
+        return {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'host': socket.gethostname(),
+                'cpu': self.cpu,
+                'python': platform.python_version(),
+                'commit': commit,
+                'stub_cost': {k: os.environ.get('STUB_{}_COST'.format(k), v)
+                              for k, v in Stub.default_cost.items()},
+                'stub_cost_mode': os.environ.get('STUB_COST_MODE', 'sleep'),
+                'results': self.results}
+
+    @staticmethod
+    def result_key(result):
+        return tuple(sorted((k, v) for k, v in result.items() if k not in ('seconds', 'runs', 'check')))
+
+    @staticmethod
+    def compare(report, previous_file):
+        with open(previous_file, 'r') as f:
+            previous = {Benchmark.result_key(x): x for x in json.load(f)['results']}
+        print('Compared with {}:'.format(previous_file))
+        for result in report['results']:
+            old = previous.get(Benchmark.result_key(result))
+            if not old:
+                continue
+            labels = ' '.join('{}={}'.format(k, v) for k, v in Benchmark.result_key(result) if k != 'stage')
+            print('\t{} {}: {:.3f}s -> {:.3f}s ({:+.1f}%)'.format(
+                result['stage'], labels, old['seconds'], result['seconds'],
+                (result['seconds'] / max(old['seconds'], 1e-9) - 1) * 100))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark the pipeline stages on synthetic data with stub tools.')
+    parser.add_argument('-p', '--preset', choices=list(Benchmark.presets), default='quick',
+                        help='Numbers of samples and data sizes to test. Default is "quick". Optional.')
+    parser.add_argument('-s', '--stages', metavar='merge,trim_filter,trim,filter,qc,end_to_end',
+                        required=False, type=str, default='merge,trim_filter,trim,filter,qc,end_to_end',
+                        help='Comma separated list of benchmarks to run. Default is all. Optional.')
+    parser.add_argument('-t', '--threads', metavar=str(cpu_count()),
+                        required=False, type=int, default=cpu_count(),
+                        help='Number of threads. Default is all ({}). Optional.'.format(cpu_count()))
+    parser.add_argument('-r', '--repeats', metavar='3',
+                        required=False, type=int, default=3,
+                        help='Number of times each benchmark is run, the median is kept. Default is 3. Optional.')
+    parser.add_argument('--real-tools', action='store_true',
+                        help='Check the native engines against the real Porechop and Filtlong found in the PATH, '
+                             'instead of the stubs. Optional.')
+    parser.add_argument('-w', '--work', metavar='/path/to/work_folder/',
+                        required=False, type=str,
+                        help='Folder for the synthetic data, kept between runs. Default is a temporary folder. '
+                             'Optional.')
+    parser.add_argument('-o', '--output', metavar='/path/to/results.json',
+                        required=False, type=str,
+                        help='Results file. Default is "benchmarks/results/<date>_<host>.json". Optional.')
+    parser.add_argument('-c', '--compare', metavar='/path/to/previous_results.json',
+                        required=False, type=str,
+                        help='Previous results file to compare with. Optional.')
+    args = parser.parse_args()
+
+    tool_dict = dict()
+    if args.real_tools:
+        for tool in ['porechop', 'filtlong']:
+            tool_dict[tool] = shutil.which(tool)
+            if not tool_dict[tool]:
+                raise Exception('"{}" not found in the PATH.'.format(tool))
+    # Stub tools first in the PATH, for this process and the pipeline processes
+    os.environ['PATH'] = stub_folder + os.pathsep + os.environ['PATH']
+
+    work_folder = args.work if args.work else tempfile.mkdtemp(prefix='basecall_nanopore_benchmark_')
+    os.makedirs(work_folder, exist_ok=True)
+    benchmark = Benchmark(work_folder, args.threads, args.repeats, tool_dict)
+    preset = Benchmark.presets[args.preset]
+    stage_list = args.stages.split(',')
+
+    try:
+        for n_reads in preset['reads']:
+            for n_samples in preset['samples']:
+                if 'merge' in stage_list:
+                    benchmark.bench_merge(n_samples, n_reads)
+                if 'trim_filter' in stage_list:
+                    benchmark.bench_trim_filter(n_samples, n_reads)
+                if 'filter' in stage_list:
+                    benchmark.bench_filter(n_samples, n_reads)
+                if 'end_to_end' in stage_list:
+                    benchmark.bench_end_to_end(n_samples, n_reads)
+        if 'trim' in stage_list:
+            for n_reads in preset['reads']:
+                benchmark.bench_trim(n_reads)
+        if 'qc' in stage_list:
+            for n_reads in preset['summary_reads']:
+                benchmark.bench_qc(n_reads)
+    finally:
+        if not args.work:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    report = benchmark.report()
+    output = args.output if args.output else os.path.join(
+        benchmark_folder, 'results', '{}_{}.json'.format(time.strftime('%Y%m%d_%H%M%S'), socket.gethostname()))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print('Results saved to {}'.format(output))
+    if args.compare:
+        Benchmark.compare(report, args.compare)
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import json
+import subprocess
+from argparse import ArgumentParser
+
+package_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, package_folder)
+
+
+class StartupBenchmark(object):
+    """
+    Startup latency of the pipeline: "--help" (interpreter start and module imports) and config resolution
+    from a flowcell, library kit and sequencer, with a cold and a warm catalog cache.
+    """
+
+    @staticmethod
+    def time_help(repeats):
+        timings = list()
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(package_folder, 'basecall_nanopore.py'), '--help'],
+                           stdout=subprocess.DEVNULL, check=True)
+            timings.append(time.perf_counter() - start_time)
+        return timings
+
+    @staticmethod
+    def time_config(repeats, flowcell, library_kit, sequencer):
+        # Each repeat in a new process, like a real invocation
+        code = ('import time; t = time.perf_counter(); import sys; sys.path.insert(0, {!r}); '
+                'from basecall_nanopore_methods import Methods; from catalog import Catalog; '
+                'Methods.check_config(None, {!r}, {!r}, {!r}); '
+                'Methods.get_guppy_config({!r}, {!r}, {!r}, Catalog.workflows); '
+                'print(time.perf_counter() - t)').format(package_folder, flowcell, sequencer, library_kit,
+                                                         flowcell, library_kit, sequencer)
+        from catalog import Catalog
+        timings = dict()
+        for cache in ['cold', 'warm']:
+            timings[cache] = list()
+            for _ in range(repeats):
+                if cache == 'cold' and os.path.exists(Catalog.cache_file):
+                    os.remove(Catalog.cache_file)
+                p = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True)
+                timings[cache].append(float(p.stdout))
+        return timings
+
+    @staticmethod
+    def summary(timings):
+        timings = sorted(timings)
+        return {'min': round(timings[0], 4),
+                'median': round(timings[len(timings) // 2], 4),
+                'max': round(timings[-1], 4)}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Startup latency benchmark.')
+    parser.add_argument('-r', '--repeats', metavar='10',
+                        required=False, type=int, default=10,
+                        help='Number of times each measure is repeated. Default is 10. Optional.')
+    parser.add_argument('-o', '--output', metavar='/path/to/startup.json',
+                        required=False, type=str,
+                        help='Save the results to this json file. Optional.')
+    args = parser.parse_args()
+
+    config_timings = StartupBenchmark.time_config(args.repeats, 'FLO-MIN106', 'SQK-LSK109', 'minion')
+    results = {'help': StartupBenchmark.summary(StartupBenchmark.time_help(args.repeats)),
+               'config_cold_cache': StartupBenchmark.summary(config_timings['cold']),
+               'config_warm_cache': StartupBenchmark.summary(config_timings['warm'])}
+    for name, stats in results.items():
+        print('{}: median {:.1f} ms (min {:.1f}, max {:.1f})'.format(
+            name, stats['median'] * 1000, stats['min'] * 1000, stats['max'] * 1000))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,51 @@
+import os
+import sys
+import gzip
+import time
+
+# Stubs import the synthetic data generator from the benchmarks folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Stub(object):
+    """
+    Shared code of the stub executables. The cost of each tool is set with environment variables:
+    STUB_<TOOL>_COST (seconds per fast5 file for Guppy, per MB of input for the other tools) and
+    STUB_COST_MODE ("sleep" to only wait, "cpu" to keep one core busy for that time).
+    """
+
+    default_cost = {'GUPPY': 0.05, 'PORECHOP': 0.2, 'FILTLONG': 0.05, 'PYCOQC': 0.02}
+
+    @staticmethod
+    def cost(tool):
+        return float(os.environ.get('STUB_{}_COST'.format(tool), Stub.default_cost[tool]))
+
+    @staticmethod
+    def spend(seconds):
+        if os.environ.get('STUB_COST_MODE', 'sleep') == 'cpu':
+            end_time = time.perf_counter() + seconds
+            x = 0
+            while time.perf_counter() < end_time:
+                x += 1
+        else:
+            time.sleep(seconds)
+
+    @staticmethod
+    def read_fastq(fastq):
+        # Return the records as a list of 4-line byte strings
+        opener = gzip.open if fastq.endswith('.gz') else open
+        with opener(fastq, 'rb') as f:
+            lines = f.read().split(b'\n')
+        return [b'\n'.join(lines[i:i + 4]) + b'\n' for i in range(0, len(lines) - 3, 4)]
+
+    @staticmethod
+    def write_fastq(records, output):
+        if output is None:
+            sys.stdout.buffer.write(b''.join(records))
+            sys.stdout.buffer.flush()
+        elif output.endswith('.gz'):
+            with gzip.open(output, 'wb', compresslevel=1) as f:
+                f.write(b''.join(records))
+        else:
+            with open(output, 'wb') as f:
+                f.write(b''.join(records))
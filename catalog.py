@@ -0,0 +1,87 @@
+import os
+import sys
+import csv
+import json
+from kits import Kits
+
+
+class Catalog(object):
+    """
+    Lookup tables for the config resolution and the kit checks, built from "data/workflows.tsv" and "kits.py".
+    They are cached on disk and only rebuilt when one of these two files changes, so resolving a config does not
+    need to parse the tsv file (or import pandas) at each run.
+    """
+
+    cache_file = os.path.expanduser('~/.basecall_nanopore/catalog.json')
+    workflows = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'workflows.tsv')
+    version = 1  # Increase when the catalog structure changes
+    _catalog = None  # Loaded once per process
+
+    @staticmethod
+    def source_stamp(workflows):
+        # Size and modification time of the source files, to know if the cache is stale
+        stamp = dict()
+        for source in [workflows, os.path.abspath(sys.modules[Kits.__module__].__file__)]:
+            if os.path.exists(source):
+                stat = os.stat(source)
+                stamp[source] = [stat.st_size, stat.st_mtime]
+        return stamp
+
+    @staticmethod
+    def build(workflows):
+        # {"flowcell|kit": [config names]}
+        config_dict = dict()
+        with open(workflows, 'r', newline='') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                config_dict.setdefault('{}|{}'.format(row['flowcell'], row['kit']), list()).append(row['config_name'])
+        return {'version': Catalog.version,
+                'stamp': Catalog.source_stamp(workflows),
+                'configs': config_dict,
+                'flowcell': Kits.flowcell_list,
+                'library kit': Kits.library_kit_list,
+                'barcoding kit': Kits.barcoding_kit_list,
+                'configuration file': Kits.configuration_file_list}
+
+    @staticmethod
+    def load(workflows=None):
+        workflows = workflows if workflows else Catalog.workflows
+        if Catalog._catalog and Catalog._catalog['workflows'] == workflows:
+            return Catalog._catalog
+
+        catalog = None
+        if os.path.exists(Catalog.cache_file):
+            try:
+                with open(Catalog.cache_file, 'r') as f:
+                    catalog = json.load(f)
+            except ValueError:
+                catalog = None  # Corrupted, rebuild
+        if not catalog or catalog.get('version') != Catalog.version \
+                or catalog.get('stamp') != Catalog.source_stamp(workflows):
+            catalog = Catalog.build(workflows)
+            try:
+                os.makedirs(os.path.dirname(Catalog.cache_file), exist_ok=True)
+                tmp_file = Catalog.cache_file + '.{}.tmp'.format(os.getpid())
+                with open(tmp_file, 'w') as f:
+                    json.dump(catalog, f)
+                os.replace(tmp_file, Catalog.cache_file)
+            except OSError:
+                pass  # Read-only home folder, use the catalog without caching it
+
+        # Hashed lookups
+        catalog['workflows'] = workflows
+        catalog['sets'] = {x: set(catalog[x])
+                           for x in ['flowcell', 'library kit', 'barcoding kit', 'configuration file']}
+        Catalog._catalog = catalog
+        return catalog
+
+    @staticmethod
+    def get_configs(flowcell, library, workflows=None):
+        return Catalog.load(workflows)['configs'].get('{}|{}'.format(flowcell, library), list())
+
+    @staticmethod
+    def is_valid(category, item):
+        return item in Catalog.load()['sets'][category]
+
+    @staticmethod
+    def get_list(category):
+        return Catalog.load()[category]
@@ -0,0 +1,366 @@
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import signal
+import importlib
+import threading
+import traceback
+import subprocess
+import multiprocessing
+from concurrent import futures
+from metrics import Metrics
+from process_engine import ProcessEngine, ProcessError
+from basecall_nanopore_methods import Methods
+
+
+class ExecutorError(Exception):
+    pass
+
+
+class JobSpec(object):
+    """
+    A pipeline function call that can run in another process or on another node: the function is found again from
+    its module and qualified name, and the settings of the pipeline (output format and compression, tool timeout and
+    retries) are applied before calling it.
+    """
+
+    @staticmethod
+    def make(func, args):
+        return {'module': func.__module__,
+                'function': func.__qualname__,
+                'args': list(args),
+                'settings': {'bgzf': Methods.bgzf,
+                             'intermediate': Methods.intermediate,
+                             'limits': dict(ProcessEngine.limits),
+                             'timeout': ProcessEngine.timeout,
+                             'retries': ProcessEngine.retries}}
+
+    @staticmethod
+    def apply_settings(settings):
+        Methods.bgzf = settings['bgzf']
+        Methods.intermediate = settings['intermediate']
+        ProcessEngine.configure(limits=settings['limits'], timeout=settings['timeout'],
+                                retries=settings['retries'])
+
+    @staticmethod
+    def call(spec):
+        """
+        Run the function of the spec and return its result, along with the metrics of the external processes it
+        ran and of the files it compressed, so they can be added to the metrics of the run.
+        """
+        JobSpec.apply_settings(spec['settings'])
+        func = importlib.import_module(spec['module'])
+        for name in spec['function'].split('.'):
+            func = getattr(func, name)
+        return Metrics.collect(func, *spec['args'])
+
+
+class LocalExecutor(object):
+    """
+    Run the node functions in a pool of worker processes on this computer. The workers are started fresh
+    ("spawn"), not forked from the pipeline and its threads.
+    """
+
+    remote = False  # Nodes use the threads and memory of this computer
+
+    def __init__(self, max_workers):
+        self.pool = futures.ProcessPoolExecutor(max_workers=max(1, int(max_workers)),
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=LocalExecutor.init_worker)
+
+    @staticmethod
+    def init_worker():
+        # The tools started by a worker are in their own process groups, kill them with it
+        def terminate(signum, frame):
+            ProcessEngine.cancel_all()
+            os._exit(1)
+        signal.signal(signal.SIGTERM, terminate)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C is handled by the pipeline
+
+    def run(self, name, func, args, mem=0):
+        result, metrics = self.pool.submit(JobSpec.call, JobSpec.make(func, args)).result()
+        Metrics.merge(metrics, name)
+        return result
+
+    def cancel_all(self):
+        # Private attribute, but the only way to stop a worker in the middle of a job
+        for process in list((self.pool._processes or dict()).values()):
+            process.terminate()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class BatchExecutor(object):
+    """
+    Run each node as a job of a batch scheduler (SLURM by default): the function call is written to a job folder
+    with a script that runs it, the script is submitted, and the state of the job is polled until it ends. The
+    worker writes a result file, which tells whether the job succeeded, whatever the scheduler says.
+
+    The job folder must be visible from the cluster nodes, as well as this package and the tools. With staging,
+    the input files of the node are copied to the job folder and its output folders are written there, then copied
+    back when the job succeeds, so the output folder of the pipeline does not need to be shared.
+
+    The commands are lists of arguments with placeholders ({name}, {threads}, {mem}, {log}, {script},
+    {job_folder} and {job_id}), so any scheduler (or a fake one for tests) can be used from a json config file.
+    """
+
+    remote = True  # Nodes do not use the threads and memory of this computer
+
+    defaults = {'submit': ['sbatch', '--parsable', '--job-name', '{name}', '--cpus-per-task', '{threads}',
+                           '--mem', '{mem}G', '--output', '{log}', '{script}'],
+                'status': ['squeue', '--noheader', '--jobs', '{job_id}', '--format', '%T'],
+                'final_status': ['sacct', '--noheader', '--parsable2', '--jobs', '{job_id}', '--format', 'State'],
+                'cancel': ['scancel', '{job_id}'],
+                'threads': 8,  # CPUs per job
+                'mem': 0,  # GB per job, 0 for the estimate of the node (at least 4)
+                'max_jobs': 0,  # Jobs submitted at the same time, 0 for no limit
+                'poll_interval': 10,  # Seconds between two status checks
+                'lost_timeout': 120,  # Seconds a job can be unknown to the scheduler without a result file
+                'retries': 1,  # Number of times a failed job is submitted again
+                'stage': False,  # Copy the inputs and outputs through the job folder
+                'python': sys.executable,
+                'setup': ''}  # Shell commands run before the worker (e.g. "module load porechop filtlong")
+
+    # States of a job still to wait for, the others mean it ended
+    active_states = {'PENDING', 'CONFIGURING', 'RUNNING', 'COMPLETING', 'SUSPENDED', 'REQUEUED', 'RESIZING',
+                     'STAGE_OUT', 'SIGNALING'}
+
+    def __init__(self, job_folder, config_file=None):
+        self.config = dict(BatchExecutor.defaults)
+        if config_file:
+            with open(config_file, 'r') as f:
+                self.config.update(json.load(f))
+        self.job_folder = os.path.abspath(self.config.get('job_folder', job_folder))
+        self.threads = int(self.config['threads'])
+        self.lock = threading.Lock()
+        self.jobs = dict()  # {job id: node name}, submitted and not finished
+        self.stopped = False
+        self.slots = threading.Semaphore(self.config['max_jobs']) if self.config['max_jobs'] else None
+
+    @staticmethod
+    def format_cmd(template, **values):
+        return [str(x).format(**values) for x in template]
+
+    def command(self, key, **values):
+        # Output of a scheduler command, which is retried once since schedulers can be briefly unavailable
+        cmd = BatchExecutor.format_cmd(self.config[key], **values)
+        for attempt in range(2):
+            try:
+                p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=60)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                error = str(e)
+            else:
+                if p.returncode == 0:
+                    return p.stdout
+                error = p.stderr.strip()
+            if attempt == 0:
+                time.sleep(self.config['poll_interval'])
+        raise ExecutorError('"{}" failed: {}'.format(' '.join(cmd), error))
+
+    @staticmethod
+    def stage_in(args, stage_folder):
+        """
+        Replace the input files of the arguments by copies in the stage folder, and the output folders by empty
+        folders in the stage folder. Return the new arguments and the {staged folder: output folder} to copy back.
+        """
+        staged_args = list()
+        copy_back = dict()
+        for i, arg in enumerate(args):
+            if isinstance(arg, str) and os.path.isfile(arg):
+                staged = os.path.join(stage_folder, 'inputs', '{}_{}'.format(i, os.path.basename(arg)))
+                os.makedirs(os.path.dirname(staged), exist_ok=True)
+                shutil.copyfile(arg, staged)
+                arg = staged
+            elif isinstance(arg, str) and os.path.isdir(arg):
+                staged = os.path.join(stage_folder, 'outputs', str(i)) + ('/' if arg.endswith('/') else '')
+                os.makedirs(staged, exist_ok=True)
+                copy_back[staged] = arg
+                arg = staged
+            staged_args.append(arg)
+        return staged_args, copy_back
+
+    @staticmethod
+    def stage_out(copy_back, result):
+        # Copy the outputs back, and return the result with the paths of the outputs instead of the staged ones
+        for staged, folder in copy_back.items():
+            shutil.copytree(staged, folder, dirs_exist_ok=True)
+        if isinstance(result, list):
+            for staged, folder in copy_back.items():
+                result = [folder + x[len(staged):] if isinstance(x, str) and x.startswith(staged) else x
+                          for x in result]
+        return result
+
+    def write_job(self, name, func, args, job_dir):
+        # Spec of the call, and the script submitted to the scheduler
+        with open(os.path.join(job_dir, 'job.pkl'), 'wb') as f:
+            pickle.dump(JobSpec.make(func, args), f)
+        script = os.path.join(job_dir, 'job.sh')
+        with open(script, 'w') as f:
+            f.write('#!/bin/bash\n'
+                    '# {}\n'
+                    '{}\n'
+                    'cd "{}"\n'
+                    'exec "{}" "{}" "{}"\n'.format(name, self.config['setup'], job_dir, self.config['python'],
+                                                   os.path.abspath(__file__), job_dir))
+        os.chmod(script, 0o755)
+        return script
+
+    def submit(self, name, script, job_dir, mem):
+        output = self.command('submit', name=name, threads=self.threads, mem=mem, script=script,
+                              log=os.path.join(job_dir, 'job.log'), job_folder=job_dir).strip()
+        job_id = output.split(';')[0].split()[-1] if output else ''  # "id;cluster" with --parsable
+        if not job_id:
+            raise ExecutorError('No job id returned when submitting {}.'.format(name))
+        return job_id
+
+    def state(self, job_id):
+        # Scheduler state of the job, '' if the scheduler does not know it (anymore)
+        try:
+            output = self.command('status', job_id=job_id).split()
+        except ExecutorError:
+            output = list()  # squeue fails on jobs that ended a while ago
+        if not output and self.config.get('final_status'):
+            try:
+                output = self.command('final_status', job_id=job_id).split()
+            except ExecutorError:
+                output = list()
+        return output[0].split('+')[0].upper() if output else ''  # "CANCELLED+" or "CANCELLED by 1234"
+
+    @staticmethod
+    def read_result(job_dir):
+        result_file = os.path.join(job_dir, 'result.json')
+        if not os.path.exists(result_file):
+            return None
+        with open(result_file, 'r') as f:
+            return json.load(f)
+
+    def wait(self, name, job_id, job_dir):
+        # Poll until the result file is written or the job is gone without one
+        unknown_since = None
+        while True:
+            if self.stopped:
+                raise ExecutorError('{} cancelled.'.format(name))
+            result = BatchExecutor.read_result(job_dir)
+            if result:
+                return result
+            state = self.state(job_id)
+            if state in BatchExecutor.active_states:
+                unknown_since = None
+            elif not state or state == 'COMPLETED':
+                # Not listed yet or anymore, or the result file is not visible yet on a network file system
+                unknown_since = unknown_since or time.time()
+                if time.time() - unknown_since > self.config['lost_timeout']:
+                    return {'status': 'failed', 'error': 'Job {} ended without a result.'.format(job_id)}
+            else:
+                time.sleep(1)  # Result written just before the job ended
+                return BatchExecutor.read_result(job_dir) or \
+                    {'status': 'failed', 'error': 'Job {} ended with state {}.'.format(job_id, state)}
+            time.sleep(self.config['poll_interval'])
+
+    def run_once(self, name, func, args, job_dir, mem):
+        shutil.rmtree(job_dir, ignore_errors=True)
+        os.makedirs(job_dir)
+        copy_back = dict()
+        if self.config['stage']:
+            args, copy_back = BatchExecutor.stage_in(args, job_dir)
+        script = self.write_job(name, func, args, job_dir)
+
+        with self.lock:
+            if self.stopped:
+                raise ExecutorError('{} cancelled.'.format(name))
+            job_id = self.submit(name, script, job_dir, mem)
+            self.jobs[job_id] = name
+        print('\t{}: submitted as job {}\n'.format(name, job_id), end='')
+        try:
+            result = self.wait(name, job_id, job_dir)
+        finally:
+            with self.lock:
+                self.jobs.pop(job_id, None)
+        if result['status'] == 'done':
+            result['result'] = BatchExecutor.stage_out(copy_back, result.get('result'))
+        return job_id, result
+
+    def run(self, name, func, args, mem=0):
+        """
+        Run func(*args) as a cluster job and return its result. Failed jobs are submitted again, then
+        ExecutorError is raised with the error of the last attempt.
+        """
+        mem = self.config['mem'] if self.config['mem'] else max(4, int(mem + 0.999))
+        job_dir = os.path.join(self.job_folder, name.replace(':', '_').replace('/', '_'))
+        if self.slots:
+            self.slots.acquire()
+        try:
+            for attempt in range(self.config['retries'] + 1):
+                job_id, result = self.run_once(name, func, args, job_dir, mem)
+                if result['status'] == 'done':
+                    break
+                if self.stopped:
+                    raise ExecutorError('{} cancelled.'.format(name))
+                if attempt < self.config['retries']:
+                    print('\t{} failed on the cluster (job {}), retrying ({}/{})\n'.format(
+                        name, job_id, attempt + 1, self.config['retries']), end='')
+            else:
+                raise ExecutorError('{} failed on the cluster (job {}): {} Job log: {}'.format(
+                    name, job_id, (result['error'].strip().splitlines() or [''])[-1], os.path.join(job_dir, 'job.log')))
+        finally:
+            if self.slots:
+                self.slots.release()
+
+        Metrics.merge(result.get('metrics', dict()), name)
+        shutil.rmtree(job_dir, ignore_errors=True)  # Kept when failed, to see what happened
+        return result.get('result')
+
+    def cancel_all(self):
+        with self.lock:
+            self.stopped = True
+            job_list = list(self.jobs)
+        for job_id in job_list:
+            try:
+                self.command('cancel', job_id=job_id)
+            except ExecutorError as e:
+                print('\tCould not cancel job {}: {}'.format(job_id, e))
+
+
+class Executors(object):
+    # Backends to run the per-sample nodes with, "thread" runs them in the pipeline process
+    choices = ['thread', 'local', 'batch']
+
+    @staticmethod
+    def get(name, max_workers, job_folder, config_file=None):
+        if name == 'local':
+            return LocalExecutor(max_workers)
+        if name == 'batch':
+            return BatchExecutor(job_folder, config_file)
+        return None
+
+
+def run_worker(job_dir):
+    # Entry point of a cluster job: run the call of the job folder and write the result file
+    with open(os.path.join(job_dir, 'job.pkl'), 'rb') as f:
+        spec = pickle.load(f)
+    try:
+        result, metrics = JobSpec.call(spec)
+        record = {'status': 'done', 'result': result, 'metrics': metrics}
+    except (Exception, KeyboardInterrupt) as e:
+        traceback.print_exc()
+        ProcessEngine.cancel_all()
+        record = {'status': 'failed',
+                  'error': str(e) if isinstance(e, ProcessError) else traceback.format_exc()}
+    tmp_file = os.path.join(job_dir, 'result.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_file, os.path.join(job_dir, 'result.json'))
+    return 0 if record['status'] == 'done' else 1
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit('Usage: python executors.py /path/to/job_folder/')
+
+    # The scheduler cancels with SIGTERM: stop the tools and write the failed result
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+    sys.exit(run_worker(os.path.abspath(sys.argv[1])))
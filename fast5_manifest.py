@@ -0,0 +1,110 @@
+import os
+import json
+import time
+from concurrent import futures
+
+
+class Fast5Manifest(object):
+    """
+    Scan the input folder for fast5 files with os.scandir, one directory level at a time with a pool of threads,
+    which helps a lot on network storage. The result ({path: (size, mtime)}) is saved in a manifest file along with
+    the modification time of each directory. Next scans are incremental: a directory that did not change since the
+    previous scan is not listed again, and only its files that were still recent at that time are checked again.
+    """
+
+    version = 1
+    threads = 16  # Scanning is I/O bound
+    settle_time = 60  # Seconds after which a fast5 file is not expected to change anymore
+
+    @staticmethod
+    def load(manifest_file, input_folder, recursive):
+        if not manifest_file or not os.path.exists(manifest_file):
+            return None
+        try:
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+        except ValueError:
+            return None  # Corrupted, full scan
+        if manifest.get('version') != Fast5Manifest.version or manifest.get('input') != input_folder \
+                or manifest.get('recursive') != recursive:
+            return None
+        return manifest
+
+    @staticmethod
+    def save(manifest, manifest_file):
+        tmp_file = manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(json.dumps(manifest))  # Much faster than json.dump, which is not using the C encoder
+        os.replace(tmp_file, manifest_file)
+
+    @staticmethod
+    def scan_folder(folder, previous, stable_before):
+        # Return the record of one directory: {'mtime', 'subdirs', 'files': {name: [size, mtime]}}
+        try:
+            folder_mtime = os.stat(folder).st_mtime
+        except FileNotFoundError:
+            return None
+
+        if previous and previous['mtime'] == folder_mtime and folder_mtime < stable_before:
+            # No file added, removed or renamed since the previous scan
+            files = dict()
+            for name, (size, mtime) in previous['files'].items():
+                if mtime < stable_before:
+                    files[name] = [size, mtime]
+                    continue
+                try:
+                    stat = os.stat(os.path.join(folder, name))  # Could still be written to
+                except FileNotFoundError:
+                    continue
+                files[name] = [stat.st_size, stat.st_mtime]
+            return {'mtime': folder_mtime, 'subdirs': previous['subdirs'], 'files': files}
+
+        subdirs, files = list(), dict()
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        elif entry.name.endswith('.fast5') and entry.is_file():
+                            stat = entry.stat()
+                            files[entry.name] = [stat.st_size, stat.st_mtime]
+                    except FileNotFoundError:  # File moved or deleted by MinKNOW between listing and stat
+                        continue
+        except FileNotFoundError:
+            return None
+        return {'mtime': folder_mtime, 'subdirs': sorted(subdirs), 'files': files}
+
+    @staticmethod
+    def scan(input_folder, recursive, manifest_file=None, threads=None):
+        # Return {path: (size, mtime)} for all the fast5 files currently in the input folder
+        input_folder = input_folder.rstrip('/')
+        scan_time = time.time()
+        manifest = Fast5Manifest.load(manifest_file, input_folder, recursive)
+        previous_dirs = manifest['dirs'] if manifest else dict()
+        stable_before = manifest['scanned'] - Fast5Manifest.settle_time if manifest else 0
+
+        dirs = dict()
+        level = [input_folder]
+        with futures.ThreadPoolExecutor(max_workers=threads if threads else Fast5Manifest.threads) as executor:
+            while level:
+                records = executor.map(Fast5Manifest.scan_folder, level,
+                                       [previous_dirs.get(x) for x in level], [stable_before] * len(level))
+                next_level = list()
+                for folder, record in zip(level, records):
+                    if record is None:
+                        continue
+                    dirs[folder] = record
+                    if recursive:
+                        next_level += [os.path.join(folder, x) for x in record['subdirs']]
+                level = next_level
+
+        if manifest_file:
+            Fast5Manifest.save({'version': Fast5Manifest.version,
+                                'input': input_folder,
+                                'recursive': recursive,
+                                'scanned': scan_time,
+                                'dirs': dirs}, manifest_file)
+
+        return {os.path.join(folder, name): tuple(stat)
+                for folder, record in dirs.items() for name, stat in record['files'].items()}
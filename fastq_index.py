@@ -0,0 +1,307 @@
+import os
+import gzip
+import zlib
+import struct
+import threading
+from argparse import ArgumentParser
+import numpy as np
+
+
+class FastqIndex(object):
+    """
+    BGZF-compressed fastq with a per-read index, for random access without decompressing the whole file.
+
+    BGZF is gzip made of independent blocks of at most 64 KB, so any gzip reader can read it. A position in the
+    file is a "virtual offset": offset of the block in the compressed file << 16 | offset in the uncompressed
+    block. The index ("<fastq>.fqi") is a tab-separated file with one line per read: read id, virtual offset,
+    length and mean quality (Phred score of the mean error probability, like the Guppy "mean_qscore").
+    """
+
+    extension = '.fqi'
+    block_size = 65280  # Uncompressed bytes per block, as htslib
+    eof = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')  # Empty last block
+    header = '#read_id\tvirtual_offset\tlength\tmean_q\n'
+
+    # Error probability of each Phred+33 character
+    error_table = np.array([10 ** (-max(i - 33, 0) / 10) for i in range(256)], dtype=np.float64)
+
+    @staticmethod
+    def index_file(fastq):
+        return fastq + FastqIndex.extension
+
+    @staticmethod
+    def is_bgzf(fastq):
+        with open(fastq, 'rb') as f:
+            header = f.read(16)
+        return len(header) == 16 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+    @staticmethod
+    def compress_block(data, level=6):
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)  # Raw deflate, the header is written here
+        deflated = c.compress(data) + c.flush()
+        # BSIZE: total block size - 1
+        return (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+                + struct.pack('<H', len(deflated) + 25) + deflated
+                + struct.pack('<II', zlib.crc32(data), len(data)))
+
+    @staticmethod
+    def compress_chunk(chunk, level=6):
+        # Return the BGZF blocks of a chunk and the (uncompressed, compressed) size of each block
+        blocks, sizes = list(), list()
+        for start in range(0, len(chunk), FastqIndex.block_size):
+            data = chunk[start:start + FastqIndex.block_size]
+            block = FastqIndex.compress_block(data, level)
+            blocks.append(block)
+            sizes.append((len(data), len(block)))
+        return b''.join(blocks), sizes
+
+    @staticmethod
+    def iter_blocks(fastq):
+        # Yield the uncompressed data and the (uncompressed, compressed) size of each block of a BGZF file
+        with open(fastq, 'rb') as f:
+            while True:
+                header = f.read(18)
+                if not header:
+                    return
+                if len(header) < 18 or header[12:14] != b'BC':
+                    raise Exception('Not a BGZF file: {}'.format(fastq))
+                block_size = struct.unpack('<H', header[16:18])[0] + 1
+                body = f.read(block_size - 18)
+                data = zlib.decompress(body[:-8], -15)
+                yield data, (len(data), block_size)
+
+    @staticmethod
+    def write(index_file, read_ids, voffsets, lengths, mean_q):
+        tmp_file = index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(FastqIndex.header)
+            f.write(''.join('{}\t{}\t{}\t{:.2f}\n'.format(*x) for x in zip(read_ids, voffsets.tolist(),
+                                                                         lengths.tolist(), mean_q.tolist())))
+        os.replace(tmp_file, index_file)
+
+    @staticmethod
+    def load(fastq):
+        # Return the read ids (list) and the virtual offsets, lengths and mean qualities (NumPy arrays)
+        with open(FastqIndex.index_file(fastq), 'r') as f:
+            rows = [x.split('\t') for x in f.read().split('\n')[1:] if x]
+        read_ids = [x[0] for x in rows]
+        voffsets = np.fromiter((int(x[1]) for x in rows), dtype=np.int64, count=len(rows))
+        lengths = np.fromiter((int(x[2]) for x in rows), dtype=np.int64, count=len(rows))
+        mean_q = np.fromiter((float(x[3]) for x in rows), dtype=np.float32, count=len(rows))
+        return read_ids, voffsets, lengths, mean_q
+
+    @staticmethod
+    def merge(fastq_list, merged_fastq):
+        """
+        Index of BGZF files concatenated in that order: the virtual offsets of each file are shifted by the
+        compressed size of the files before it. Call before the files are deleted.
+        """
+        id_list, voffset_list, length_list, mean_q_list = list(), list(), list(), list()
+        shift = 0
+        for fastq in fastq_list:
+            read_ids, voffsets, lengths, mean_q = FastqIndex.load(fastq)
+            id_list += read_ids
+            voffset_list.append(voffsets + (shift << 16))
+            length_list.append(lengths)
+            mean_q_list.append(mean_q)
+            shift += os.path.getsize(fastq)
+        if not voffset_list:
+            return
+        FastqIndex.write(FastqIndex.index_file(merged_fastq), id_list, np.concatenate(voffset_list),
+                         np.concatenate(length_list), np.concatenate(mean_q_list))
+
+    @staticmethod
+    def build(fastq, threads=1, level=6):
+        # Index an existing file. A plain gzip file is recompressed to BGZF first.
+        if FastqIndex.is_bgzf(fastq):
+            indexer = Indexer()
+            for data, size in FastqIndex.iter_blocks(fastq):
+                indexer.feed(data)
+                indexer.add_block(*size)
+            indexer.write(FastqIndex.index_file(fastq))
+            return
+        from basecall_nanopore_methods import Methods  # Avoid circular import
+        opener = gzip.open if fastq.endswith('.gz') else open
+        with opener(fastq, 'rb') as f:
+            Methods.compress_stream(f, fastq + '.tmp', threads, level=level, bgzf=True,
+                                    index_file=FastqIndex.index_file(fastq))
+        os.replace(fastq + '.tmp', fastq)
+
+    @staticmethod
+    def read_records(fastq, voffsets):
+        # Yield the records (bytes) at the given virtual offsets, in that order
+        from pysam.libcbgzf import BGZFile
+        with BGZFile(fastq, 'rb') as f:
+            for voffset in voffsets:
+                f.seek(int(voffset))
+                yield b'%s\n%s\n%s\n%s\n' % (f.readline(), f.readline(), f.readline(), f.readline())
+
+    @staticmethod
+    def get_reads(fastq, read_id_list):
+        # Return {read_id: record} for the requested reads found in the file
+        read_ids, voffsets, _, _ = FastqIndex.load(fastq)
+        position = {x: i for i, x in enumerate(read_ids)}
+        found = sorted((voffsets[position[x]], x) for x in set(read_id_list) if x in position)
+        return dict(zip((x[1] for x in found), FastqIndex.read_records(fastq, [x[0] for x in found])))
+
+    @staticmethod
+    def write_reads(fastq, voffsets, out_fastq, threads=1):
+        # Records read in file order (mostly sequential reads), written as BGZF with their own index
+        from basecall_nanopore_methods import Methods  # Avoid circular import
+        read_fd, write_fd = os.pipe()
+
+        error = list()  # Of the writer thread
+
+        def writer():
+            try:
+                with os.fdopen(write_fd, 'wb') as f:
+                    for record in FastqIndex.read_records(fastq, np.sort(voffsets)):
+                        f.write(record)
+            except BaseException as e:
+                error.append(e)
+
+        t = threading.Thread(target=writer)
+        t.start()
+        with os.fdopen(read_fd, 'rb') as f:
+            Methods.compress_stream(f, out_fastq + '.tmp', threads, bgzf=True,
+                                    index_file=FastqIndex.index_file(out_fastq + '.tmp'))
+        t.join()
+        if error:
+            # Input stopped early: the output is truncated and must not be kept
+            raise error[0]
+        os.replace(FastqIndex.index_file(out_fastq + '.tmp'), FastqIndex.index_file(out_fastq))
+        os.replace(out_fastq + '.tmp', out_fastq)
+
+    @staticmethod
+    def extract(fastq, read_id_list, out_fastq, threads=1):
+        # Write the requested reads to a new file. Return the number of reads found.
+        read_ids, voffsets, _, _ = FastqIndex.load(fastq)
+        wanted = set(read_id_list)
+        selected = voffsets[np.fromiter((x in wanted for x in read_ids), dtype=bool, count=len(read_ids))]
+        FastqIndex.write_reads(fastq, selected, out_fastq, threads)
+        return len(selected)
+
+    @staticmethod
+    def subsample(fastq, out_fastq, n_reads=None, fraction=None, target_bases=None, min_length=0, min_q=0,
+                  seed=1, threads=1):
+        """
+        Uniform random subsample (without replacement) of the reads passing min_length and min_q: n_reads reads,
+        a fraction of the reads, or reads until target_bases bases. Only the index and the selected reads are
+        read. Return the number of reads and bases written.
+        """
+        _, voffsets, lengths, mean_q = FastqIndex.load(fastq)
+        candidates = np.flatnonzero((lengths >= min_length) & (mean_q >= min_q))
+        order = np.random.default_rng(seed).permutation(candidates)
+        if n_reads is not None:
+            order = order[:n_reads]
+        elif fraction is not None:
+            order = order[:int(round(len(order) * fraction))]
+        if target_bases is not None:
+            bases_before = np.cumsum(lengths[order]) - lengths[order]
+            order = order[bases_before < target_bases]
+        FastqIndex.write_reads(fastq, voffsets[order], out_fastq, threads)
+        return len(order), int(lengths[order].sum())
+
+
+class Indexer(object):
+    # Build the index of a fastq stream as it is compressed: feed() the uncompressed data, add_block() each block
+
+    def __init__(self):
+        self.leftover = b''
+        self.offset = 0  # Uncompressed offset of the leftover
+        self.read_ids = list()
+        self.starts = list()  # Uncompressed offset of the reads, per chunk
+        self.lengths = list()
+        self.mean_q = list()
+        self.blocks = list()  # (uncompressed, compressed) size of each block
+
+    def feed(self, chunk):
+        lines = (self.leftover + chunk).split(b'\n')
+        n_complete = (len(lines) - 1) // 4 * 4
+        if n_complete:
+            self.add_records(lines[:n_complete])
+        self.leftover = b'\n'.join(lines[n_complete:])
+
+    def add_records(self, lines):
+        line_sizes = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines)) + 1
+        record_sizes = line_sizes.reshape(-1, 4).sum(axis=1)
+        self.starts.append(self.offset + np.cumsum(record_sizes) - record_sizes)
+        self.offset += int(record_sizes.sum())
+        self.read_ids += [x[1:].split(None, 1)[0].decode() if len(x) > 1 else '' for x in lines[0::4]]
+
+        qual_list = lines[3::4]
+        lengths = line_sizes[3::4] - 1
+        errors = FastqIndex.error_table[np.frombuffer(b''.join(qual_list), dtype=np.uint8)]
+        mean_q = np.zeros(len(qual_list), dtype=np.float64)
+        non_empty = lengths > 0
+        if non_empty.any():
+            starts = np.cumsum(lengths) - lengths
+            mean_error = np.add.reduceat(errors, starts[non_empty]) / lengths[non_empty]
+            mean_q[non_empty] = -10 * np.log10(np.maximum(mean_error, 1e-10))
+        self.lengths.append(lengths)
+        self.mean_q.append(mean_q)
+
+    def add_block(self, uncompressed_size, compressed_size):
+        self.blocks.append((uncompressed_size, compressed_size))
+
+    def write(self, index_file):
+        if self.leftover.strip():
+            self.feed(b'\n')  # No newline at the end of the file
+        if self.leftover.strip():
+            raise Exception('Truncated fastq, could not index {}'.format(index_file))
+        block_sizes = np.array(self.blocks, dtype=np.int64).reshape(-1, 2)
+        block_ustarts = np.cumsum(block_sizes[:, 0]) - block_sizes[:, 0]
+        block_cstarts = np.cumsum(block_sizes[:, 1]) - block_sizes[:, 1]
+        starts = np.concatenate(self.starts) if self.starts else np.zeros(0, dtype=np.int64)
+        # Block of each read: last block starting at or before it
+        block = np.searchsorted(block_ustarts, starts, side='right') - 1
+        voffsets = (block_cstarts[block] << 16) | (starts - block_ustarts[block])
+        FastqIndex.write(index_file, self.read_ids, voffsets,
+                         np.concatenate(self.lengths) if self.lengths else np.zeros(0, dtype=np.int64),
+                         np.concatenate(self.mean_q) if self.mean_q else np.zeros(0))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Index, extract reads from and subsample BGZF fastq files.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    index_parser = subparsers.add_parser('index', help='Index a fastq file. Plain gzip files are recompressed '
+                                                       'to BGZF.')
+    index_parser.add_argument('fastq', nargs='+')
+    index_parser.add_argument('-t', '--threads', type=int, default=1,
+                              help='Number of compression threads. Default is 1. Optional.')
+    extract_parser = subparsers.add_parser('extract', help='Extract reads by id.')
+    extract_parser.add_argument('fastq')
+    extract_parser.add_argument('-r', '--read-ids', metavar='/path/to/read_ids.txt', required=True,
+                                help='File with one read id per line. Mandatory.')
+    extract_parser.add_argument('-o', '--output', metavar='/path/to/output.fastq.gz', required=True,
+                                help='Output fastq. Mandatory.')
+    subsample_parser = subparsers.add_parser('subsample', help='Random subsample of the reads.')
+    subsample_parser.add_argument('fastq')
+    subsample_parser.add_argument('-o', '--output', metavar='/path/to/output.fastq.gz', required=True,
+                                  help='Output fastq. Mandatory.')
+    subsample_parser.add_argument('-n', '--reads', type=int,
+                                  help='Number of reads. Optional.')
+    subsample_parser.add_argument('-f', '--fraction', type=float,
+                                  help='Fraction of the reads. Optional.')
+    subsample_parser.add_argument('-b', '--target-bases', type=float,
+                                  help='Number of bases (e.g. 5e8). Optional.')
+    subsample_parser.add_argument('-l', '--min-length', type=int, default=0,
+                                  help='Only sample reads at least that long. Default is 0. Optional.')
+    subsample_parser.add_argument('-q', '--min-q', type=float, default=0,
+                                  help='Only sample reads with at least that mean quality. Default is 0. Optional.')
+    subsample_parser.add_argument('-s', '--seed', type=int, default=1,
+                                  help='Random seed. Default is 1. Optional.')
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        for fastq_file in args.fastq:
+            FastqIndex.build(fastq_file, args.threads)
+    elif args.command == 'extract':
+        with open(args.read_ids, 'r') as f:
+            id_list = [x.strip().lstrip('@') for x in f if x.strip()]
+        print('{} reads extracted'.format(FastqIndex.extract(args.fastq, id_list, args.output)))
+    else:
+        n, bases = FastqIndex.subsample(args.fastq, args.output, args.reads, args.fraction,
+                                        int(args.target_bases) if args.target_bases else None, args.min_length,
+                                        args.min_q, args.seed)
+        print('{} reads, {} bases'.format(n, bases))
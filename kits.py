@@ -141,3 +141,37 @@ class Kits(object):
                                'rna_r9.4.1_70bps_hac.cfg',
                                'rna_r9.4.1_70bps_hac_mk1c.cfg',
                                'rna_r9.4.1_70bps_hac_prom.cfg']
+
+    # Adapter sequences (start, end) used by the built-in trimmer. Same sequences as Porechop.
+    adapter_dict = {'SQK-NSK007': ('AATGTACTTCGTTCAGTTACGTATTGCT', 'GCAATACGTAACTGAACGAAGT'),
+                    'Rapid': ('TTTTTTTTCCTGTACTTCGTTCAGTTACGTATTGCT', ''),
+                    'RBK004_upstream': ('AATGTACTTCGTTCAGTTACGGCTTGGGTGTTTAACC', ''),
+                    'SQK-MAP006': ('GGTTGTTTCTGTTGGTGCTGATATTGCT', 'GCAATATCAGCACCAACAGAAA'),
+                    'SQK-MAP006 short': ('GGTTGTTTCTGTTGGTGCTG', 'CAGCACCAACAGAAACAACC'),
+                    'PCR adapters 1': ('ACTTGCCTGTCGCTCTATCTTC', 'GAAGATAGAGCGACAGGCAAGT'),
+                    'PCR adapters 2': ('TTTCTGTTGGTGCTGATATTGCTGCCATTACGGCCGGG',
+                                       'CCCGGCCGTAATGGCAGCAATATCAGCACCAACAGAAA'),
+                    'PCR adapters 3': ('TACTTGCCTGTCGCTCTATCTTC', 'GAAGATAGAGCGACAGGCAAGTA')}
+
+    # Adapter sets to look for, based on the library kit prefix. All adapters are used for other or unknown kits.
+    kit_adapter_dict = {'SQK-LSK': ['SQK-NSK007'],
+                        'SQK-NBD': ['SQK-NSK007'],
+                        'SQK-LWB': ['SQK-NSK007'],
+                        'SQK-RAD': ['Rapid', 'RBK004_upstream'],
+                        'SQK-RBK': ['Rapid', 'RBK004_upstream'],
+                        'SQK-RAB': ['Rapid', 'RBK004_upstream'],
+                        'SQK-RLB': ['Rapid', 'RBK004_upstream'],
+                        'SQK-ULK': ['Rapid', 'RBK004_upstream'],
+                        'SQK-RPB': ['Rapid', 'RBK004_upstream', 'PCR adapters 1', 'PCR adapters 2', 'PCR adapters 3'],
+                        'SQK-PCB': ['SQK-NSK007', 'PCR adapters 1', 'PCR adapters 2', 'PCR adapters 3'],
+                        'SQK-PCS': ['SQK-NSK007', 'PCR adapters 1', 'PCR adapters 2', 'PCR adapters 3'],
+                        'SQK-PBK': ['SQK-NSK007', 'PCR adapters 1', 'PCR adapters 2', 'PCR adapters 3'],
+                        'SQK-DCS': ['SQK-NSK007', 'PCR adapters 1', 'PCR adapters 2', 'PCR adapters 3']}
+
+    @staticmethod
+    def get_adapters(library_kit):
+        if library_kit:
+            for prefix, adapter_list in Kits.kit_adapter_dict.items():
+                if library_kit.startswith(prefix):
+                    return {x: Kits.adapter_dict[x] for x in adapter_list}
+        return dict(Kits.adapter_dict)
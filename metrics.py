@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+import psutil
+
+
+class ProcessMonitor(object):
+    """
+    Resource usage of an external process and its children. Peak memory and I/O are sampled with psutil while
+    the process runs. CPU time and I/O totals are also taken from the rusage returned by wait4 when the process
+    ends, which includes the children that already exited. The rusage peak memory is not used, as on Linux it
+    includes the memory of this pipeline at the time of the fork.
+    """
+
+    interval = 0.5  # Seconds between samples
+
+    def __init__(self, name, popen, stage=None):
+        self.name = name
+        self.stage = stage if stage else Metrics.current_stage()
+        self.popen = popen
+        self.start_time = time.time()
+        self.peak_rss = 0
+        self.cpu = dict()  # {pid: user + system seconds}, last sample of each process of the tree
+        self.io = dict()  # {pid: (read bytes, write bytes)}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        try:
+            parent = psutil.Process(self.popen.pid)
+        except psutil.Error:
+            return
+        while True:
+            try:
+                rss = 0
+                for p in [parent] + parent.children(recursive=True):
+                    try:
+                        with p.oneshot():
+                            rss += p.memory_info().rss
+                            cpu_times = p.cpu_times()
+                            self.cpu[p.pid] = cpu_times.user + cpu_times.system
+                            io = p.io_counters()
+                            self.io[p.pid] = (io.read_bytes, io.write_bytes)
+                    except (psutil.Error, AttributeError):  # Exited, or no I/O counters on this system
+                        continue
+                self.peak_rss = max(self.peak_rss, rss)
+            except psutil.Error:
+                pass
+            if self.stop_event.wait(ProcessMonitor.interval):
+                return
+
+    def wait(self):
+        # Use instead of Popen.wait(), to get the resource usage of the process and its reaped children
+        _, status, usage = os.wait4(self.popen.pid, 0)
+        self.popen.returncode = os.waitstatus_to_exitcode(status)
+        self.stop_event.set()
+        self.thread.join()
+
+        record = {'name': self.name,
+                  'stage': self.stage,
+                  'command': ' '.join(str(x) for x in self.popen.args) if isinstance(self.popen.args, list)
+                  else str(self.popen.args),
+                  'start': self.start_time,
+                  'wall_seconds': round(time.time() - self.start_time, 3),
+                  'cpu_seconds': round(max(usage.ru_utime + usage.ru_stime, sum(self.cpu.values())), 3),
+                  'peak_rss_bytes': self.peak_rss,
+                  'read_bytes': max(sum(x[0] for x in self.io.values()), usage.ru_inblock * 512),
+                  'write_bytes': max(sum(x[1] for x in self.io.values()), usage.ru_oublock * 512),
+                  'exit_code': self.popen.returncode}
+        Metrics.add('processes', record)
+        return self.popen.returncode
+
+
+class Metrics(object):
+    """
+    Run metrics: wall and CPU time of each pipeline stage, wall time, CPU time, peak RSS, read/write bytes and
+    exit code of each external process, level, sizes and CPU time of each fastq compressed by the pipeline, and
+    size on disk of the output folders. Written to a json run report and, optionally, to a Prometheus textfile
+    (node_exporter textfile collector).
+    """
+
+    lock = threading.Lock()
+    records = {'stages': list(), 'processes': list(), 'compression': list(), 'disk': list()}
+    collected = ['processes', 'compression']  # Records returned by the calls run in other processes
+    local = threading.local()  # Stage running in the current thread
+    start_time = time.time()
+
+    @staticmethod
+    def add(kind, record):
+        with Metrics.lock:
+            Metrics.records[kind].append(record)
+
+    @staticmethod
+    def current_stage():
+        return getattr(Metrics.local, 'stage', None)
+
+    @staticmethod
+    @contextmanager
+    def stage(name):
+        # CPU time is the one of the calling thread. External processes are measured separately.
+        Metrics.local.stage = name
+        start_time = time.time()
+        start_cpu = time.thread_time()
+        status = 'failed'
+        try:
+            yield
+            status = 'done'
+        finally:
+            Metrics.add('stages', {'name': name,
+                                   'start': start_time,
+                                   'wall_seconds': round(time.time() - start_time, 3),
+                                   'thread_cpu_seconds': round(time.thread_time() - start_cpu, 3),
+                                   'status': status})
+            Metrics.local.stage = None
+
+    @staticmethod
+    def bind(func):
+        # func to run in a pool thread, under the stage of the calling thread
+        stage = Metrics.current_stage()
+
+        def wrapper(*args):
+            Metrics.local.stage = stage
+            try:
+                return func(*args)
+            finally:
+                Metrics.local.stage = None
+        return wrapper
+
+    @staticmethod
+    def collect(func, *args):
+        """
+        Call func(*args) in a process running one call at a time (pool worker, cluster job) and return its result
+        with the process and compression records it added, to be merged in the metrics of the pipeline.
+        """
+        start = {kind: len(Metrics.records[kind]) for kind in Metrics.collected}
+        result = func(*args)
+        return result, {kind: Metrics.records[kind][start[kind]:] for kind in Metrics.collected}
+
+    @staticmethod
+    def merge(records, stage):
+        # Records returned by collect(), under the stage of the caller
+        for kind in Metrics.collected:
+            for record in records.get(kind, list()):
+                Metrics.add(kind, dict(record, stage=stage))
+
+    @staticmethod
+    def report():
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with Metrics.lock:
+            return {'start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(Metrics.start_time)),
+                    'wall_seconds': round(time.time() - Metrics.start_time, 3),
+                    'pipeline_cpu_seconds': round(self_usage.ru_utime + self_usage.ru_stime, 3),
+                    'pipeline_peak_rss_bytes': self_usage.ru_maxrss * 1024,
+                    'processes_cpu_seconds': round(children_usage.ru_utime + children_usage.ru_stime, 3),
+                    'stages': list(Metrics.records['stages']),
+                    'processes': list(Metrics.records['processes']),
+                    'compression': list(Metrics.records['compression']),
+                    'disk': list(Metrics.records['disk'])}
+
+    @staticmethod
+    def write_report(report_file):
+        tmp_file = report_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(Metrics.report(), f, indent=4)
+        os.replace(tmp_file, report_file)
+
+    @staticmethod
+    def labels(name):
+        # "filtering:barcode01" -> stage="filtering",sample="barcode01"
+        stage, _, sample = name.partition(':')
+        label_list = ['stage="{}"'.format(stage)]
+        if sample:
+            label_list.append('sample="{}"'.format(sample.replace('\\', '\\\\').replace('"', '\\"')))
+        return ','.join(label_list)
+
+    @staticmethod
+    def write_prometheus(prom_file):
+        report = Metrics.report()
+        metric_list = [('stage_wall_seconds', 'Wall time of each pipeline stage.', 'stages', 'wall_seconds'),
+                       ('stage_thread_cpu_seconds', 'CPU time of the thread running each pipeline stage.', 'stages',
+                        'thread_cpu_seconds'),
+                       ('process_wall_seconds', 'Wall time of each external process.', 'processes', 'wall_seconds'),
+                       ('process_cpu_seconds', 'CPU time of each external process and its children.', 'processes',
+                        'cpu_seconds'),
+                       ('process_peak_rss_bytes', 'Peak resident memory of each external process.', 'processes',
+                        'peak_rss_bytes'),
+                       ('process_read_bytes', 'Bytes read from storage by each external process.', 'processes',
+                        'read_bytes'),
+                       ('process_write_bytes', 'Bytes written to storage by each external process.', 'processes',
+                        'write_bytes'),
+                       ('process_exit_code', 'Exit code of each external process.', 'processes', 'exit_code')]
+        lines = ['# HELP basecall_nanopore_wall_seconds Wall time of the run.',
+                 '# TYPE basecall_nanopore_wall_seconds gauge',
+                 'basecall_nanopore_wall_seconds {}'.format(report['wall_seconds'])]
+        for metric, description, kind, key in metric_list:
+            lines += ['# HELP basecall_nanopore_{} {}'.format(metric, description),
+                      '# TYPE basecall_nanopore_{} gauge'.format(metric)]
+            seen = dict()
+            for record in report[kind]:
+                labels = Metrics.labels(record['name'])
+                if kind == 'processes':
+                    labels = Metrics.labels(record['stage'] if record['stage'] else record['name']) \
+                             + ',process="{}"'.format(record['name'])
+                # Same labels twice is invalid (e.g. a stage rerun after a failure)
+                seen[labels] = seen.get(labels, 0) + 1
+                if seen[labels] > 1:
+                    labels += ',n="{}"'.format(seen[labels])
+                lines.append('basecall_nanopore_{}{{{}}} {}'.format(metric, labels, record[key]))
+
+        # Atomic, so the collector never reads a partial file
+        tmp_file = prom_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, prom_file)
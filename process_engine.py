@@ -0,0 +1,279 @@
+import os
+import signal
+import atexit
+import asyncio
+import threading
+import subprocess
+from concurrent import futures
+from multiprocessing import cpu_count
+from metrics import Metrics, ProcessMonitor
+
+
+class ProcessError(Exception):
+    pass
+
+
+class ProcessCancelled(ProcessError):
+    pass
+
+
+class JobGroup(object):
+    # Jobs that fail together: when one fails, the others are cancelled
+    def __init__(self):
+        self.jobs = set()
+        self.error = None
+
+
+class Job(object):
+    def __init__(self, name, cmd, stdout, log_file, cwd, timeout, retries, pool, group, stage):
+        self.name = name
+        self.cmd = [str(x) for x in cmd]
+        self.stdout = stdout  # None (log file or inherited), a file path, or a pipe write end
+        self.log_file = log_file  # stderr, and stdout if not redirected elsewhere
+        self.cwd = cwd
+        self.timeout = timeout
+        self.retries = retries
+        self.pool = pool
+        self.group = group
+        self.stage = stage  # Pipeline stage of the caller, for the metrics
+        self.popen = None
+        self.cancelled = False
+
+
+class ProcessEngine(object):
+    """
+    Runs all the external tools. Jobs are coroutines on an event loop running in a background thread, so they can
+    be submitted from any thread (scheduler nodes, parallel helpers). Each pool has a maximum number of processes
+    running at the same time; jobs over the limit wait for a slot. Each process is started in its own process
+    group, so it can be killed along with its children on timeout, cancellation or Ctrl-C. A failed job is retried,
+    then its group is cancelled: the running processes of the group are killed and its pending jobs do not start.
+    """
+
+    PIPE = object()  # stdout value to read the output of the process as it runs
+
+    limits = {'tools': cpu_count()}  # {pool: maximum number of processes}, pools not listed are not limited
+    timeout = None  # Default seconds before a tool is killed
+    retries = 0  # Default number of retries of a failed tool
+    kill_grace = 10  # Seconds between SIGTERM and SIGKILL
+
+    lock = threading.Lock()
+    loop = None
+    semaphores = dict()
+    jobs = set()  # Submitted and not finished
+    stopped = False  # After cancel_all(), no new job is started
+    wait_executor = futures.ThreadPoolExecutor(max_workers=256, thread_name_prefix='process_wait')
+
+    @staticmethod
+    def configure(limits=None, timeout=None, retries=None):
+        with ProcessEngine.lock:
+            if limits:
+                ProcessEngine.limits.update(limits)
+                ProcessEngine.semaphores = dict()  # Recreated with the new limits
+            ProcessEngine.timeout = timeout
+            if retries is not None:
+                ProcessEngine.retries = retries
+            ProcessEngine.stopped = False
+
+    @staticmethod
+    def get_loop():
+        with ProcessEngine.lock:
+            if ProcessEngine.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True, name='process_engine').start()
+                ProcessEngine.loop = loop
+                atexit.register(ProcessEngine.cancel_all)  # No orphan tools if the pipeline exits on an error
+            return ProcessEngine.loop
+
+    @staticmethod
+    def group():
+        return JobGroup()
+
+    @staticmethod
+    def submit(name, cmd, stdout=None, log_file=None, cwd=None, timeout=None, retries=None, pool='tools',
+               group=None):
+        """
+        Start a job and return a concurrent.futures.Future, with the exit code (0) as result. Raise ProcessError if
+        the process still fails after the retries, or ProcessCancelled. With stdout=ProcessEngine.PIPE, the output
+        of the process is read from future.stdout (no retries in that case).
+        """
+        reader = None
+        if stdout is ProcessEngine.PIPE:
+            read_fd, write_fd = os.pipe()
+            reader = os.fdopen(read_fd, 'rb')
+            stdout = write_fd
+            retries = 0
+        job = Job(name, cmd, stdout, log_file, cwd,
+                  timeout if timeout is not None else ProcessEngine.timeout,
+                  retries if retries is not None else ProcessEngine.retries,
+                  pool, group, Metrics.current_stage())
+        with ProcessEngine.lock:
+            ProcessEngine.jobs.add(job)
+            if group:
+                group.jobs.add(job)
+        future = asyncio.run_coroutine_threadsafe(ProcessEngine.run_job(job), ProcessEngine.get_loop())
+        future.stdout = reader
+        return future
+
+    @staticmethod
+    def run(name, cmd, **kwargs):
+        # Blocking version of submit()
+        return ProcessEngine.submit(name, cmd, **kwargs).result()
+
+    @staticmethod
+    def get_semaphore(pool):
+        # Only called from the event loop
+        if pool not in ProcessEngine.limits:
+            return None
+        if pool not in ProcessEngine.semaphores:
+            ProcessEngine.semaphores[pool] = asyncio.Semaphore(ProcessEngine.limits[pool])
+        return ProcessEngine.semaphores[pool]
+
+    @staticmethod
+    async def run_job(job):
+        try:
+            semaphore = ProcessEngine.get_semaphore(job.pool)
+            if semaphore:
+                async with semaphore:
+                    return await ProcessEngine.run_attempts(job)
+            return await ProcessEngine.run_attempts(job)
+        except ProcessError as e:
+            if job.group and not isinstance(e, ProcessCancelled):
+                ProcessEngine.cancel_group(job.group, e)
+            raise
+        finally:
+            if isinstance(job.stdout, int):
+                os.close(job.stdout)  # Reader gets EOF even if the process never started
+                job.stdout = None
+            with ProcessEngine.lock:
+                ProcessEngine.jobs.discard(job)
+                if job.group:
+                    job.group.jobs.discard(job)
+
+    @staticmethod
+    async def run_attempts(job):
+        for attempt in range(job.retries + 1):
+            if job.cancelled or ProcessEngine.stopped:
+                raise ProcessCancelled('{} cancelled.'.format(job.name))
+            returncode, timed_out = await ProcessEngine.run_once(job, attempt)
+            if returncode == 0:
+                return 0
+            if job.cancelled or ProcessEngine.stopped:
+                raise ProcessCancelled('{} cancelled.'.format(job.name))
+            reason = 'timed out after {}s'.format(job.timeout) if timed_out \
+                else 'failed with exit code {}'.format(returncode)
+            if attempt < job.retries:
+                print('\t{} {}, retrying ({}/{})\n'.format(job.name, reason, attempt + 1, job.retries), end='')
+                continue
+            raise ProcessError('{} {}.{}'.format(job.name, reason,
+                                                 ' See {}'.format(job.log_file) if job.log_file else ''))
+
+    @staticmethod
+    async def run_once(job, attempt):
+        stdout = stderr = None
+        try:
+            if job.log_file:
+                os.makedirs(os.path.dirname(job.log_file) or '.', exist_ok=True)
+                stderr = open(job.log_file, 'a' if attempt else 'w')
+                if attempt:
+                    stderr.write('\n### Attempt {}\n'.format(attempt + 1))
+                    stderr.flush()
+            if isinstance(job.stdout, str):
+                stdout = open(job.stdout, 'wb')  # Truncated at each attempt
+            elif isinstance(job.stdout, int):
+                stdout = job.stdout
+            else:
+                stdout = stderr  # Everything to the log file, or inherited if no log file
+
+            try:
+                job.popen = ProcessEngine.start_process(job, stdout, stderr)
+            except OSError as e:
+                raise ProcessError('{} could not be started: {}'.format(job.name, e))
+            if job.cancelled:
+                ProcessEngine.kill(job)  # Cancelled while starting
+            if isinstance(job.stdout, int):
+                os.close(job.stdout)  # Only the process keeps the write end open
+                job.stdout = None
+        finally:
+            for f in [stdout, stderr]:
+                if f is not None and not isinstance(f, int):
+                    f.close()
+
+        monitor = ProcessMonitor(job.name, job.popen, job.stage)
+        wait = asyncio.get_running_loop().run_in_executor(ProcessEngine.wait_executor, monitor.wait)
+        timed_out = False
+        if job.timeout:
+            try:
+                await asyncio.wait_for(asyncio.shield(wait), job.timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                ProcessEngine.kill(job)
+        returncode = await wait
+        job.popen = None
+        return returncode, timed_out
+
+    @staticmethod
+    def start_process(job, stdout, stderr):
+        # Own session, so the whole process group can be killed
+        return subprocess.Popen(job.cmd, stdout=stdout, stderr=stderr, stdin=subprocess.DEVNULL, cwd=job.cwd,
+                                start_new_session=True)
+
+    @staticmethod
+    def kill(job):
+        # SIGTERM to the process group, then SIGKILL if still running after the grace period
+        popen = job.popen
+        if popen is None or popen.returncode is not None:
+            return
+        try:
+            os.killpg(popen.pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            return
+
+        def force_kill():
+            if popen.returncode is None:
+                try:
+                    os.killpg(popen.pid, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError):
+                    pass
+        timer = threading.Timer(ProcessEngine.kill_grace, force_kill)
+        timer.daemon = True
+        timer.start()
+
+    @staticmethod
+    def cancel_group(group, error):
+        with ProcessEngine.lock:
+            if group.error is None:
+                group.error = error
+            job_list = list(group.jobs)
+        for job in job_list:
+            job.cancelled = True
+            ProcessEngine.kill(job)
+
+    @staticmethod
+    def cancel_all():
+        # Fail fast: kill every running tool, and do not start the pending ones
+        ProcessEngine.stopped = True
+        with ProcessEngine.lock:
+            job_list = list(ProcessEngine.jobs)
+        for job in job_list:
+            job.cancelled = True
+            ProcessEngine.kill(job)
+
+    @staticmethod
+    def run_parallel(func, args_list, parallel):
+        """
+        Call func(*args, group=group) for each args with a pool of threads, all the jobs in the same group.
+        Raise the error of the first job that failed, not the cancellation of the others.
+        """
+        group = ProcessEngine.group()
+        with futures.ThreadPoolExecutor(max_workers=max(1, int(parallel))) as executor:
+            job_list = [executor.submit(func, *args, group=group) for args in args_list]
+            futures.wait(job_list, return_when=futures.FIRST_EXCEPTION)
+            if any(x.done() and x.exception() for x in job_list):
+                ProcessEngine.cancel_group(group, None)
+                for job in job_list:
+                    job.cancel()
+        if group.error:
+            raise group.error
+        error_list = [x.exception() for x in job_list if not x.cancelled() and x.exception()]
+        if error_list:
+            raise next((x for x in error_list if not isinstance(x, ProcessCancelled)), error_list[0])
@@ -0,0 +1,184 @@
+import os
+import json
+import html
+import time
+import numpy as np
+import pandas as pd
+from summary_cache import SummaryCache
+
+
+class QcReport(object):
+    """
+    Built-in alternative to pycoQC. The sequencing summary is read by chunks of fixed size from its columnar cache
+    (see summary_cache.py), only the columns needed, and all the statistics are accumulated in fixed size arrays
+    (histograms), so memory usage does not depend on the number of reads.
+    """
+
+    chunk_size = 500000  # Lines of sequencing_summary.txt read at once
+    length_bins = np.logspace(1, 7, 601)  # 10 bp to 10 Mbp, 1% wide bins
+    quality_bins = np.arange(0, 50.5, 0.5)
+    time_bin = 600  # Yield over time resolution, in seconds
+
+    column_dict = {'passes_filtering': 'pass',
+                   'sequence_length_template': 'length',
+                   'mean_qscore_template': 'quality',
+                   'barcode_arrangement': 'barcode',
+                   'start_time': 'start_time'}
+
+    def __init__(self):
+        self.reads = 0
+        self.bases = 0
+        self.pass_reads = 0
+        self.pass_bases = 0
+        self.length_counts = np.zeros(0, dtype=np.int64)  # Exact, to compute N50
+        self.length_hist = np.zeros(len(QcReport.length_bins) - 1, dtype=np.int64)
+        self.quality_hist = np.zeros(len(QcReport.quality_bins) - 1, dtype=np.int64)
+        self.time_bases = np.zeros(0, dtype=np.int64)
+        self.barcode_dict = dict()  # {barcode: [reads, bases, sum of qualities, length histogram]}
+
+    @staticmethod
+    def n50_from_counts(length_counts):
+        lengths = np.nonzero(length_counts)[0]
+        if not len(lengths):
+            return 0
+        bases = (lengths * length_counts[lengths])[::-1]  # Longest first
+        cumsum = np.cumsum(bases)
+        return int(lengths[::-1][np.searchsorted(cumsum, cumsum[-1] / 2)])
+
+    @staticmethod
+    def n50_from_hist(length_hist):
+        # Approximate N50, using the middle of the length bins
+        centers = np.sqrt(QcReport.length_bins[:-1] * QcReport.length_bins[1:])
+        bases = (centers * length_hist)[::-1]
+        if not bases.sum():
+            return 0
+        cumsum = np.cumsum(bases)
+        return int(centers[::-1][np.searchsorted(cumsum, cumsum[-1] / 2)])
+
+    def add_chunk(self, df):
+        lengths = df['length'].to_numpy(dtype=np.int64)
+        quality = df['quality'].to_numpy(dtype=np.float64)
+        if isinstance(df['pass'].dtype, pd.CategoricalDtype):
+            # From the cache: one comparison per category
+            flags = np.array([str(x).upper() == 'TRUE' for x in df['pass'].cat.categories], dtype=bool)
+            passed = flags[df['pass'].cat.codes.to_numpy()]
+        else:
+            passed = df['pass'].astype(str).str.upper().to_numpy() == 'TRUE'
+
+        self.reads += len(df)
+        self.bases += int(lengths.sum())
+        self.pass_reads += int(passed.sum())
+        self.pass_bases += int(lengths[passed].sum())
+
+        counts = np.bincount(lengths)
+        if len(counts) > len(self.length_counts):
+            counts[:len(self.length_counts)] += self.length_counts
+            self.length_counts = counts
+        else:
+            self.length_counts[:len(counts)] += counts
+        self.length_hist += np.histogram(lengths, QcReport.length_bins)[0]
+        self.quality_hist += np.histogram(quality, QcReport.quality_bins)[0]
+
+        if 'start_time' in df:
+            time_bins = (df['start_time'].to_numpy(dtype=np.float64) // QcReport.time_bin).astype(np.int64)
+            time_bases = np.bincount(time_bins, weights=lengths).astype(np.int64)
+            if len(time_bases) > len(self.time_bases):
+                time_bases[:len(self.time_bases)] += self.time_bases
+                self.time_bases = time_bases
+            else:
+                self.time_bases[:len(time_bases)] += time_bases
+
+        if 'barcode' in df:
+            df = df.assign(length_bin=np.digitize(lengths, QcReport.length_bins) - 1)
+            for barcode, group in df.groupby('barcode', sort=False, observed=True):
+                if barcode not in self.barcode_dict:
+                    self.barcode_dict[barcode] = [0, 0, 0.0, np.zeros(len(self.length_hist), dtype=np.int64)]
+                stats = self.barcode_dict[barcode]
+                stats[0] += len(group)
+                stats[1] += int(group['length'].sum())
+                stats[2] += float(group['quality'].sum())
+                length_bin = group['length_bin'].to_numpy()
+                length_bin = length_bin[(length_bin >= 0) & (length_bin < len(self.length_hist))]
+                stats[3] += np.bincount(length_bin, minlength=len(self.length_hist))
+
+    def parse(self, summary_file):
+        header = pd.read_csv(summary_file, sep='\t', nrows=0).columns
+        usecols = [x for x in QcReport.column_dict if x in header]
+        for chunk in pd.read_csv(summary_file, sep='\t', usecols=usecols, chunksize=QcReport.chunk_size):
+            self.add_chunk(chunk.rename(columns=QcReport.column_dict))
+
+    def parse_cache(self, summary_cache):
+        for chunk in summary_cache.scan(list(QcReport.column_dict.values()), QcReport.chunk_size):
+            self.add_chunk(chunk)
+
+    def to_dict(self):
+        length_centers = np.sqrt(QcReport.length_bins[:-1] * QcReport.length_bins[1:])
+        report = {'reads': self.reads,
+                  'bases': self.bases,
+                  'pass_reads': self.pass_reads,
+                  'pass_bases': self.pass_bases,
+                  'n50': QcReport.n50_from_counts(self.length_counts),
+                  'mean_length': self.bases / self.reads if self.reads else 0,
+                  'length_histogram': {'bins': [round(x) for x in length_centers[self.length_hist > 0]],
+                                       'counts': self.length_hist[self.length_hist > 0].tolist()},
+                  'quality_histogram': {'bins': QcReport.quality_bins[:-1].tolist(),
+                                        'counts': self.quality_hist.tolist()},
+                  'yield_over_time': {'hours': (np.arange(1, len(self.time_bases) + 1) * QcReport.time_bin
+                                                / 3600).tolist(),
+                                      'cumulative_bases': np.cumsum(self.time_bases).tolist()},
+                  'barcodes': dict()}
+        for barcode in sorted(self.barcode_dict):
+            reads, bases, quality_sum, length_hist = self.barcode_dict[barcode]
+            report['barcodes'][barcode] = {'reads': reads,
+                                           'bases': bases,
+                                           'mean_quality': quality_sum / reads if reads else 0,
+                                           'n50': QcReport.n50_from_hist(length_hist)}
+        return report
+
+    @staticmethod
+    def svg_bars(x_list, y_list, width=600, height=150):
+        # Minimal inline bar chart, no plotting library needed
+        if not y_list or max(y_list) == 0:
+            return ''
+        bar_width = width / len(y_list)
+        y_max = max(y_list)
+        bars = ''.join('<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}"><title>{}: {}</title></rect>'
+                       .format(i * bar_width, height - y / y_max * height, max(bar_width - 1, 1), y / y_max * height,
+                               x, y)
+                       for i, (x, y) in enumerate(zip(x_list, y_list)))
+        return '<svg width="{}" height="{}" fill="steelblue">{}</svg>'.format(width, height, bars)
+
+    @staticmethod
+    def write_html(report, html_file):
+        rows = ''.join('<tr><td>{}</td><td>{:,}</td><td>{:,}</td><td>{:.1f}</td><td>{:,}</td></tr>'
+                       .format(html.escape(str(barcode)), x['reads'], x['bases'], x['mean_quality'], x['n50'])
+                       for barcode, x in report['barcodes'].items())
+        with open(html_file, 'w') as f:
+            f.write('<html><head><meta charset="utf-8"><title>Read QC</title></head><body>\n')
+            f.write('<h1>Read QC</h1><p>Generated {}</p>\n'.format(time.strftime('%Y-%m-%d %H:%M:%S')))
+            f.write('<table border="1"><tr><th>Reads</th><th>Bases</th><th>Pass reads</th><th>Pass bases</th>'
+                    '<th>N50</th><th>Mean length</th></tr><tr><td>{:,}</td><td>{:,}</td><td>{:,}</td><td>{:,}</td>'
+                    '<td>{:,}</td><td>{:,.0f}</td></tr></table>\n'
+                    .format(report['reads'], report['bases'], report['pass_reads'], report['pass_bases'],
+                            report['n50'], report['mean_length']))
+            f.write('<h2>Read length</h2>{}\n'.format(QcReport.svg_bars(report['length_histogram']['bins'],
+                                                                      report['length_histogram']['counts'])))
+            f.write('<h2>Read quality</h2>{}\n'.format(QcReport.svg_bars(report['quality_histogram']['bins'],
+                                                                       report['quality_histogram']['counts'])))
+            f.write('<h2>Cumulative yield over time</h2>{}\n'.format(
+                QcReport.svg_bars(report['yield_over_time']['hours'], report['yield_over_time']['cumulative_bases'])))
+            if rows:
+                f.write('<h2>Barcodes</h2><table border="1"><tr><th>Barcode</th><th>Reads</th><th>Bases</th>'
+                        '<th>Mean quality</th><th>N50 (approx.)</th></tr>{}</table>\n'.format(rows))
+            f.write('</body></html>\n')
+
+    @staticmethod
+    def run_qc(basecalled_folder, report_folder):
+        os.makedirs(report_folder, exist_ok=True)
+        qc = QcReport()
+        qc.parse_cache(SummaryCache.open(basecalled_folder + 'sequencing_summary.txt'))
+        report = qc.to_dict()
+        with open(report_folder + 'qc_report.json', 'w') as f:
+            json.dump(report, f, indent=4)
+        QcReport.write_html(report, report_folder + 'qc_report.html')
+        print('\tQC: {:,} reads, {:,} bases, N50 {:,}'.format(report['reads'], report['bases'], report['n50']))
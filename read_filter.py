@@ -0,0 +1,278 @@
+import os
+import gzip
+import json
+import time
+import subprocess
+import threading
+import multiprocessing
+from concurrent import futures
+import numpy as np
+from basecall_nanopore_methods import Methods
+from fastq_index import FastqIndex
+from metrics import Metrics
+from executors import JobSpec
+
+
+class ReadFilter(object):
+    """
+    In-process alternative to Filtlong, using the same read scoring (default weights) and "--keep_percent" logic.
+
+    Pass 1 streams the fastq and only keeps 3 small arrays in memory (length, mean quality and minimum window
+    quality per read), computed with NumPy over batches of quality strings. The reads to keep are then selected
+    from the scores and pass 2 streams the fastq again to write them, in the input order.
+    """
+
+    preselect_margin = 1.25  # Bases pre-selected before trimming, relative to the target number of bases
+
+    # Per-base accuracy for each Phred+33 character, as a percentage
+    accuracy_table = np.array([100 * (1 - 10 ** (-max(i - 33, 0) / 10)) for i in range(256)], dtype=np.float64)
+
+    @staticmethod
+    def open_fastq(fastq):
+        if fastq.endswith('.gz'):
+            return gzip.open(fastq, 'rb')
+        return open(fastq, 'rb')
+
+    @staticmethod
+    def iter_records(fastq, chunk_size=16 * 1024 * 1024):
+        # Yield lists of (header, sequence, quality) tuples, one list per chunk of the input file
+        leftover = b''
+        with ReadFilter.open_fastq(fastq) as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk and not leftover:
+                    break
+                lines = (leftover + chunk).split(b'\n')
+                if chunk:
+                    # Keep the incomplete record for the next chunk
+                    n_complete = (len(lines) - 1) // 4 * 4
+                    leftover = b'\n'.join(lines[n_complete:])
+                    lines = lines[:n_complete]
+                else:
+                    leftover = b''
+                    lines = [x for x in lines if x]
+                    if len(lines) % 4:
+                        raise Exception('Truncated fastq file: {}'.format(fastq))
+                if lines:
+                    yield list(zip(lines[0::4], lines[1::4], lines[3::4]))
+
+    @staticmethod
+    def score_batch(qual_list, window_size=250):
+        # Return the length, the mean quality and the minimum window quality of each read of the batch
+        lengths = np.fromiter((len(x) for x in qual_list), dtype=np.int64, count=len(qual_list))
+        accuracy = ReadFilter.accuracy_table[np.frombuffer(b''.join(qual_list), dtype=np.uint8)]
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+        # Mean quality
+        non_empty = lengths > 0
+        mean_q = np.zeros(len(qual_list), dtype=np.float64)
+        sums = np.add.reduceat(accuracy, starts[non_empty]) if non_empty.any() else np.zeros(0)
+        mean_q[non_empty] = sums / lengths[non_empty]
+
+        # Minimum window quality. Reads shorter than the window get their mean quality.
+        window_q = mean_q.copy()
+        long_reads = lengths >= window_size
+        if long_reads.any():
+            cumsum = np.concatenate(([0], np.cumsum(accuracy)))
+            window_means = (cumsum[window_size:] - cumsum[:-window_size]) / window_size  # Window starting at i
+            # Mask the windows overlapping two reads
+            position = np.arange(len(window_means)) - np.repeat(starts, lengths)[:len(window_means)]
+            read_length = np.repeat(lengths, lengths)[:len(window_means)]
+            window_means[position > read_length - window_size] = np.inf
+            window_q[long_reads] = np.minimum.reduceat(window_means, starts[long_reads])
+
+        return lengths, mean_q, window_q
+
+    @staticmethod
+    def read_scores(lengths, mean_q, window_q):
+        # Filtlong final score: geometric mean of the length and mean quality scores, lowered by the window quality
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.sqrt(lengths * mean_q)
+            penalty = np.where((window_q < mean_q) & (mean_q > 0), window_q / mean_q, 1.0)
+        return np.nan_to_num(scores * penalty)
+
+    @staticmethod
+    def select_reads(lengths, scores, keep_percent=95, target_bases=None):
+        # Keep the best reads until the requested amount of bases is reached
+        order = np.argsort(-scores, kind='stable')
+        bases_before = np.cumsum(lengths[order]) - lengths[order]
+        threshold = lengths.sum() * keep_percent / 100
+        if target_bases:
+            threshold = min(threshold, target_bases)
+        keep = np.zeros(len(lengths), dtype=bool)
+        keep[order[bases_before < threshold]] = True
+        return keep
+
+    @staticmethod
+    def score_fastq(fastq):
+        length_list, mean_q_list, window_q_list = list(), list(), list()
+        for records in ReadFilter.iter_records(fastq):
+            lengths, mean_q, window_q = ReadFilter.score_batch([x[2] for x in records])
+            length_list.append(lengths)
+            mean_q_list.append(mean_q.astype(np.float32))
+            window_q_list.append(window_q.astype(np.float32))
+        if not length_list:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+        return np.concatenate(length_list), np.concatenate(mean_q_list), np.concatenate(window_q_list)
+
+    @staticmethod
+    def write_selected(fastq, keep, out_fastq, cpu, index_file=None, level=6):
+        # Stream the kept records through a pipe into the multi-threaded compressor
+        read_fd, write_fd = os.pipe()
+
+        error = list()  # Of the writer thread
+
+        def writer():
+            try:
+                i = 0
+                with os.fdopen(write_fd, 'wb') as f:
+                    for records in ReadFilter.iter_records(fastq):
+                        batch_keep = keep[i:i + len(records)]
+                        i += len(records)
+                        f.write(b''.join(b'%s\n%s\n+\n%s\n' % r for r, k in zip(records, batch_keep) if k))
+            except BaseException as e:
+                error.append(e)
+
+        t = threading.Thread(target=writer)
+        t.start()
+        with os.fdopen(read_fd, 'rb') as f:
+            stats = Methods.compress_stream(f, out_fastq, max(1, cpu), level=level, index_file=index_file)
+        t.join()
+        if error:
+            # Input stopped early: the output is truncated and must not be kept
+            raise error[0]
+        return stats
+
+    @staticmethod
+    def remove_partial(out_fastq):
+        # Temporary output and read index of a write that failed
+        for path in [out_fastq + '.tmp', FastqIndex.index_file(out_fastq)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def run_filter(sample, input_fastq, filtered_folder, keep_percent=95, cpu=1, target_bases=None):
+        print('\t{}'.format(sample))
+        start_time = time.time()
+
+        # Pass 1: score reads
+        lengths, mean_q, window_q = ReadFilter.score_fastq(input_fastq)
+        keep = ReadFilter.select_reads(lengths, ReadFilter.read_scores(lengths, mean_q, window_q),
+                                       keep_percent, target_bases)
+
+        # Pass 2: write kept reads
+        filtered_fastq = filtered_folder + sample + '.fastq.gz'
+        try:
+            bytes_in, bytes_out = ReadFilter.write_selected(input_fastq, keep, filtered_fastq + '.tmp', cpu,
+                                                            FastqIndex.index_file(filtered_fastq))
+        except BaseException:
+            # The index is written under its final name: it must not be left next to a missing output
+            ReadFilter.remove_partial(filtered_fastq)
+            raise
+        os.replace(filtered_fastq + '.tmp', filtered_fastq)
+
+        elapsed = max(time.time() - start_time, 0.001)
+        print('\t{}: kept {}/{} reads ({:.1f}/{:.1f} Mbp) in {:.1f}s ({:.1f} MB/s)'.format(
+            sample, int(keep.sum()), len(keep), lengths[keep].sum() / 1000000, lengths.sum() / 1000000,
+            elapsed, bytes_in / 1000000 / elapsed))
+
+    @staticmethod
+    def run_filter_process(sample, input_fastq, filtered_folder, keep_percent=95, cpu=1, target_bases=None):
+        # Parsing holds the GIL, so run each sample in its own process when called from a thread. Started fresh
+        # ("spawn"): a process forked while other threads hold locks (metrics, process engine) could deadlock.
+        with futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            _, records = executor.submit(JobSpec.call, JobSpec.make(ReadFilter.run_filter, (
+                sample, input_fastq, filtered_folder, keep_percent, cpu, target_bases))).result()
+        Metrics.merge(records, Metrics.current_stage())
+
+    @staticmethod
+    def preselect(sample, input_fastq, preselected_folder, target_bases, cpu=1, stats_folder=None, compress=False):
+        """
+        Keep the best reads (same scores as the filtering) up to target_bases bases before trimming, so a deep sample
+        only has the reads that can make it to the output trimmed and filtered. The reads are written uncompressed
+        (read once by the trimmer) along with a json of what was kept, for the report. The json goes to
+        stats_folder if given, when the reads are staged on a scratch folder.
+        With compress, the reads are written compressed like the trimmed reads ("<sample>.fastq.gz"), for the reads
+        already trimmed batch by batch in watch mode.
+        """
+        print('\t{}'.format(sample))
+        start_time = time.time()
+        lengths, mean_q, window_q = ReadFilter.score_fastq(input_fastq)
+        keep = ReadFilter.select_reads(lengths, ReadFilter.read_scores(lengths, mean_q, window_q), 100, target_bases)
+
+        preselected_fastq = preselected_folder + sample + ('.fastq.gz' if compress else '.fastq')
+        try:
+            if compress:
+                ReadFilter.write_selected(input_fastq, keep, preselected_fastq + '.tmp', cpu,
+                                          FastqIndex.index_file(preselected_fastq), Methods.intermediate_level())
+            else:
+                i = 0
+                with open(preselected_fastq + '.tmp', 'wb') as f:
+                    for records in ReadFilter.iter_records(input_fastq):
+                        batch_keep = keep[i:i + len(records)]
+                        i += len(records)
+                        f.write(b''.join(b'%s\n%s\n+\n%s\n' % r for r, k in zip(records, batch_keep) if k))
+        except BaseException:
+            ReadFilter.remove_partial(preselected_fastq)
+            raise
+        os.replace(preselected_fastq + '.tmp', preselected_fastq)
+
+        stats = {'sample': sample,
+                 'preselection_bases': int(target_bases),
+                 'input_reads': len(keep),
+                 'input_bases': int(lengths.sum()),
+                 'preselected_reads': int(keep.sum()),
+                 'preselected_bases': int(lengths[keep].sum())}
+        with open((stats_folder if stats_folder else preselected_folder) + sample + '.json', 'w') as f:
+            json.dump(stats, f, indent=4)
+
+        print('\t{}: pre-selected {}/{} reads ({:.1f}/{:.1f} Mbp) in {:.1f}s'.format(
+            sample, stats['preselected_reads'], stats['input_reads'], stats['preselected_bases'] / 1000000,
+            stats['input_bases'] / 1000000, time.time() - start_time))
+
+    @staticmethod
+    def preselect_process(sample, input_fastq, preselected_folder, target_bases, cpu=1, stats_folder=None,
+                          compress=False):
+        # Same as run_filter_process()
+        with futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            _, records = executor.submit(JobSpec.call, JobSpec.make(ReadFilter.preselect, (
+                sample, input_fastq, preselected_folder, target_bases, cpu, stats_folder, compress))).result()
+        Metrics.merge(records, Metrics.current_stage())
+
+    @staticmethod
+    def compare_with_filtlong(input_fastq, keep_percent=95, filtlong='filtlong'):
+        """
+        Equivalence check against Filtlong on a given fastq file, both with the same "--keep_percent". Return the
+        throughput of each engine, the number of reads kept by each engine and by both, and the agreement (reads
+        kept by both / reads kept by either).
+        """
+        start_time = time.time()
+        kept_native = set()
+        lengths, mean_q, window_q = ReadFilter.score_fastq(input_fastq)
+        keep = ReadFilter.select_reads(lengths, ReadFilter.read_scores(lengths, mean_q, window_q), keep_percent)
+        i = 0
+        for records in ReadFilter.iter_records(input_fastq):
+            for record in records:
+                if keep[i]:
+                    kept_native.add(record[0].split()[0])
+                i += 1
+        native_time = max(time.time() - start_time, 0.001)
+
+        start_time = time.time()
+        kept_filtlong = set()
+        p = subprocess.run([filtlong, '--keep_percent', str(keep_percent), input_fastq],
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        for line in p.stdout.split(b'\n')[0::4]:
+            if line:
+                kept_filtlong.add(line.split()[0])
+        filtlong_time = max(time.time() - start_time, 0.001)
+
+        both = len(kept_native & kept_filtlong)
+        return {'reads': len(keep),
+                'external_reads_per_s': len(keep) / filtlong_time,
+                'native_reads_per_s': len(keep) / native_time,
+                'speedup': filtlong_time / native_time,
+                'native': len(kept_native),
+                'filtlong': len(kept_filtlong),
+                'both': both,
+                'agreement': both / max(len(kept_native | kept_filtlong), 1)}
@@ -0,0 +1,319 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from concurrent import futures
+from metrics import Metrics
+from process_engine import ProcessEngine
+
+
+class Node(object):
+    def __init__(self, name, func, args=(), deps=(), group=None, outputs=(), params=None, work=0, mem=0,
+                 executor=None, then=None, cleanup=(), disk=0):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = list(deps)
+        self.group = group  # Nodes of the same group share a concurrency limit
+        self.outputs = list(outputs)  # Files produced by the node, checked on restart
+        self.params = params if params else dict()  # Anything that changes the outputs if changed
+        self.work = work  # Estimated amount of work (e.g. input size), larger nodes start first and get more threads
+        self.mem = mem  # Estimated peak memory, in GB
+        self.threads = 1  # Allocated when submitted
+        self.executor = executor  # Runs func somewhere else than in a thread of the pipeline, if any
+        self.then = then  # Called once the node is completed (or already was), can add the next nodes of the graph
+        self.cleanup = list(cleanup)  # Input files deleted once the node is completed, if not needed anymore
+        self.disk = disk  # Estimated bytes written to the volume of the output folder
+
+    @property
+    def remote(self):
+        # Running on another computer: not counted in the group limits, threads and memory of this one
+        return bool(self.executor and self.executor.remote)
+
+
+class Scheduler(object):
+    """
+    Run the pipeline as a dependency graph. A node is submitted as soon as all the nodes it depends on are
+    completed, so each sample moves to its next stage without waiting for the other samples.
+
+    Completed nodes are recorded in a json checkpoint manifest, along with the size and checksum of their outputs
+    and the parameters used. On restart, a node is skipped only if its parameters did not change and its outputs
+    are all present and intact. Nodes depending on a node that has to be rerun are rerun too.
+
+    A node can delete its input files once it is completed and its outputs are recorded (intermediate files of a
+    sample). An output deleted that way does not make its node rerun while the node that deleted it is still done.
+
+    With a disk reserve, a node only starts if its estimated output fits in the free space of the volume of the
+    manifest, minus the reserve and the estimated output of the running nodes.
+    """
+
+    # Placeholder in the node arguments, replaced by the number of threads allocated to the node
+    THREADS = object()
+
+    def __init__(self, manifest_file, limits=None, cpu=None, mem=None, disk_reserve=None):
+        self.manifest_file = manifest_file
+        self.limits = limits if limits else dict()  # {group: maximum number of nodes running at the same time}
+        self.cpu = cpu  # Threads shared by all the running nodes
+        self.mem = mem  # Memory budget in GB for the running nodes
+        self.disk_reserve = disk_reserve  # Bytes to keep free on the output volume, None for no disk space check
+        self.nodes = dict()  # Insertion order is the submission order when several nodes are ready
+        self.manifest = Scheduler.load_manifest(manifest_file)
+        self.valid = dict()  # {node name: True/False}, so outputs are only checked once per run
+
+    @staticmethod
+    def load_manifest(manifest_file):
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as f:
+                return json.load(f)
+        return dict()
+
+    def save_manifest(self):
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(tmp_file, self.manifest_file)  # Atomic, manifest never half written
+
+    @staticmethod
+    def file_checksum(my_file, block_size=4 * 1024 * 1024):
+        h = hashlib.blake2b(digest_size=16)
+        with open(my_file, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    @staticmethod
+    def describe_output(my_file):
+        stat = os.stat(my_file)
+        return {'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'checksum': Scheduler.file_checksum(my_file)}
+
+    @staticmethod
+    def check_output(my_file, record):
+        if not os.path.exists(my_file):
+            return False
+        stat = os.stat(my_file)
+        if stat.st_size != record['size']:
+            return False  # Truncated or overwritten
+        if stat.st_mtime != record['mtime']:
+            return Scheduler.file_checksum(my_file) == record['checksum']  # Touched, make sure content is the same
+        return True
+
+    def add(self, name, func, args=(), deps=(), group=None, outputs=(), params=None, work=0, mem=0,
+            executor=None, then=None, cleanup=(), disk=0):
+        self.nodes[name] = Node(name, func, args, deps, group, outputs, params, work, mem, executor, then, cleanup,
+                                disk)
+
+    def recorded_outputs(self, name):
+        # {file: size, modification time and checksum} of the outputs of a completed node, even if deleted since
+        return dict(self.manifest[name]['outputs']) if name in self.manifest else dict()
+
+    def cleaned_by(self, output):
+        # Node that deleted this file once completed, if any
+        return next((k for k, v in self.manifest.items() if output in v.get('cleanup', list())), None)
+
+    def is_done(self, name):
+        if name in self.valid:
+            return self.valid[name]
+
+        if name not in self.manifest:
+            return False
+        record = self.manifest[name]
+
+        if name in self.nodes:
+            node = self.nodes[name]
+            if record['params'] != json.loads(json.dumps(node.params)):  # Same types as when read from manifest
+                print('\tParameters changed for {}. Rerunning.'.format(name))
+                self.valid[name] = False
+                return False
+            for dep in node.deps:
+                if dep in self.manifest and self.manifest[dep]['completed'] > record['completed']:
+                    print('\tInputs changed for {}. Rerunning.'.format(name))
+                    self.valid[name] = False
+                    return False
+            for output in node.outputs + [x for x in record['outputs'] if x not in node.outputs]:
+                consumer = self.cleaned_by(output) if not os.path.exists(output) else None
+                if consumer and (consumer not in self.nodes or self.is_done(consumer)):
+                    continue  # Deleted once used
+                if output not in record['outputs'] or not Scheduler.check_output(output, record['outputs'][output]):
+                    print('\tMissing or truncated output for {}: {}. Rerunning.'.format(name, output))
+                    self.valid[name] = False
+                    return False
+            self.valid[name] = True
+        return True
+
+    def mark_done(self, name, extra_outputs=None):
+        # Nodes can return the list of files they produced when they are not known in advance
+        node = self.nodes[name]
+        outputs = node.outputs + [x for x in (extra_outputs if extra_outputs else list()) if x not in node.outputs]
+        self.manifest[name] = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                               'completed': time.time(),
+                               'params': node.params,
+                               'outputs': {x: Scheduler.describe_output(x) for x in outputs},
+                               'cleanup': node.cleanup}
+        self.valid[name] = True
+        self.save_manifest()
+
+    def delete_inputs(self, name):
+        # Only once the outputs of the node are recorded in the manifest
+        for input_file in self.nodes[name].cleanup:
+            if os.path.exists(input_file):
+                os.remove(input_file)
+
+    def check_inputs(self, pending):
+        # Nodes to run whose inputs were deleted by a previous run, and that no node to run writes again
+        produced = set()
+        for name in pending:
+            produced.update(self.nodes[name].outputs + list(self.recorded_outputs(name)))
+        for name in pending:
+            missing = [x for x in self.nodes[name].cleanup
+                       if not os.path.exists(x) and x not in produced and self.cleaned_by(x)]
+            if missing:
+                raise Exception('{} has to run again, but its inputs were deleted once used: {}. Run it with the '
+                                'same parameters as before, or in a new output folder.'.format(name,
+                                                                                             ', '.join(missing)))
+
+    def invalidate(self, name):
+        self.manifest.pop(name, None)
+        self.valid[name] = False
+        self.save_manifest()
+
+    def admit(self, node, running, ready):
+        # Check the disk space and the group limit, then allocate threads and memory to the node
+        if self.disk_reserve is not None and node.disk:
+            free = shutil.disk_usage(os.path.dirname(os.path.abspath(self.manifest_file))).free - self.disk_reserve
+            if node.disk + sum(x.disk for x in running.values()) > free:
+                if running:
+                    return False  # Space is freed by the nodes running, or by the inputs they delete
+                raise Exception('Not enough disk space to run {}: about {:.1f} GB to write, {:.1f} GB free minus '
+                                'the reserve.'.format(node.name, node.disk / 1000000000, max(free, 0) / 1000000000))
+        if node.remote:
+            node.threads = node.executor.threads  # Threads of a cluster job, the executor limits the jobs
+            return True
+        running = {k: v for k, v in running.items() if not v.remote}
+        ready = [x for x in ready if not x.remote]
+        slots = None
+        if node.group in self.limits:
+            slots = self.limits[node.group] - len([x for x in running.values() if x.group == node.group])
+            if slots <= 0:
+                return False
+
+        if self.mem and running:  # A node is always admitted if nothing runs, even if over the budget
+            if sum(x.mem for x in running.values()) + node.mem > self.mem:
+                return False
+
+        node.threads = 1
+        if Scheduler.THREADS in node.args and self.cpu:
+            free = self.cpu - sum(x.threads for x in running.values())
+            if free <= 0 and running:
+                return False
+            # Share the free threads with the next nodes that can start, in proportion to their work
+            peers = [x for x in ready if x.group == node.group and Scheduler.THREADS in x.args]
+            peers = peers[:slots] if slots else peers
+            total_work = sum(x.work for x in peers)
+            if total_work > 0:
+                node.threads = int(free * node.work / total_work)
+            else:
+                node.threads = int(free / max(len(peers), 1))
+            node.threads = min(max(node.threads, 1), max(free, 1))
+        return True
+
+    @staticmethod
+    def run_node(name, func, args, executor=None, mem=0):
+        # Wall and CPU time of each node go to the run metrics
+        with Metrics.stage(name):
+            if executor:
+                return executor.run(name, func, args, mem)
+            return func(*args)
+
+    def get_pending(self, known=None):
+        """
+        Nodes to run: the ones not done, and everything downstream of them. With known, only the nodes added since
+        then are checked, the others are already pending, running or done.
+        """
+        known = known if known is not None else dict()
+        pending = [name for name in self.nodes if name not in known and not self.is_done(name)]
+        changed = True
+        while changed:
+            changed = False
+            for name, node in self.nodes.items():
+                if name not in known and name not in pending \
+                        and any(dep in pending or known.get(dep) is False for dep in node.deps):
+                    pending.append(name)
+                    changed = True
+        return pending
+
+    def call_then(self, pending):
+        # Callbacks of the completed nodes, which can add new nodes. Return the names of the new ones.
+        names = set(self.nodes)
+        for node in list(self.nodes.values()):
+            if node.then and node.name not in pending and self.is_done(node.name):
+                then, node.then = node.then, None
+                then()
+        return [x for x in self.nodes if x not in names]
+
+    def run(self):
+        # Nodes added by the callbacks of the nodes already done are part of this run too
+        pending = self.get_pending()
+        while self.call_then(pending):
+            pending = self.get_pending()
+        if not pending:
+            return
+        self.check_inputs(pending)
+        for name in pending:
+            self.invalidate(name)
+
+        for name in pending:
+            for dep in self.nodes[name].deps:
+                if dep not in self.nodes and not self.is_done(dep):
+                    raise Exception('Node "{}" depends on unknown node "{}".'.format(name, dep))
+
+        running = dict()  # {future: node}
+        # Threads are only started when needed, the limit is for the nodes added while running
+        with futures.ThreadPoolExecutor(max_workers=max(len(pending), 256)) as executor:
+            try:
+                while pending or running:
+                    # Submit the nodes that are ready, largest first, within their group limit and the resources left
+                    ready = [self.nodes[x] for x in self.nodes
+                             if x in pending and all(self.is_done(dep) for dep in self.nodes[x].deps)]
+                    ready.sort(key=lambda x: -x.work)
+                    for node in list(ready):
+                        if not self.admit(node, running, ready):
+                            continue
+                        args = [node.threads if x is Scheduler.THREADS else x for x in node.args]
+                        running[executor.submit(Scheduler.run_node, node.name, node.func, args, node.executor,
+                                                node.mem)] = node
+                        pending.remove(node.name)
+                        ready.remove(node)
+
+                    if not running:
+                        raise Exception('Could not resolve the dependencies of nodes: {}'.format(', '.join(pending)))
+
+                    done_set, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                    for job in done_set:
+                        node = running.pop(job)
+                        self.mark_done(node.name, job.result())
+                        self.delete_inputs(node.name)
+
+                    # Nodes added by the completed ones: run the ones not done before, and the ones depending on
+                    # nodes still to run
+                    new_nodes = self.call_then(pending)
+                    if new_nodes:
+                        busy = set(pending) | set(x.name for x in running.values())
+                        known = {x: x not in busy for x in self.nodes if x not in new_nodes}
+                        new_pending = self.get_pending(known)
+                        self.check_inputs(new_pending)
+                        for name in new_pending:
+                            self.invalidate(name)
+                        pending += new_pending
+            except BaseException:
+                # Fail fast (also on Ctrl-C): nothing else starts and the tools of the running nodes are killed,
+                # so the executor does not wait for them to finish
+                pending.clear()
+                for other in running:
+                    other.cancel()
+                ProcessEngine.cancel_all()
+                for node_executor in set(x.executor for x in running.values() if x.executor):
+                    node_executor.cancel_all()
+                raise
@@ -0,0 +1,252 @@
+import os
+import json
+import shutil
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+
+
+class SummaryCache(object):
+    """
+    Columnar copy of sequencing_summary.txt, written once after basecalling so the text file is not parsed again.
+    Each column is a raw NumPy array in its own file ("<column>.bin"), read back memory-mapped: only the pages of the
+    columns used are read, and they stay in the page cache for the next reader. The barcode and the pass/fail flag
+    are categoricals: small integer codes, with the values listed in "meta.json" along with the number of reads, the
+    column types and the size and modification time of the summary it was made from.
+    """
+
+    chunk_size = 500000  # Lines of sequencing_summary.txt read at once
+    folder_name = 'summary_cache/'
+    meta_file = 'meta.json'
+
+    # {summary column: (cache column, type)}, "S" is a fixed width read id
+    column_dict = {'read_id': ('read_id', 'S'),
+                   'channel': ('channel', 'uint16'),
+                   'start_time': ('start_time', 'float64'),
+                   'duration': ('duration', 'float32'),
+                   'sequence_length_template': ('length', 'uint32'),
+                   'mean_qscore_template': ('quality', 'float32'),
+                   'passes_filtering': ('pass', 'category'),
+                   'barcode_arrangement': ('barcode', 'category')}
+    category_type = 'uint16'
+
+    def __init__(self, cache_folder):
+        self.folder = cache_folder
+        with open(cache_folder + SummaryCache.meta_file, 'r') as f:
+            self.meta = json.load(f)
+        self.reads = self.meta['reads']
+        self.columns = list(self.meta['columns'])
+        self.arrays = dict()
+
+    @staticmethod
+    def cache_folder(summary_file):
+        return os.path.dirname(os.path.abspath(summary_file)) + '/' + SummaryCache.folder_name
+
+    @staticmethod
+    def source_stat(summary_file):
+        stat = os.stat(summary_file)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    @staticmethod
+    def is_current(summary_file, cache_folder=None):
+        # Cache present and made from the summary as it is now
+        meta_file = (cache_folder or SummaryCache.cache_folder(summary_file)) + SummaryCache.meta_file
+        if not os.path.exists(meta_file):
+            return False
+        with open(meta_file, 'r') as f:
+            return json.load(f).get('source') == SummaryCache.source_stat(summary_file)
+
+    @staticmethod
+    def build(summary_file, cache_folder=None):
+        """
+        Convert the summary by chunks, each column appended to its file. Written to a temporary folder that replaces
+        the cache at the end, so an interrupted conversion leaves no partial cache. Return the cache folder.
+        """
+        cache_folder = cache_folder or SummaryCache.cache_folder(summary_file)
+        tmp_folder = cache_folder.rstrip('/') + '.tmp/'
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        os.makedirs(tmp_folder)
+        source = SummaryCache.source_stat(summary_file)
+
+        header = pd.read_csv(summary_file, sep='\t', nrows=0).columns
+        usecols = [x for x in SummaryCache.column_dict if x in header]
+        types = {SummaryCache.column_dict[x][0]: SummaryCache.column_dict[x][1] for x in usecols}
+        categories = {name: dict() for name, kind in types.items() if kind == 'category'}
+        id_width = 0
+        reads = 0
+        files = {name: open(tmp_folder + name + '.bin', 'wb') for name in types}
+        try:
+            for chunk in pd.read_csv(summary_file, sep='\t', usecols=usecols, chunksize=SummaryCache.chunk_size,
+                                     dtype={'read_id': str, 'passes_filtering': str, 'barcode_arrangement': str}):
+                chunk = chunk.rename(columns={x: SummaryCache.column_dict[x][0] for x in usecols})
+                for name, kind in types.items():
+                    if kind == 'category':
+                        # Codes of this chunk mapped to the codes of the values seen so far
+                        codes, values = pd.factorize(chunk[name].fillna(''))
+                        mapping = np.array([categories[name].setdefault(x, len(categories[name])) for x in values],
+                                           dtype=SummaryCache.category_type)
+                        array = mapping[codes] if len(codes) else np.zeros(0, dtype=SummaryCache.category_type)
+                    elif kind == 'S':
+                        array = chunk[name].fillna('').to_numpy().astype('S')
+                        if array.dtype.itemsize > id_width:
+                            if reads:
+                                # Longer read ids than the previous chunks: widen what was written
+                                files[name].close()
+                                previous = np.fromfile(tmp_folder + name + '.bin', dtype='S{}'.format(id_width))
+                                files[name] = open(tmp_folder + name + '.bin', 'wb')
+                                files[name].write(previous.astype(array.dtype).tobytes())
+                            id_width = array.dtype.itemsize
+                        array = array.astype('S{}'.format(id_width))
+                    else:
+                        array = chunk[name].fillna(0).to_numpy().astype(kind)
+                    files[name].write(array.tobytes())
+                reads += len(chunk)
+        finally:
+            for f in files.values():
+                f.close()
+
+        if 'read_id' in types:
+            types['read_id'] = 'S{}'.format(max(id_width, 1))
+        meta = {'reads': reads,
+                'columns': {name: SummaryCache.category_type if kind == 'category' else kind
+                            for name, kind in types.items()},
+                'categories': {name: list(values) for name, values in categories.items()},
+                'source': source}
+        with open(tmp_folder + SummaryCache.meta_file, 'w') as f:
+            json.dump(meta, f, indent=4)
+        shutil.rmtree(cache_folder, ignore_errors=True)
+        os.replace(tmp_folder, cache_folder)
+        return cache_folder
+
+    @staticmethod
+    def run_cache(basecalled_folder):
+        # Pipeline stage, after the demultiplexing
+        summary_file = basecalled_folder + 'sequencing_summary.txt'
+        cache = SummaryCache(SummaryCache.build(summary_file))
+        print('\tSequencing summary: {:,} reads cached in {:.1f} MB (was {:.1f} MB)'.format(
+            cache.reads, cache.size() / 1000000, os.path.getsize(summary_file) / 1000000))
+
+    @staticmethod
+    def open(summary_file):
+        # Cache of the summary, made first if missing or older than the summary
+        if not SummaryCache.is_current(summary_file):
+            SummaryCache.build(summary_file)
+        return SummaryCache(SummaryCache.cache_folder(summary_file))
+
+    def size(self):
+        return sum(os.path.getsize(self.folder + x) for x in os.listdir(self.folder))
+
+    def column(self, name):
+        # Memory-mapped array of a column (codes for the categoricals), read only
+        if name not in self.meta['columns']:
+            raise KeyError('No "{}" column in the sequencing summary cache ({}).'.format(name, self.folder))
+        if name not in self.arrays:
+            dtype = np.dtype(self.meta['columns'][name])
+            if self.reads:
+                self.arrays[name] = np.memmap(self.folder + name + '.bin', dtype=dtype, mode='r', shape=(self.reads,))
+            else:
+                self.arrays[name] = np.zeros(0, dtype=dtype)  # Empty files cannot be mapped
+        return self.arrays[name]
+
+    def categories(self, name):
+        return self.meta['categories'][name]
+
+    def values(self, name, start=0, end=None):
+        # Column as a pandas Series, categoricals decoded (without copying the codes)
+        array = self.column(name)[start:end]
+        if name in self.meta['categories']:
+            return pd.Series(pd.Categorical.from_codes(array.astype(np.int32), self.categories(name)))
+        if array.dtype.kind == 'S':
+            return pd.Series(np.char.decode(array, 'ascii'))
+        return pd.Series(array)
+
+    def passed(self, start=0, end=None):
+        # Boolean array of the reads passing the Guppy quality filter
+        if 'pass' not in self.meta['columns']:
+            return np.ones(len(range(self.reads)[start:end]), dtype=bool)
+        flags = np.array([x.upper() == 'TRUE' for x in self.categories('pass')], dtype=bool)
+        return flags[self.column('pass')[start:end]]
+
+    def mask(self, start=0, end=None, barcode=None, passed=None, min_length=0, min_quality=0):
+        """
+        Reads of [start, end) matching all the filters: barcode (name or list of names), passed (True or False),
+        min_length and min_quality. None if there is no filter.
+        """
+        end = self.reads if end is None else min(end, self.reads)
+        mask = None
+        if barcode is not None:
+            barcode_list = [barcode] if isinstance(barcode, str) else barcode
+            codes = self.column('barcode')[start:end]
+            mask = np.array([x in barcode_list for x in self.categories('barcode')], dtype=bool)[codes]
+        if passed is not None:
+            flags = self.passed(start, end) == passed
+            mask = flags if mask is None else mask & flags
+        if min_length:
+            flags = self.column('length')[start:end] >= min_length
+            mask = flags if mask is None else mask & flags
+        if min_quality:
+            flags = self.column('quality')[start:end] >= min_quality
+            mask = flags if mask is None else mask & flags
+        return mask
+
+    def scan(self, columns=None, chunk_size=None, **filters):
+        """
+        Yield the reads matching the filters (see mask()) as pandas DataFrames of at most chunk_size reads, with
+        the requested columns (all by default, skipping the ones not in the summary).
+        """
+        columns = [x for x in (columns or self.columns) if x in self.meta['columns']]
+        chunk_size = chunk_size or SummaryCache.chunk_size
+        for start in range(0, self.reads, chunk_size):
+            end = min(start + chunk_size, self.reads)
+            df = pd.DataFrame({x: self.values(x, start, end) for x in columns})
+            mask = self.mask(start, end, **filters)
+            if mask is not None:
+                df = df[mask]
+            if len(df):
+                yield df
+
+    def barcode_stats(self):
+        # {barcode: [reads, bases]} from the codes, by chunks
+        if 'barcode' not in self.meta['columns']:
+            return dict()
+        n = len(self.categories('barcode'))
+        reads = np.zeros(n, dtype=np.int64)
+        bases = np.zeros(n, dtype=np.int64)
+        for start in range(0, self.reads, SummaryCache.chunk_size):
+            codes = self.column('barcode')[start:start + SummaryCache.chunk_size]
+            reads += np.bincount(codes, minlength=n)
+            bases += np.bincount(codes, weights=self.column('length')[start:start + SummaryCache.chunk_size],
+                                 minlength=n).astype(np.int64)
+        return {x: [int(reads[i]), int(bases[i])] for i, x in enumerate(self.categories('barcode'))}
+
+    def read_ids(self, **filters):
+        # Ids of the reads matching the filters, e.g. for FastqIndex.extract()
+        return [x for df in self.scan(['read_id'], **filters) for x in df['read_id']]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Columnar cache of a sequencing_summary.txt file: build it and list the '
+                                        'reads matching filters.')
+    parser.add_argument('summary', metavar='/path/to/sequencing_summary.txt')
+    parser.add_argument('--barcode', nargs='+',
+                        help='Only list the reads of these barcodes. Optional.')
+    parser.add_argument('--pass-only', action='store_true',
+                        help='Only list the reads passing the Guppy quality filter. Optional.')
+    parser.add_argument('-l', '--min-length', type=int, default=0,
+                        help='Only list reads at least that long. Default is 0. Optional.')
+    parser.add_argument('-q', '--min-q', type=float, default=0,
+                        help='Only list reads with at least that mean quality. Default is 0. Optional.')
+    parser.add_argument('-o', '--output', metavar='/path/to/read_ids.txt',
+                        help='Write the read ids there, one per line. Only the cache is built if not given. '
+                             'Optional.')
+    args = parser.parse_args()
+
+    summary_cache = SummaryCache.open(args.summary)
+    print('{} reads, {:.1f} MB cached in {}'.format(summary_cache.reads, summary_cache.size() / 1000000,
+                                                    summary_cache.folder))
+    if args.output:
+        id_list = summary_cache.read_ids(barcode=args.barcode, passed=True if args.pass_only else None,
+                                         min_length=args.min_length, min_quality=args.min_q)
+        with open(args.output, 'w') as f:
+            f.write(''.join(x + '\n' for x in id_list))
+        print('{} reads listed in {}'.format(len(id_list), args.output))
@@ -0,0 +1,387 @@
+import os
+import json
+import time
+import threading
+import multiprocessing
+import subprocess
+from collections import deque
+from concurrent import futures
+import numpy as np
+from basecall_nanopore_methods import Methods
+from read_filter import ReadFilter
+from fastq_index import FastqIndex
+from kits import Kits
+
+
+class AdapterIndex(object):
+    """
+    K-mer index of the start and end adapter sequences. A read is scanned by looking up all its k-mers at once in
+    a boolean table, then the few hits are grouped by adapter and diagonal (position in read - position in adapter)
+    to locate the adapters.
+    """
+
+    def __init__(self, adapter_dict, k=8):
+        self.k = k
+        self.entry_list = list()  # (adapter set name, 'start' or 'end', sequence)
+        self.kmer_dict = dict()  # {kmer code: [(entry index, position in adapter), ...]}
+        self.lookup = np.zeros(4 ** k, dtype=bool)
+        self.n_kmers = list()
+
+        for name, (start_seq, end_seq) in adapter_dict.items():
+            for side, seq in [('start', start_seq), ('end', end_seq)]:
+                if len(seq) < k:
+                    continue
+                entry = len(self.entry_list)
+                self.entry_list.append((name, side, seq))
+                codes, valid = AdapterIndex.encode_kmers(seq.encode(), k)
+                self.n_kmers.append(len(codes))
+                for pos, code in enumerate(codes):
+                    self.kmer_dict.setdefault(int(code), list()).append((entry, pos))
+                    self.lookup[code] = True
+
+    # A, C, G and T to 0-3. Anything else breaks k-mers.
+    base_table = np.full(256, -1, dtype=np.int64)
+    for i, base in enumerate(b'ACGT'):
+        base_table[base] = i
+        base_table[base + 32] = i  # Lower case
+
+    @staticmethod
+    def encode_kmers(seq, k):
+        # Return the code of each k-mer of the sequence and whether it only contains ACGT
+        codes = AdapterIndex.base_table[np.frombuffer(seq, dtype=np.uint8)]
+        if len(codes) < k:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+        windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+        kmers = (np.clip(windows, 0, 3) << (2 * np.arange(k - 1, -1, -1))).sum(axis=1)
+        return kmers, (windows >= 0).all(axis=1)
+
+    @staticmethod
+    def search(pattern, text):
+        """
+        Best match of the whole pattern anywhere in text (edit distance, Myers' bit-parallel algorithm). Return the
+        distance and the end of the first best match in text.
+        """
+        m = len(pattern)
+        mask = (1 << m) - 1
+        high = 1 << (m - 1)
+        peq = [0] * 256
+        for i, base in enumerate(pattern):
+            peq[base] |= 1 << i
+        pv, mv, score = mask, 0, m
+        best, best_end = m, 0
+        for j, base in enumerate(text):
+            eq = peq[base]
+            xv = eq | mv
+            xh = ((((eq & pv) + pv) & mask) ^ pv) | eq
+            ph = mv | (~(xh | pv) & mask)
+            mh = pv & xh
+            if ph & high:
+                score += 1
+            elif mh & high:
+                score -= 1
+            ph = (ph << 1) & mask
+            mh = (mh << 1) & mask
+            pv = mh | (~(xv | ph) & mask)
+            mv = ph & xv
+            if score < best:
+                best, best_end = score, j + 1
+        return best, best_end
+
+    @staticmethod
+    def align(pattern, text):
+        # Edit distance, start and end in text of the best match of the pattern
+        distance, end = AdapterIndex.search(pattern, text)
+        _, length = AdapterIndex.search(pattern[::-1], text[:end][::-1])
+        return distance, end - length, end
+
+    def find(self, seq, region_start=0, region_end=None, min_fraction=0.2, min_hits=3, band=8):
+        """
+        Look for adapters in seq[region_start:region_end].
+        Return a list of (entry index, start in read, end in read, identity, score). The adapters located by their
+        k-mers are aligned to the read, only the part of the adapter that can be in the region (it may start before
+        or end after it): start and end are those of the alignment, identity is 1 - edit distance / length and score
+        is length - 2 * edit distance (matched bases minus edits).
+        """
+        kmers, valid = AdapterIndex.encode_kmers(seq[region_start:region_end], self.k)
+        hit_positions = np.nonzero(self.lookup[kmers] & valid)[0]
+        if len(hit_positions) < min_hits:
+            return list()
+        region_stop = region_start + len(kmers) + self.k - 1
+
+        # Vote per adapter and diagonal, allowing a few indels
+        vote_dict = dict()
+        for read_pos in hit_positions.tolist():
+            for entry, adapter_pos in self.kmer_dict[int(kmers[read_pos])]:
+                vote_dict.setdefault(entry, list()).append(read_pos - adapter_pos)
+
+        hit_list = list()
+        for entry, diagonals in vote_dict.items():
+            diagonals = np.sort(np.array(diagonals))
+            # Largest number of hits within 4 bp of each other
+            counts = np.searchsorted(diagonals, diagonals + 4, side='right') - np.arange(len(diagonals))
+            best = int(np.argmax(counts))
+            fraction = counts[best] / self.n_kmers[entry]
+            if counts[best] < min_hits or fraction < min_fraction:
+                continue
+            # Read position of the first base of the adapter
+            diagonal = region_start + int(np.median(diagonals[best:best + counts[best]]))
+            adapter = self.entry_list[entry][2].encode()
+            first, last = max(region_start - diagonal, 0), min(len(adapter), region_stop - diagonal)
+            if last - first < self.k:
+                continue
+            window_start = max(diagonal + first - band, region_start)
+            window_end = min(diagonal + last + band, region_stop)
+            distance, start, end = AdapterIndex.align(adapter[first:last], seq[window_start:window_end])
+            hit_list.append((entry, window_start + start, window_start + end, 1 - distance / (last - first),
+                             last - first - 2 * distance))
+        return hit_list
+
+
+class NativeTrimmer(object):
+    """
+    Built-in alternative to Porechop. Adapters are first searched in the first "check_reads" reads to find which
+    adapter sets are present, like Porechop does. Then reads are processed in batches by a pool of processes
+    sharing the same read-only adapter index: adapters at the read ends are trimmed and reads with an adapter in
+    the middle are split (pieces shorter than "min_split_size" are discarded).
+    """
+
+    end_size = 150  # Length of the read ends where adapters are trimmed
+    extra_end_trim = 2  # Extra bases removed next to an adapter
+    end_fraction = 0.15  # Minimum fraction of adapter k-mers found to look closer at a read end
+    end_identity = 0.75  # Minimum alignment identity to trim, like the Porechop end threshold
+    middle_fraction = 0.4  # Higher for middle adapters, to avoid splitting reads on false positives
+    middle_identity = 0.9  # Like the Porechop middle threshold
+    middle_hits = 5
+    min_split_size = 1000
+    batch_size = 2000
+
+    worker_index = None  # Adapter index of each worker process
+
+    @staticmethod
+    def init_worker(adapter_dict):
+        NativeTrimmer.worker_index = AdapterIndex(adapter_dict)
+
+    @staticmethod
+    def end_adapter(index, seq, side):
+        """
+        Best supported adapter of that side ("start" or "end") in the read end: (entry index, start, end) of its
+        matched part, or None. Adapters matching only part of their length (e.g. sharing a prefix with the actual
+        adapter) are ignored.
+        """
+        if side == 'start':
+            hit_list = index.find(seq, 0, NativeTrimmer.end_size, NativeTrimmer.end_fraction)
+        else:
+            hit_list = index.find(seq, max(len(seq) - NativeTrimmer.end_size, 0), None, NativeTrimmer.end_fraction)
+        hit_list = [x for x in hit_list if index.entry_list[x[0]][1] == side and x[3] >= NativeTrimmer.end_identity]
+        if not hit_list:
+            return None
+        entry, start, end, identity, score = max(hit_list, key=lambda x: (x[4], x[3]))
+        return entry, start, end
+
+    @staticmethod
+    def trim_record(index, header, seq, qual):
+        read_len = len(seq)
+        start, end = 0, read_len
+
+        # Read ends, only the matched part of the adapter
+        hit = NativeTrimmer.end_adapter(index, seq, 'start')
+        if hit:
+            start = hit[2] + NativeTrimmer.extra_end_trim
+        hit = NativeTrimmer.end_adapter(index, seq, 'end')
+        if hit:
+            end = hit[1] - NativeTrimmer.extra_end_trim
+
+        # Middle of the read
+        cut_list = list()
+        if end - start > 2 * NativeTrimmer.end_size:
+            for entry, a_start, a_end, identity, score in index.find(seq, start + NativeTrimmer.end_size,
+                                                                      end - NativeTrimmer.end_size,
+                                                                      NativeTrimmer.middle_fraction,
+                                                                      NativeTrimmer.middle_hits):
+                if identity >= NativeTrimmer.middle_identity:
+                    cut_list.append((a_start - NativeTrimmer.extra_end_trim, a_end + NativeTrimmer.extra_end_trim))
+
+        if not cut_list:
+            if end <= start:
+                return list(), start > 0 or end < read_len, False
+            return [(header, seq[start:end], qual[start:end])], start > 0 or end < read_len, False
+
+        # Split read, numbering pieces like Porechop
+        read_id, _, description = header.partition(b' ')
+        piece_list = list()
+        for cut_start, cut_end in sorted(cut_list) + [(end, end)]:
+            if cut_start - start >= NativeTrimmer.min_split_size:
+                piece_header = read_id + b'_' + str(len(piece_list) + 1).encode()
+                if description:
+                    piece_header += b' ' + description
+                piece_list.append((piece_header, seq[start:cut_start], qual[start:cut_start]))
+            start = max(start, cut_end)
+        return piece_list, True, True
+
+    @staticmethod
+    def trim_batch(records):
+        out_list = list()
+        n_trimmed = n_split = 0
+        for header, seq, qual in records:
+            pieces, trimmed, split = NativeTrimmer.trim_record(NativeTrimmer.worker_index, header, seq, qual)
+            out_list.extend(pieces)
+            n_trimmed += trimmed
+            n_split += split
+        return b''.join(b'%s\n%s\n+\n%s\n' % r for r in out_list), n_trimmed, n_split
+
+    @staticmethod
+    def find_adapters(input_fastq, adapter_dict, check_reads):
+        # Adapter sets found at the ends of at least 1% of the checked reads
+        index = AdapterIndex(adapter_dict)
+        count_dict = dict()
+        n_reads = 0
+        for records in ReadFilter.iter_records(input_fastq, chunk_size=1024 * 1024):
+            for header, seq, qual in records:
+                found = set()
+                for side in ['start', 'end']:
+                    hit = NativeTrimmer.end_adapter(index, seq, side)
+                    if hit:
+                        found.add(index.entry_list[hit[0]][0])
+                for name in found:
+                    count_dict[name] = count_dict.get(name, 0) + 1
+                n_reads += 1
+                if n_reads >= check_reads:
+                    break
+            if n_reads >= check_reads:
+                break
+        return {name: adapter_dict[name] for name, count in count_dict.items() if count >= max(1, n_reads / 100)}
+
+    @staticmethod
+    def batch_adapters(barcode_batch_folder, input_fastq, adapter_dict, check_reads=1000):
+        # Adapters of a barcode in watch mode: found in its first batch, saved for the next batches and restarts
+        adapter_file = barcode_batch_folder + 'adapters.json'
+        if os.path.exists(adapter_file):
+            with open(adapter_file, 'r') as f:
+                return {k: tuple(v) for k, v in json.load(f).items()}
+        found_dict = NativeTrimmer.find_adapters(input_fastq, adapter_dict if adapter_dict else Kits.adapter_dict,
+                                                 check_reads)
+        with open(adapter_file + '.tmp', 'w') as f:
+            json.dump(found_dict, f, indent=4)
+        os.replace(adapter_file + '.tmp', adapter_file)
+        return found_dict
+
+    @staticmethod
+    def trim_fastq(input_fastq, out_fastq, cpu, check_reads=1000, adapter_dict=None, compress=True,
+                   index_file=None):
+        if adapter_dict is None:
+            adapter_dict = dict(Kits.adapter_dict)
+        # No reads to check: the adapters were already found, all of them are trimmed
+        found_dict = NativeTrimmer.find_adapters(input_fastq, adapter_dict, check_reads) if check_reads \
+            else adapter_dict
+
+        stats = {'reads': 0, 'trimmed': 0, 'split': 0, 'adapters': sorted(found_dict)}
+        read_fd, write_fd = os.pipe()
+
+        error = list()  # Of the writer thread
+
+        def writer():
+            try:
+                with os.fdopen(write_fd, 'wb') as f:
+                    if not found_dict:
+                        # Nothing to trim
+                        for records in ReadFilter.iter_records(input_fastq):
+                            stats['reads'] += len(records)
+                            f.write(b''.join(b'%s\n%s\n+\n%s\n' % r for r in records))
+                        return
+                    # Spawned, not forked: this thread runs next to the compression threads, and samples are trimmed
+                    # from scheduler and watch mode threads. The workers only need the adapters found.
+                    with futures.ProcessPoolExecutor(max_workers=max(1, cpu),
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=NativeTrimmer.init_worker,
+                                                     initargs=(found_dict,)) as executor:
+                        pending = deque()
+                        for records in ReadFilter.iter_records(input_fastq):
+                            for i in range(0, len(records), NativeTrimmer.batch_size):
+                                batch = records[i:i + NativeTrimmer.batch_size]
+                                stats['reads'] += len(batch)
+                                pending.append(executor.submit(NativeTrimmer.trim_batch, batch))
+                                # Bounded number of batches in flight, written in input order
+                                while len(pending) >= 2 * max(1, cpu):
+                                    NativeTrimmer.write_batch(f, pending.popleft().result(), stats)
+                        while pending:
+                            NativeTrimmer.write_batch(f, pending.popleft().result(), stats)
+            except BaseException as e:
+                error.append(e)
+
+        t = threading.Thread(target=writer)
+        t.start()
+        with os.fdopen(read_fd, 'rb') as f:
+            if compress:
+                Methods.compress_stream(f, out_fastq, max(1, cpu), level=Methods.intermediate_level(),
+                                        index_file=index_file)
+            else:
+                with open(out_fastq, 'wb') as f_out:
+                    for block in iter(lambda: f.read(4 * 1024 * 1024), b''):
+                        f_out.write(block)
+        t.join()
+        if error:
+            # Input stopped early: the output is truncated and must not be kept
+            raise error[0]
+        return stats
+
+    @staticmethod
+    def write_batch(f, result, stats):
+        data, n_trimmed, n_split = result
+        f.write(data)
+        stats['trimmed'] += n_trimmed
+        stats['split'] += n_split
+
+    @staticmethod
+    def run_trimming(sample, input_fastq, trimmed_folder, cpu, check_reads=1000, adapter_dict=None):
+        print('\t{}'.format(sample))
+        start_time = time.time()
+        trimmed_fastq = trimmed_folder + sample + '.fastq.gz'
+        try:
+            stats = NativeTrimmer.trim_fastq(input_fastq, trimmed_fastq + '.tmp', cpu, check_reads, adapter_dict,
+                                             index_file=FastqIndex.index_file(trimmed_fastq))
+        except BaseException:
+            ReadFilter.remove_partial(trimmed_fastq)
+            raise
+        os.replace(trimmed_fastq + '.tmp', trimmed_fastq)
+        elapsed = max(time.time() - start_time, 0.001)
+        print('\t{}: {} reads, {} trimmed, {} split in {:.1f}s ({:.0f} reads/s). Adapters found: {}'.format(
+            sample, stats['reads'], stats['trimmed'], stats['split'], elapsed, stats['reads'] / elapsed,
+            ', '.join(stats['adapters']) if stats['adapters'] else 'none'))
+
+    @staticmethod
+    def compare_with_porechop(input_fastq, work_folder, cpu, check_reads=1000, adapter_dict=None, tolerance=5,
+                              porechop='porechop'):
+        """
+        Benchmark against Porechop on a given fastq file. Return the throughput of each engine and the fraction of
+        reads trimmed the same way (same reads kept, lengths within "tolerance" bp).
+        """
+        Methods.make_folder(work_folder)
+        porechop_fastq = os.path.join(work_folder, 'porechop.fastq')
+        native_fastq = os.path.join(work_folder, 'native.fastq')
+
+        start_time = time.time()
+        with open(porechop_fastq, 'wb') as f:
+            subprocess.run([porechop, '-i', input_fastq, '--format', 'fastq', '--threads', str(cpu),
+                            '--check_reads', str(check_reads)], stdout=f, stderr=subprocess.DEVNULL, check=True)
+        porechop_time = max(time.time() - start_time, 0.001)
+
+        start_time = time.time()
+        stats = NativeTrimmer.trim_fastq(input_fastq, native_fastq, cpu, check_reads, adapter_dict, compress=False)
+        native_time = max(time.time() - start_time, 0.001)
+
+        length_list = list()
+        for fastq in [porechop_fastq, native_fastq]:
+            length_dict = dict()
+            for records in ReadFilter.iter_records(fastq):
+                for header, seq, qual in records:
+                    length_dict[header.split()[0]] = len(seq)
+            length_list.append(length_dict)
+        porechop_dict, native_dict = length_list
+
+        agree = len([x for x, length in porechop_dict.items()
+                     if x in native_dict and abs(native_dict[x] - length) <= tolerance])
+        return {'reads': stats['reads'],
+                'external_reads_per_s': stats['reads'] / porechop_time,
+                'native_reads_per_s': stats['reads'] / native_time,
+                'speedup': porechop_time / native_time,
+                'agreement': agree / max(len(set(porechop_dict) | set(native_dict)), 1)}
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import socket
+import shutil
+import itertools
+from glob import glob
+from basecall_nanopore_methods import Methods
+
+
+class Tuner(object):
+    """
+    Find the best Guppy "--chunk_size", "--chunks_per_runner" and "--gpu_runners_per_device" for this machine by
+    basecalling a small subset of the fast5 files with each combination. The fastest one is saved in a profile
+    keyed by host, config and device, which is then loaded automatically by the normal runs.
+    """
+
+    profile_file = os.path.expanduser('~/.basecall_nanopore/tuning.json')
+
+    grid = {'chunk_size': [1000, 2000],
+            'chunks_per_runner': [128, 256, 512],
+            'gpu_runners_per_device': [2, 4]}
+
+    @staticmethod
+    def profile_key(guppy_conf, device):
+        return '{}|{}|{}'.format(socket.gethostname(), guppy_conf, device)
+
+    @staticmethod
+    def load_profile(guppy_conf, device):
+        # Tuned Guppy parameters for this host, config and device, or the defaults
+        if os.path.exists(Tuner.profile_file):
+            with open(Tuner.profile_file, 'r') as f:
+                profile = json.load(f)
+            key = Tuner.profile_key(guppy_conf, device)
+            if key in profile:
+                return profile[key]['params']
+        return dict(Methods.guppy_params)
+
+    @staticmethod
+    def save_profile(guppy_conf, device, params, results):
+        profile = dict()
+        if os.path.exists(Tuner.profile_file):
+            with open(Tuner.profile_file, 'r') as f:
+                profile = json.load(f)
+        profile[Tuner.profile_key(guppy_conf, device)] = {'params': params,
+                                                          'tuned': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                                          'results': results}
+        os.makedirs(os.path.dirname(Tuner.profile_file), exist_ok=True)
+        tmp_file = Tuner.profile_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(profile, f, indent=4)
+        os.replace(tmp_file, Tuner.profile_file)
+
+    @staticmethod
+    def sample_fast5(fast5_dict, n_files):
+        # Evenly spaced over the run, so the subset is representative and the same each time
+        file_list = sorted(fast5_dict)
+        if len(file_list) <= n_files:
+            return file_list
+        step = len(file_list) / n_files
+        return [file_list[int(i * step)] for i in range(n_files)]
+
+    @staticmethod
+    def parse_samples_per_second(basecalled_folder):
+        # Guppy reports "Caller time: 12345 ms, Samples called: 123456789, samples/s: 1.2e+07" in its log
+        for log_file in glob(basecalled_folder + 'guppy_basecaller_log-*.log'):
+            with open(log_file, 'r') as f:
+                for line in f:
+                    if 'samples/s:' in line:
+                        try:
+                            return float(line.rsplit('samples/s:', 1)[1].split()[0])
+                        except (ValueError, IndexError):
+                            pass
+        return 0.0
+
+    @staticmethod
+    def count_reads(basecalled_folder):
+        summary_file = basecalled_folder + 'sequencing_summary.txt'
+        if not os.path.exists(summary_file):
+            return 0
+        with open(summary_file, 'rb') as f:
+            return max(sum(1 for _ in f) - 1, 0)
+
+    @staticmethod
+    def tune(fast5_folder, output_folder, guppy_conf, recursive, device, n_files=4, fast5_dict=None):
+        if fast5_dict is None:
+            fast5_dict = Methods.list_fast5(fast5_folder, recursive)
+        file_list = Tuner.sample_fast5(fast5_dict, n_files)
+        print('\tTuning Guppy on {} fast5 file(s) ({:.1f} MB)'.format(
+            len(file_list), sum(fast5_dict[x][0] for x in file_list) / 1000000))
+
+        tuning_folder = output_folder + '/tuning/'
+        results = list()
+        keys = list(Tuner.grid)
+        for values in itertools.product(*[Tuner.grid[x] for x in keys]):
+            params = dict(zip(keys, values))
+            folder = tuning_folder + '_'.join(str(x) for x in values) + '/'
+            shutil.rmtree(folder, ignore_errors=True)
+            start_time = time.time()
+            try:
+                # No barcode detection, only the basecalling speed is measured
+                Methods.run_guppy(fast5_folder, folder, guppy_conf, recursive, device, None,
+                                  file_list=file_list, guppy_params=params)
+            except Exception as e:
+                # Typically out of GPU memory
+                print('\t{}: failed ({})'.format(params, e))
+                results.append({'params': params, 'failed': True})
+                continue
+            elapsed = max(time.time() - start_time, 0.001)
+            reads = Tuner.count_reads(folder)
+            result = {'params': params,
+                      'failed': False,
+                      'seconds': round(elapsed, 2),
+                      'reads_per_second': reads / elapsed,
+                      'samples_per_second': Tuner.parse_samples_per_second(folder)}
+            results.append(result)
+            print('\t{}: {:.1f} reads/s, {:.3g} samples/s'.format(
+                params, result['reads_per_second'], result['samples_per_second']))
+        shutil.rmtree(tuning_folder, ignore_errors=True)
+
+        done = [x for x in results if not x['failed']]
+        if not done:
+            raise Exception('Guppy failed with all the tuning parameters.')
+        # Samples/s from the Guppy log when available, as it excludes the startup time
+        best = max(done, key=lambda x: (x['samples_per_second'], x['reads_per_second']))
+        Tuner.save_profile(guppy_conf, device, best['params'], results)
+        print('\tBest: {}. Saved to {}.'.format(best['params'], Tuner.profile_file))
+        return best['params']